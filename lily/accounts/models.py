@@ -1,7 +1,6 @@
 import urlparse
 
 from django.conf import settings
-from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
@@ -11,7 +10,7 @@ from lily.tenant.models import TenantMixin
 from lily.users.models import LilyUser
 from lily.utils.functions import flatten, clean_website
 from lily.utils.models.models import EmailAddress
-from lily.utils.models.mixins import Common
+from lily.utils.models.mixins import Common, ContentTypeMixin
 
 
 def get_account_logo_upload_path(instance, filename):
@@ -34,7 +33,7 @@ class AccountStatus(TenantMixin):
         ordering = ['position']
 
 
-class Account(Common, TaggedObjectMixin):
+class Account(Common, TaggedObjectMixin, ContentTypeMixin):
     """
     Account model, this is a company's profile. May have relations with contacts.
     """
@@ -71,13 +70,6 @@ class Account(Common, TaggedObjectMixin):
 
     import_id = models.CharField(max_length=100, default='', blank=True, db_index=True)
 
-    @property
-    def content_type(self):
-        """
-        Return the content type (Django model) for this model
-        """
-        return ContentType.objects.get(app_label="accounts", model="account")
-
     def primary_email(self):
         return self.email_addresses.filter(status=EmailAddress.PRIMARY_STATUS).first()
 
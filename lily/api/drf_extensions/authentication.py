@@ -3,16 +3,35 @@ import hmac
 
 from django.utils.translation import ugettext_lazy as _
 from rest_framework.authentication import BaseAuthentication, SessionAuthentication, TokenAuthentication
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed, PermissionDenied
 
 from lily.deals.models import Deal
 from lily.integrations.credentials import get_credentials
+from lily.users.authentication.tokens import get_token_user
 from lily.users.models import LilyUser
 from lily.tenant.middleware import set_current_user
 from lily.utils.functions import has_required_tier
 
 
-class TokenGETAuthentication(TokenAuthentication):
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Token authentication which looks up the users of the tokens in the caches before the database.
+    """
+    def authenticate_credentials(self, key):
+        user = get_token_user(key)
+
+        if user is None:
+            raise AuthenticationFailed(_('Invalid token.'))
+
+        if not user.is_active:
+            raise AuthenticationFailed(_('User inactive or deleted.'))
+
+        # The token itself isn't needed, so don't retrieve it from the database.
+        return (user, Token(key=key, user=user))
+
+
+class TokenGETAuthentication(CachedTokenAuthentication):
     """
     Allows for token authentication based on the GET parameter.
     """
@@ -25,7 +44,7 @@ class TokenGETAuthentication(TokenAuthentication):
 
 
 class LilyApiAuthentication(BaseAuthentication):
-    authenticators = (SessionAuthentication, TokenAuthentication, TokenGETAuthentication)
+    authenticators = (SessionAuthentication, CachedTokenAuthentication, TokenGETAuthentication)
 
     def authenticate(self, request):
         for authenticator_cls in self.authenticators:
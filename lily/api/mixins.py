@@ -2,6 +2,8 @@ import json
 
 from django.contrib.contenttypes.models import ContentType
 from rest_framework.decorators import detail_route, list_route
+from rest_framework.fields import SkipField
+from rest_framework.relations import PKOnlyObject
 from rest_framework.response import Response
 
 from lily.changes.models import Change
@@ -12,12 +14,15 @@ from lily.utils.functions import format_phone_number
 
 
 class ModelChangesMixin(object):
+    # Fields that are never stored in the change log.
+    ignored_change_fields = ['modified', 'id', 'full_name']
+
     def create(self, request, *args, **kwargs):
         response = super(ModelChangesMixin, self).create(request, *args, **kwargs)
 
         obj_id = response.data.get('id')
         content_type_id = response.data.get('content_type').get('id')
-        content_type = ContentType.objects.get(pk=content_type_id)
+        content_type = ContentType.objects.get_for_id(content_type_id)
 
         Change.objects.create(
             action='post',
@@ -29,25 +34,74 @@ class ModelChangesMixin(object):
 
         return response
 
-    def update(self, request, *args, **kwargs):
-        partial = kwargs.get('partial', False)
-        action = 'patch' if partial else 'put'
-        ignored_fields = ['modified', 'id', 'full_name']
+    def perform_update(self, serializer):
+        """
+        Save the object and log the changes of the fields in the request.
+
+        Only the fields in the request can change, so only those are serialized, once before and once after saving.
+        """
+        fields = self.get_change_fields(serializer)
+        old_data = self.get_change_snapshot(serializer, fields)
 
-        # Store the old data so we can compare changes.
-        serializer = self.get_serializer(instance=self.get_object())
-        old_data = serializer.data
+        super(ModelChangesMixin, self).perform_update(serializer)
 
-        response = super(ModelChangesMixin, self).update(request, *args, **kwargs)
+        obj = serializer.instance
+        # Related fields may still have the old objects prefetched.
+        obj._prefetched_objects_cache = {}
+        new_data = self.get_change_snapshot(serializer, fields)
 
-        obj = self.get_object()
-        serializer = self.get_serializer(instance=obj)
-        new_data = serializer.data
+        Change.objects.create(
+            action='patch' if serializer.partial else 'put',
+            data=json.dumps(self.get_change_data(old_data, new_data)),
+            user=self.request.user,
+            content_type=obj.content_type,
+            object_id=obj.id,
+        )
+
+    def get_change_fields(self, serializer):
+        """
+        Return the names of the serializer fields in the request, including their display fields.
+        """
+        fields = []
+
+        for key in self.request.data:
+            if key in serializer.fields and key not in self.ignored_change_fields:
+                fields.append(key)
+
+                if key + '_display' in serializer.fields:
+                    fields.append(key + '_display')
+
+        return fields
+
+    def get_change_snapshot(self, serializer, fields):
+        """
+        Serialize the given fields of the object, the same way the serializer itself would.
+        """
+        data = {}
+
+        for key in fields:
+            field = serializer.fields[key]
+
+            try:
+                attribute = field.get_attribute(serializer.instance)
+            except SkipField:
+                continue
+
+            check_for_none = attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+            data[key] = None if check_for_none is None else field.to_representation(attribute)
+
+        return data
+
+    def get_change_data(self, old_data, new_data):
+        """
+        Compare the old and new data of the object and return the changes per field.
+        """
+        request_data = self.request.data
 
         # Social media fields are saved in a 'special' way.
         # Since we want to show changes per social media type we split all the data.
-        if 'social_media' in request.data:
-            for item in old_data.get('social_media'):
+        if 'social_media' in old_data:
+            for item in old_data.get('social_media') or []:
                 social_type = item.get('name')
 
                 if social_type not in old_data:
@@ -57,7 +111,7 @@ class ModelChangesMixin(object):
 
             del old_data['social_media']
 
-            for item in new_data.get('social_media'):
+            for item in new_data.get('social_media') or []:
                 social_type = item.get('name')
 
                 if social_type not in new_data:
@@ -80,7 +134,7 @@ class ModelChangesMixin(object):
         for key in diffkeys:
             is_social_media = (key in dict(SocialMedia.SOCIAL_NAME_CHOICES).keys())
 
-            if key in request.data or is_social_media:
+            if key in request_data or is_social_media:
                 # We don't want to display an ID in the change log,
                 # so fetch the display name if possible.
                 choice_field_name = key + '_display'
@@ -108,7 +162,7 @@ class ModelChangesMixin(object):
                         new = new.get('full_name')
 
                 # Related fields (e.g. phone numbers) are always lists.
-                if is_social_media or isinstance(request.data[key], list):
+                if is_social_media or isinstance(request_data[key], list):
                     if len(old) > len(new):
                         for item in old:
                             # If the item has been deleted we still want to register the change.
@@ -127,34 +181,31 @@ class ModelChangesMixin(object):
 
                 data.update(change)
 
-        # Remove keys we don't want to track.
-        for key in data.keys():
-            if key in ignored_fields:
-                del data[key]
-
-        Change.objects.create(
-            action=action,
-            data=json.dumps(data),
-            user=request.user,
-            content_type=obj.content_type,
-            object_id=obj.id,
-        )
-
-        return response
+        return data
 
     @detail_route(methods=['get'])
     def changes(self, request, pk=None):
+        """
+        List the changes of the object, oldest first so clients can merge consecutive changes.
+
+        All changes are returned, unless a page is requested with the page or page_size query param.
+        """
         obj = self.get_object()
 
-        change_objects = Change.objects.prefetch_related(
+        change_objects = Change.objects.select_related(
             'user',
         ).filter(
             object_id=obj.id,
             content_type=obj.content_type
-        )
+        ).order_by('created', 'id')
+
+        page = None
+        if self.paginator and ('page' in request.query_params or 'page_size' in request.query_params):
+            page = self.paginate_queryset(change_objects)
+
         changes = []
 
-        for change in change_objects:
+        for change in change_objects if page is None else page:
             user = {
                 'id': change.user.id,
                 'full_name': change.user.full_name,
@@ -169,7 +220,14 @@ class ModelChangesMixin(object):
                 'created': change.created,
             })
 
-        return Response({'objects': changes})
+        if page is None:
+            return Response({'objects': changes})
+
+        response = self.get_paginated_response(changes)
+        # Keep the key the clients already use for the list of changes.
+        response.data['objects'] = response.data.pop('results')
+
+        return response
 
 
 class TimeLogMixin(object):
@@ -1,5 +1,3 @@
-import json
-
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.db import transaction
@@ -8,7 +6,8 @@ from django.utils import six
 from rest_framework import serializers
 from rest_framework.fields import empty
 from rest_framework.serializers import SerializerMetaclass
-from requests_futures.sessions import FuturesSession
+
+from lily.utils.webhooks import queue_webhook_event
 
 
 def is_dirty(instance, data):
@@ -375,29 +374,12 @@ class WritableNestedSerializer(serializers.ModelSerializer):
                 original_validated_data.update({
                     'id': instance.id,
                 })
-
-                data = {
-                    'type': model,
-                    'data': original_validated_data,
-                    'object': self.data,
-                    'event': 'create',
-                }
+                event = 'create'
             else:
-                data = {
-                    'type': model,
-                    'data': original_validated_data,
-                    'object': self.data,
-                    'event': 'update',
-                }
-
-            data = json.dumps(data, sort_keys=True, default=lambda x: str(x))
-
-            headers = {
-                'Content-Type': 'application/json',
-            }
+                event = 'update'
 
-            session = FuturesSession()
-            session.post(webhook.url, data=data, headers=headers)
+            # The event is stored and delivered by a worker, so the request doesn't wait for the webhook.
+            queue_webhook_event(webhook, model, self.instance.pk, event, original_validated_data, self.data)
 
 
 class WritableNestedListSerializer(serializers.ListSerializer):
@@ -20,8 +20,8 @@ from lily.notes.api.views import NoteViewSet
 from lily.provide.api.views import DataproviderViewSet
 from lily.tenant.api.views import TenantViewSet
 from lily.timelogs.api.views import TimeLogViewSet
-from lily.users.api.views import (LilyUserViewSet, TeamViewSet, TwoFactorDevicesViewSet, SessionViewSet,
-                                  UserInviteViewSet)
+from lily.users.api.views import (LilyUserViewSet, TeamViewSet, TokenCacheStats, TwoFactorDevicesViewSet,
+                                  SessionViewSet, UserInviteViewSet)
 from lily.utils.api.views import AppHash, CallerName, CountryViewSet, Notifications
 from lily.voipgrid.api.views import CallNotificationViewSet
 
@@ -99,5 +99,7 @@ urlpatterns = [
 
     url(r'^messaging/email/search/$', SearchView.as_view()),
 
+    url(r'^users/token-cache-stats/$', TokenCacheStats.as_view()),
+
     url(r'^', include(router.urls)),
 ]
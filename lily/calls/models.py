@@ -1,12 +1,12 @@
 from django.db import models
 from django.contrib.contenttypes.fields import GenericRelation
-from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _
 
 from lily.tenant.models import TenantMixin
+from lily.utils.models.mixins import ContentTypeMixin
 
 
-class Call(TenantMixin):
+class Call(TenantMixin, ContentTypeMixin):
     RINGING, ANSWERED, HUNGUP = range(3)
     CALL_STATUS_CHOICES = (
         (RINGING, _('Ringing')),
@@ -35,18 +35,11 @@ class Call(TenantMixin):
     created = models.DateTimeField(auto_now_add=True, null=True)
     notes = GenericRelation('notes.Note', content_type_field='gfk_content_type', object_id_field='gfk_object_id')
 
-    @property
-    def content_type(self):
-        """
-        Return the content type (Django model) for this model.
-        """
-        return ContentType.objects.get(app_label='calls', model='call')
-
     def __unicode__(self):
         return '%s: Call from %s to %s' % (self.unique_id, self.caller_number, self.called_number)
 
 
-class CallRecord(TenantMixin):
+class CallRecord(TenantMixin, ContentTypeMixin):
     RINGING, IN_PROGRESS, ENDED = range(3)
     CALL_STATUS_CHOICES = (
         (RINGING, _('Ringing')),
@@ -101,16 +94,6 @@ class CallRecord(TenantMixin):
         object_id_field='gfk_object_id'
     )
 
-    @property
-    def content_type(self):
-        """
-        Return the content type (Django model) for this model.
-        """
-        return ContentType.objects.get(
-            app_label='calls',
-            model='callrecord'
-        )
-
     def __unicode__(self):
         return '%s: Call from %s' % (
             self.call_id,
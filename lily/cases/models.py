@@ -1,5 +1,4 @@
 from django.contrib.contenttypes.fields import GenericRelation
-from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 
@@ -10,7 +9,7 @@ from lily.tags.models import TaggedObjectMixin
 from lily.tenant.models import TenantMixin
 from lily.users.models import Team, LilyUser
 from lily.utils.date_time import week_from_now
-from lily.utils.models.mixins import DeletedMixin, ArchivedMixin
+from lily.utils.models.mixins import DeletedMixin, ArchivedMixin, ContentTypeMixin
 
 
 class CaseType(TenantMixin, ArchivedMixin):
@@ -35,7 +34,7 @@ class CaseStatus(TenantMixin):
         ordering = ['position']
 
 
-class Case(TenantMixin, TaggedObjectMixin, DeletedMixin, ArchivedMixin):
+class Case(TenantMixin, TaggedObjectMixin, DeletedMixin, ArchivedMixin, ContentTypeMixin):
     LOW_PRIO, MID_PRIO, HIGH_PRIO, CRIT_PRIO = range(4)
     PRIORITY_CHOICES = (
         (LOW_PRIO, _('Low')),
@@ -67,13 +66,6 @@ class Case(TenantMixin, TaggedObjectMixin, DeletedMixin, ArchivedMixin):
     billing_checked = models.BooleanField(default=False)
     newly_assigned = models.BooleanField(default=False)
 
-    @property
-    def content_type(self):
-        """
-        Return the content type (Django model) for this model.
-        """
-        return ContentType.objects.get(app_label='cases', model='case')
-
     def __unicode__(self):
         return self.subject
 
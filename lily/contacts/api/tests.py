@@ -227,3 +227,53 @@ class ContactTests(GenericAPITestCase):
                 [item['id'] for item in request.data.get(field_name)],
                 '%s %s -was- deleted while it should have been.' % (field_name, object_list[1].pk)
             )
+
+    def test_patch_logs_changes(self):
+        contact = self._create_object(with_relations=True)
+        phone_numbers = list(contact.phone_numbers.all())
+        old_first_name = contact.first_name
+
+        data = {
+            'first_name': 'Changed',
+            'phone_numbers': [{
+                'id': phone_numbers[0].pk,
+                'is_deleted': True,
+            }],
+        }
+        self.user.patch(self.get_url(self.detail_url, kwargs={'pk': contact.pk}), data)
+
+        request = self.user.get(self.get_url('contact-changes', kwargs={'pk': contact.pk}))
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(len(request.data['objects']), 1)
+
+        change = request.data['objects'][0]
+        self.assertEqual(change['action'], 'patch')
+        # Only the fields in the request should be logged.
+        self.assertEqual(set(change['data'].keys()), {'first_name', 'phone_numbers'})
+        self.assertEqual(change['data']['first_name'], {'old': old_first_name, 'new': 'Changed'})
+        self.assertIn(
+            {'id': phone_numbers[0].pk, 'is_deleted': True},
+            change['data']['phone_numbers']['new']
+        )
+
+    def test_changes_order(self):
+        contact = self._create_object()
+
+        for first_name in ('First', 'Second', 'Third'):
+            self.user.patch(self.get_url(self.detail_url, kwargs={'pk': contact.pk}), {'first_name': first_name})
+
+        # All changes are returned oldest first, which the activity stream relies on to merge them.
+        request = self.user.get(self.get_url('contact-changes', kwargs={'pk': contact.pk}))
+        self.assertNotIn('pagination', request.data)
+        self.assertEqual(
+            [change['data']['first_name']['new'] for change in request.data['objects']],
+            ['First', 'Second', 'Third']
+        )
+
+        # Unless a page is requested.
+        request = self.user.get(self.get_url('contact-changes', kwargs={'pk': contact.pk}), {'page_size': 2})
+        self.assertEqual(request.data['pagination']['total'], 3)
+        self.assertEqual(
+            [change['data']['first_name']['new'] for change in request.data['objects']],
+            ['First', 'Second']
+        )
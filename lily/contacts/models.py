@@ -1,4 +1,3 @@
-from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 
@@ -6,7 +5,7 @@ from lily.accounts.models import Account
 from django.conf import settings
 from lily.tags.models import TaggedObjectMixin
 from lily.utils.models.models import PhoneNumber, EmailAddress
-from lily.utils.models.mixins import Common, DeletedMixin
+from lily.utils.models.mixins import Common, ContentTypeMixin, DeletedMixin
 
 
 def get_contact_picture_upload_path(instance, filename):
@@ -17,7 +16,7 @@ def get_contact_picture_upload_path(instance, filename):
     }
 
 
-class Contact(Common, TaggedObjectMixin):
+class Contact(Common, TaggedObjectMixin, ContentTypeMixin):
     """
     Contact model, this is a person's profile. Has an optional relation to an account through
     Function. Can be related to LilyUser.
@@ -58,13 +57,6 @@ class Contact(Common, TaggedObjectMixin):
         related_name='contacts',
     )
 
-    @property
-    def content_type(self):
-        """
-        Return the content type (Django model) for this model.
-        """
-        return ContentType.objects.get(app_label='contacts', model='contact')
-
     @property
     def primary_email(self):
         """
@@ -1,5 +1,4 @@
 from django.contrib.contenttypes.fields import GenericRelation
-from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 
@@ -9,7 +8,7 @@ from lily.tags.models import TaggedObjectMixin
 from lily.users.models import LilyUser, Team
 from lily.tenant.models import TenantMixin
 from lily.utils.currencies import CURRENCIES
-from lily.utils.models.mixins import DeletedMixin, ArchivedMixin
+from lily.utils.models.mixins import DeletedMixin, ArchivedMixin, ContentTypeMixin
 
 
 class DealNextStep(TenantMixin):
@@ -87,7 +86,7 @@ class DealStatus(TenantMixin):
         ordering = ['position']
 
 
-class Deal(TaggedObjectMixin, TenantMixin, DeletedMixin, ArchivedMixin):
+class Deal(TaggedObjectMixin, TenantMixin, DeletedMixin, ArchivedMixin, ContentTypeMixin):
     """
     Deal model
     """
@@ -131,13 +130,6 @@ class Deal(TaggedObjectMixin, TenantMixin, DeletedMixin, ArchivedMixin):
                                  on_delete=models.SET_NULL)
     newly_assigned = models.BooleanField(default=False)
 
-    @property
-    def content_type(self):
-        """
-        Return the content type (Django model) for this model
-        """
-        return ContentType.objects.get(app_label='deals', model='deal')
-
     def __unicode__(self):
         return self.name
 
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('importer', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importupload',
+            name='offset',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -20,3 +20,5 @@ class ImportUpload(TenantMixin, TimeStampedModel):
         upload_to=get_csv_import_upload_path,
         max_length=500
     )
+    # The position in bytes in the file after the last imported row.
+    offset = models.PositiveIntegerField(default=0)
@@ -1,16 +1,19 @@
+import codecs
 import logging
+from itertools import islice
 
+import unicodecsv
 from celery.task import task
 from django.conf import settings
 from django.db import transaction
-from django.db.models import Q
-from tablib import Dataset
 
 from lily.accounts.models import Account, AccountStatus, Website
 from lily.contacts.models import Contact, Function
 from lily.importer.models import ImportUpload
+from lily.search.index_queue import deferred_indexing, enqueue_index
+from lily.search.scan_search import ModelMappings
 from lily.socialmedia.models import SocialMedia
-from lily.utils.functions import parse_phone_number
+from lily.utils.functions import clean_website, flatten, normalize_phone_number, parse_phone_number
 from lily.utils.models.models import EmailAddress, PhoneNumber, Address
 
 
@@ -19,23 +22,29 @@ logger = logging.getLogger(__name__)
 
 @task(name='import_csv_file', logger=logger, bind=True)
 def import_csv_file(self, upload_id, iteration, import_type):
+    """
+    Import the next batch of rows of the uploaded file and schedule the import of the batch after that.
+
+    Reading starts at the offset where the previous batch stopped, so every row of the file is only parsed once.
+    """
     csv_upload = ImportUpload.objects.get(id=upload_id)
-    csv_file = csv_upload.csv
-    data = Dataset().load(csv_file.read())
-    headers = data.headers
-
-    batch_size = settings.IMPORT_BATCH_SIZE
-    start = iteration * batch_size
-    end = min(((iteration + 1) * batch_size) - 1, len(data) - 1)
-
-    for i in range(start, end + 1):
-        row = dict(zip(headers, data[i]))  # Use headers as keys and data as values.
-        if import_type == 'contacts':
-            import_contact(row, csv_upload.tenant_id, data.headers)
-        else:  # 'accounts'
-            import_account(row, csv_upload.tenant_id, data.headers)
-
-    if ((iteration + 1) * batch_size) < len(data):
+
+    csv_upload.csv.open('rb')
+    try:
+        reader = CSVRowReader(csv_upload.csv, offset=csv_upload.offset)
+        rows = list(islice(reader, settings.IMPORT_BATCH_SIZE))
+    finally:
+        csv_upload.csv.close()
+
+    if import_type == 'contacts':
+        ContactImporter(csv_upload.tenant_id, reader.headers).run(rows)
+    else:  # 'accounts'
+        AccountImporter(csv_upload.tenant_id, reader.headers).run(rows)
+
+    csv_upload.offset = reader.offset
+    csv_upload.save()
+
+    if rows and reader.offset < csv_upload.csv.size:
         import_csv_file.apply_async(
             queue='other_tasks',
             kwargs={
@@ -47,395 +56,516 @@ def import_csv_file(self, upload_id, iteration, import_type):
         )
 
 
-def import_contact(row, tenant_id, headers):
-    # The following set of fields should be present as headers in the uploaded file.
-    required_fields = {u'first name', u'last name'}
-    # The following set of fields are optional.
-    optional_fields = {u'company name', u'email address', u'phone number', u'address', u'postal code', u'city',
-                       u'twitter', u'linkedin', u'mobile'}
+class CSVRowReader(object):
+    """
+    Iterate over the rows of a CSV file as dicts with the headers as keys.
 
-    # The following headers are present in the uploaded file.
-    available_in_upload = set(headers)
+    The file is read line by line, so the position in bytes after the last returned row is known. Reading can be
+    continued from that position later on without parsing the preceding rows again.
 
-    optional_in_upload = optional_fields & available_in_upload
-    extra_in_upload = available_in_upload - (required_fields | optional_fields)
+    The upload is validated by tablib, so the file is read the same way: tab separated files are supported and a
+    byte order mark is skipped. Lines that aren't UTF-8 are read as Windows-1252, the encoding Excel uses on Windows.
+    Rows that can't be parsed are logged and skipped.
+    """
+    fallback_encoding = 'cp1252'
 
-    first_name = row.get(u'first name')
-    last_name = row.get(u'last name')
-    full_name = u'{0} {1}'.format(first_name, last_name)
+    def __init__(self, csv_file, offset=0):
+        self.file = csv_file
+        self.file.seek(0)
+        self.position = 0
 
-    contact = new_or_existing_contact(row, tenant_id, optional_in_upload)
+        header_line = self.file.readline()
+        self.file.seek(0)
+        delimiter = '\t' if header_line.count('\t') > header_line.count(',') else ','
 
-    account = None
-    email_address = None
-    phone_number = None
-    address = None
-    twitter = None
-    linkedin = None
-    mobile = None
-    try:
-        # Use atomic to rollback all intermediate database actions if an error occurs in just one of them.
-        with transaction.atomic():
-            # All the extra fields excluding 'company' that are present in the upload are placed in the description
-            # field.
-            description = u''
-            extra_in_upload_wo_company = set(extra_in_upload)
-            extra_in_upload_wo_company.discard(u'company name')
-            for field in extra_in_upload_wo_company:
-                if row.get(field):
-                    description += '{0}: {1}\n'.format(field.capitalize(), row.get(field))
+        self.reader = unicodecsv.reader(self._read_lines(), encoding='utf-8', delimiter=delimiter)
 
-            contact.description = description
-            contact.save()
+        self.headers = next(self.reader, [])
+        self.offset = self.position
 
-            if u'company name' in optional_in_upload and row.get(u'company name'):
-                company_name = row.get(u'company name')
-                # Not using get_or_create() to make use of the skip_signal construction.
-                try:
-                    account = Account.objects.get(name=company_name, tenant_id=tenant_id, is_deleted=False)
-                except Account.DoesNotExist:
-                    account_status = AccountStatus.objects.get(name='Relation', tenant_id=tenant_id)
-                    account = Account(
-                        name=company_name,
-                        tenant_id=tenant_id,
-                        status=account_status
-                    )
-                    account.skip_signal = True
-                    account.save()
-
-            if u'email address' in optional_in_upload and row.get(u'email address'):
-                formatted_email_address = row.get(u'email address').lower()
-                if not contact.email_addresses.filter(email_address=formatted_email_address).exists():
-                    email_address = EmailAddress(
-                        email_address=formatted_email_address,
-                        status=EmailAddress.PRIMARY_STATUS,
-                        tenant_id=tenant_id
-                    )
-                    email_address.skip_signal = True
-                    email_address.save()
-
-            if u'phone number' in optional_in_upload and row.get(u'phone number'):
-                formatted_phone_number = parse_phone_number(row.get(u'phone number'))
-                if not contact.phone_numbers.filter(number=formatted_phone_number).exists():
-                    phone_number = PhoneNumber(
-                        number=formatted_phone_number,
-                        tenant_id=tenant_id
-                    )
-                    phone_number.skip_signal = True
-                    phone_number.save()
-
-            # An Address consists of multiple, optional fields. So create or update the instance.
-            if u'address' in optional_in_upload and row.get(u'address'):
-                address = Address(
-                    address=row.get(u'address'),
-                    type='visiting',
-                    tenant_id=tenant_id
-                )
-                address.skip_signal = True
-                address.save()
-
-            if u'postal code' in optional_in_upload and row.get(u'postal code'):
-                if address:
-                    address.postal_code = row.get(u'postal code')
-                else:
-                    address = Address(
-                        postal_code=row.get(u'postal code'),
-                        type='visiting',
-                        tenant_id=tenant_id
-                    )
-                address.skip_signal = True
-                address.save()
-
-            if u'city' in optional_in_upload and row.get(u'city'):
-                if address:
-                    address.city = row.get(u'city')
-                else:
-                    address = Address(
-                        city=row.get(u'city'),
-                        type='visiting',
-                        tenant_id=tenant_id
-                    )
-                address.skip_signal = True
-                address.save()
-
-            if u'twitter' in optional_in_upload and row.get(u'twitter'):
-                twitter = SocialMedia(
-                    name='twitter',
-                    username=row.get(u'twitter'),
-                    profile_url='https://twitter.com/{0}'.format(row.get(u'twitter')),
-                    tenant_id=tenant_id
-                )
-                twitter.skip_signal = True
-                twitter.save()
-
-            if u'linkedin' in optional_in_upload and row.get(u'linkedin'):
-                linkedin = SocialMedia(
-                    name='linkedin',
-                    username=row.get(u'linkedin'),
-                    profile_url='https://www.linkedin.com/in/{0}'.format(row.get(u'linkedin')),
-                    tenant_id=tenant_id
-                )
-                linkedin.skip_signal = True
-                linkedin.save()
-
-            if u'mobile' in optional_in_upload and row.get(u'mobile'):
-                formatted_phone_number = parse_phone_number(row.get(u'mobile'))
-                if not contact.phone_numbers.filter(number=formatted_phone_number).exists():
-                    mobile = PhoneNumber(
-                        number=formatted_phone_number,
-                        tenant_id=tenant_id,
-                        type='mobile'
-                    )
-                    mobile.skip_signal = True
-                    mobile.save()
-
-    except Exception as e:
-        # On an exception all database actions are rolled back. Because of the skip_signal=True no row is added to the
-        # search index.
-        logger.error(u'Import error for {}: {}'.format(full_name, e))
-    else:
-        if email_address:
-            email_address.skip_signal = False
-            email_address.save()
-            contact.email_addresses.add(email_address)
-        if phone_number:
-            phone_number.skip_signal = False
-            phone_number.save()
-            contact.phone_numbers.add(phone_number)
-        if address:
-            address.skip_signal = False
-            address.save()
-            contact.addresses.add(address)
-        if twitter:
-            twitter.skip_signal = False
-            twitter.save()
-            contact.social_media.add(twitter)
-        if linkedin:
-            linkedin.skip_signal = False
-            linkedin.save()
-            contact.social_media.add(linkedin)
-        if account:
-            account.skip_signal = False
-            account.save()
+        if offset > self.offset:
+            self.file.seek(offset)
+            self.position = self.offset = offset
+
+    def _read_lines(self):
+        while True:
+            line = self.file.readline()
+            if not line:
+                return
 
-            if not Function.objects.filter(account=account, contact=contact).exists():
-                Function.objects.create(account=account, contact=contact)
-        if mobile:
-            mobile.skip_signal = False
-            mobile.save()
-            contact.phone_numbers.add(mobile)
+            if not self.position and line.startswith(codecs.BOM_UTF8):
+                # Files saved by Excel start with a byte order mark, which isn't part of the first header.
+                value = line[len(codecs.BOM_UTF8):]
+            else:
+                value = line
 
-        contact.skip_signal = False
-        contact.save()
+            try:
+                value.decode('utf-8')
+            except UnicodeDecodeError:
+                value = value.decode(self.fallback_encoding, 'replace').encode('utf-8')
 
+            self.position += len(line)
+            yield value
 
-def new_or_existing_contact(row, tenant_id, optional_in_upload):
+    def __iter__(self):
+        while True:
+            try:
+                values = next(self.reader)
+            except StopIteration:
+                return
+            except unicodecsv.Error as e:
+                logger.warning('Skipping the row before byte %s of the import, it can\'t be read: %s' % (
+                    self.position,
+                    e
+                ))
+                self.offset = self.position
+                continue
+
+            self.offset = self.position
+            if values:
+                # Skip empty lines.
+                yield dict(zip(self.headers, values))
+
+
+def add_relations(model, field_name, pairs):
     """
-    Determine if Lily needs to create a new contact with the given row or that it should update a current contact.
+    Add the objects to the many to many field of the instances with one query.
+
+    Args:
+        model (Model): the model of the instances
+        field_name (str): the name of the many to many field
+        pairs (list): tuples with an instance and the object to add
+    """
+    if not pairs:
+        return
+
+    field = model._meta.get_field(field_name)
+    through = field.remote_field.through
+    through.objects.bulk_create([through(**{
+        '%s_id' % field.m2m_field_name(): instance.pk,
+        '%s_id' % field.m2m_reverse_field_name(): obj.pk,
+    }) for instance, obj in pairs])
+
+
+class BaseImporter(object):
+    """
+    Import the rows of one batch with set based queries.
+
+    The existing objects are fetched for the whole batch at once and new objects are inserted with bulk_create.
+    The search index is updated in bulk after the batch is imported.
     """
-    account = None
-    email_address = None
-    formatted_phone_number = None
-
-    first_name = row.get(u'first name')
-    last_name = row.get(u'last name')
-
-    if u'company name' in optional_in_upload and row.get(u'company name'):
-        company_name = row.get(u'company name')
-        try:
-            account = Account.objects.get(name=company_name, tenant_id=tenant_id, is_deleted=False)
-        except Account.DoesNotExist:
-            pass
-
-    if u'email address' in optional_in_upload and row.get(u'email address'):
-        email_address = row.get(u'email address').lower()
-
-    if u'phone number' in optional_in_upload and row.get(u'phone number'):
-        formatted_phone_number = parse_phone_number(row.get(u'phone number'))
-
-    # Regard as a existing contact when there is one in the database with the given name in combination with the
-    # email address and / or phone number.
-    qs = Contact.objects.filter(
-        first_name=first_name,
-        last_name=last_name,
-        tenant_id=tenant_id,
-        is_deleted=False
-    )
-
-    if account:
-        qs = qs.filter(
-            functions__account=account
+    required_fields = set()
+    optional_fields = set()
+
+    def __init__(self, tenant_id, headers):
+        self.tenant_id = tenant_id
+        self.headers = headers
+
+        # The following headers are present in the uploaded file.
+        available_in_upload = set(headers)
+
+        self.optional_in_upload = self.optional_fields & available_in_upload
+        self.extra_in_upload = available_in_upload - (self.required_fields | self.optional_fields)
+
+        self.relation_status = None
+        self.new_accounts = []
+        self.email_addresses = []
+        self.phone_numbers = []
+        self.addresses = []
+        self.social_media = []
+
+    def run(self, rows):
+        """
+        Import the rows as one batch. If that fails, import the rows one at a time so only the failing rows are lost.
+        """
+        with deferred_indexing():
+            try:
+                with transaction.atomic():
+                    self.import_rows(rows)
+            except Exception as e:
+                logger.warning(u'Import error for batch, importing the rows one at a time: {}'.format(e))
+
+                for row in rows:
+                    try:
+                        with transaction.atomic():
+                            # Use a new importer, so nothing of the failed batch is reused.
+                            type(self)(self.tenant_id, self.headers).import_rows([row])
+                    except Exception as e:
+                        logger.error(u'Import error for {}: {}'.format(self.get_row_name(row), e))
+
+    def import_rows(self, rows):
+        raise NotImplementedError
+
+    def get_row_name(self, row):
+        raise NotImplementedError
+
+    def get_value(self, row, field):
+        """
+        Return the value of an optional field, or None if the field isn't in the upload or is empty.
+        """
+        if field in self.optional_in_upload and row.get(field):
+            return row.get(field)
+        return None
+
+    def new_account(self, name, description=u''):
+        if not self.relation_status:
+            self.relation_status = AccountStatus.objects.get(name='Relation', tenant_id=self.tenant_id)
+
+        account = Account(
+            name=name,
+            flatname=flatten(name),
+            tenant_id=self.tenant_id,
+            status=self.relation_status,
+            description=description
         )
+        self.new_accounts.append(account)
+
+        return account
+
+    def new_email_address(self, email_address):
+        email_address = EmailAddress(
+            email_address=email_address,
+            status=EmailAddress.PRIMARY_STATUS,
+            tenant_id=self.tenant_id
+        )
+        self.email_addresses.append(email_address)
+
+        return email_address
 
-    if email_address and formatted_phone_number:
-        qs = qs.filter(
-            Q(email_addresses__email_address=email_address) | Q(phone_numbers__number=formatted_phone_number)
+    def new_phone_number(self, number, phone_type=None):
+        # Phone numbers are bulk created, which skips PhoneNumber.save, so normalize the number here.
+        phone_number = PhoneNumber(
+            number=number,
+            normalized_number=normalize_phone_number(number),
+            tenant_id=self.tenant_id
         )
-    elif email_address:
-        qs = qs.filter(email_addresses__email_address=email_address)
-    elif formatted_phone_number:
-        qs = qs.filter(phone_numbers__number=formatted_phone_number)
-
-    contact = qs.first()
-
-    if not contact:
-        # There was no existing contact, so instantiate a new one.
-        contact = Contact(
-            first_name=first_name,
-            last_name=last_name,
-            tenant_id=tenant_id
+        if phone_type:
+            phone_number.type = phone_type
+        self.phone_numbers.append(phone_number)
+
+        return phone_number
+
+    def new_address(self, row):
+        """
+        An Address consists of multiple, optional fields, so only create one if any of them is in the row.
+        """
+        fields = {
+            'address': self.get_value(row, u'address'),
+            'postal_code': self.get_value(row, u'postal code'),
+            'city': self.get_value(row, u'city'),
+        }
+
+        if not any(fields.values()):
+            return None
+
+        address = Address(
+            type='visiting',
+            tenant_id=self.tenant_id,
+            **{field: value for field, value in fields.items() if value}
         )
+        self.addresses.append(address)
 
-    # Skip the signal at this moment, so on a rollback the instance isn't still in the search index.
-    contact.skip_signal = True
+        return address
+
+    def new_social_media(self, name, username, profile_url):
+        social_media = SocialMedia(
+            name=name,
+            username=username,
+            profile_url=profile_url,
+            tenant_id=self.tenant_id
+        )
+        self.social_media.append(social_media)
+
+        return social_media
+
+    def save_new_objects(self):
+        """
+        Insert all new related objects with one query per model.
+        """
+        for model, objects in [
+            (Account, self.new_accounts),
+            (EmailAddress, self.email_addresses),
+            (PhoneNumber, self.phone_numbers),
+            (Address, self.addresses),
+            (SocialMedia, self.social_media),
+        ]:
+            if objects:
+                model.objects.bulk_create(objects)
+
+
+class ContactImporter(BaseImporter):
+    # The following set of fields should be present as headers in the uploaded file.
+    required_fields = {u'first name', u'last name'}
+    # The following set of fields are optional.
+    optional_fields = {u'company name', u'email address', u'phone number', u'address', u'postal code', u'city',
+                       u'twitter', u'linkedin', u'mobile'}
 
-    return contact
+    def get_row_name(self, row):
+        return u'{0} {1}'.format(row.get(u'first name'), row.get(u'last name'))
+
+    def import_rows(self, rows):
+        company_names = set(filter(None, [self.get_value(row, u'company name') for row in rows]))
+
+        # Accounts that exist before importing the batch.
+        accounts = {}
+        for account in Account.objects.filter(
+            name__in=company_names,
+            tenant_id=self.tenant_id,
+            is_deleted=False
+        ).order_by('pk'):
+            accounts.setdefault(account.name, account)
+
+        contacts = self.get_existing_contacts(rows)
+        imported_contacts = []
+        changed_contacts = {}
+        new_contacts = []
+        functions = []
+        relations = {
+            'email_addresses': [],
+            'phone_numbers': [],
+            'addresses': [],
+            'social_media': [],
+        }
+
+        for row in rows:
+            first_name = row.get(u'first name')
+            last_name = row.get(u'last name')
+            company_name = self.get_value(row, u'company name')
+            email_address = self.get_value(row, u'email address')
+            if email_address:
+                email_address = email_address.lower()
+            phone_number = self.get_value(row, u'phone number')
+            if phone_number:
+                phone_number = parse_phone_number(phone_number)
+
+            contact = self.find_contact(
+                contacts.get((first_name, last_name), []),
+                company_name if company_name in accounts else None,
+                email_address,
+                phone_number
+            )
+
+            if not contact:
+                # There was no existing contact, so instantiate a new one.
+                contact = Contact(
+                    first_name=first_name,
+                    last_name=last_name,
+                    tenant_id=self.tenant_id
+                )
+                contact.import_email_addresses = set()
+                contact.import_phone_numbers = set()
+                contact.import_account_names = set()
+                contacts.setdefault((first_name, last_name), []).append(contact)
+                new_contacts.append(contact)
+            imported_contacts.append(contact)
 
+            # All the extra fields excluding 'company' that are present in the upload are placed in the description
+            # field.
+            description = u''
+            for field in self.extra_in_upload - {u'company name'}:
+                if row.get(field):
+                    description += u'{0}: {1}\n'.format(field.capitalize(), row.get(field))
 
-def import_account(row, tenant_id, headers):
+            if contact.pk and contact.description != description:
+                changed_contacts[contact.pk] = contact
+            contact.description = description
+
+            if company_name:
+                account = accounts.get(company_name)
+                if not account:
+                    account = self.new_account(company_name)
+                    accounts[company_name] = account
+
+                if company_name not in contact.import_account_names:
+                    functions.append((account, contact))
+                    contact.import_account_names.add(company_name)
+
+            if email_address and email_address not in contact.import_email_addresses:
+                relations['email_addresses'].append((contact, self.new_email_address(email_address)))
+                contact.import_email_addresses.add(email_address)
+
+            for field, phone_type in [(u'phone number', None), (u'mobile', 'mobile')]:
+                number = self.get_value(row, field)
+                if not number:
+                    continue
+
+                number = parse_phone_number(number)
+                if number not in contact.import_phone_numbers:
+                    relations['phone_numbers'].append((contact, self.new_phone_number(number, phone_type)))
+                    contact.import_phone_numbers.add(number)
+
+            address = self.new_address(row)
+            if address:
+                relations['addresses'].append((contact, address))
+
+            twitter = self.get_value(row, u'twitter')
+            if twitter:
+                relations['social_media'].append((contact, self.new_social_media(
+                    'twitter', twitter, 'https://twitter.com/{0}'.format(twitter)
+                )))
+
+            linkedin = self.get_value(row, u'linkedin')
+            if linkedin:
+                relations['social_media'].append((contact, self.new_social_media(
+                    'linkedin', linkedin, 'https://www.linkedin.com/in/{0}'.format(linkedin)
+                )))
+
+        Contact.objects.bulk_create(new_contacts)
+        for contact in changed_contacts.values():
+            contact.save()
+
+        self.save_new_objects()
+
+        for field_name, pairs in relations.items():
+            add_relations(Contact, field_name, pairs)
+        Function.objects.bulk_create([
+            Function(account=function_account, contact=function_contact)
+            for function_account, function_contact in functions
+        ])
+
+        contact_mapping = ModelMappings.model_to_mappings[Contact]
+        for contact in imported_contacts:
+            enqueue_index(contact_mapping, contact.pk)
+        account_mapping = ModelMappings.model_to_mappings[Account]
+        for account, contact in functions:
+            enqueue_index(account_mapping, account.pk)
+
+    def get_existing_contacts(self, rows):
+        """
+        Fetch the contacts with the names of the rows, together with their email addresses, phone numbers and accounts.
+
+        Returns:
+            dict: lists of contacts by first and last name
+        """
+        first_names = set(row.get(u'first name') for row in rows)
+        last_names = set(row.get(u'last name') for row in rows)
+
+        contacts = {}
+        for contact in Contact.objects.filter(
+            first_name__in=first_names,
+            last_name__in=last_names,
+            tenant_id=self.tenant_id,
+            is_deleted=False
+        ).prefetch_related('email_addresses', 'phone_numbers', 'functions__account'):
+            contact.import_email_addresses = set(email.email_address for email in contact.email_addresses.all())
+            contact.import_phone_numbers = set(phone.number for phone in contact.phone_numbers.all())
+            contact.import_account_names = set(function.account.name for function in contact.functions.all())
+            contacts.setdefault((contact.first_name, contact.last_name), []).append(contact)
+
+        return contacts
+
+    def find_contact(self, contacts, company_name, email_address, phone_number):
+        """
+        Regard as an existing contact when there is one with the given name in combination with the email address
+        and / or phone number (and the account if it already exists).
+        """
+        for contact in contacts:
+            if company_name and company_name not in contact.import_account_names:
+                continue
+
+            if email_address and phone_number:
+                if email_address in contact.import_email_addresses or phone_number in contact.import_phone_numbers:
+                    return contact
+            elif email_address:
+                if email_address in contact.import_email_addresses:
+                    return contact
+            elif phone_number:
+                if phone_number in contact.import_phone_numbers:
+                    return contact
+            else:
+                return contact
+
+        return None
+
+
+class AccountImporter(BaseImporter):
     # The following set of fields should be present as headers in the uploaded file.
     required_fields = {u'company name'}
     # The following set of fields are optional.
     optional_fields = {u'website', u'email address', u'phone number', u'twitter', u'address', u'postal code', u'city'}
 
-    # The following headers are present in the uploaded file.
-    available_in_upload = set(headers)
-
-    optional_in_upload = optional_fields & available_in_upload
-    extra_in_upload = available_in_upload - (required_fields | optional_fields)
-
-    company_name = row.get(u'company name')
+    def get_row_name(self, row):
+        return row.get(u'company name')
+
+    def import_rows(self, rows):
+        accounts = {}
+        for account in Account.objects.filter(
+            name__in=set(row.get(u'company name') for row in rows),
+            tenant_id=self.tenant_id
+        ).prefetch_related('email_addresses').order_by('pk'):
+            if account.name not in accounts:
+                account.import_email_addresses = set(email.email_address for email in account.email_addresses.all())
+                accounts[account.name] = account
+
+        imported_accounts = []
+        changed_accounts = {}
+        websites = []
+        relations = {
+            'email_addresses': [],
+            'phone_numbers': [],
+            'addresses': [],
+            'social_media': [],
+        }
+
+        for row in rows:
+            company_name = row.get(u'company name')
 
-    website = None
-    email_address = None
-    phone_number = None
-    twitter = None
-    address = None
-    try:
-        # Use atomic to rollback all intermediate database actions if an error occurs in just one of them.
-        with transaction.atomic():
-            description = ''
+            description = u''
             # All the extra fields that are present in the upload are placed in the description field.
-            for field in extra_in_upload:
-                description += '{0}: {1}\n'.format(field, row.get(field))
+            for field in self.extra_in_upload:
+                description += u'{0}: {1}\n'.format(field, row.get(field))
 
-            # Not using get_or_create() to make use of the skip_signal construction.
-            try:
-                account = Account.objects.get(name=company_name, tenant_id=tenant_id)
+            account = accounts.get(company_name)
+            if account:
                 if description:
-                    new_description = '{0}\n{1}'.format(account.description.strip(), description)
-                    account.description = new_description
-                    account.skip_signal = True
-                    account.save()
-            except Account.DoesNotExist:
-                account_status = AccountStatus.objects.get(name='Relation', tenant_id=tenant_id)
-                account = Account(
-                    name=company_name,
-                    tenant_id=tenant_id,
-                    status=account_status,
-                    description=description
-                )
-                account.skip_signal = True
-                account.save()
-
-            if u'website' in optional_in_upload and row.get(u'website'):
-                website = Website(
-                    website=row.get(u'website'),
-                    is_primary=True, account=account,
-                    tenant_id=tenant_id
-                )
-                website.skip_signal = True
-                website.save()
-
-            if u'email address' in optional_in_upload and row.get(u'email address'):
-                formatted_email_address = row.get(u'email address').lower()
-                if not account.email_addresses.filter(email_address=formatted_email_address).exists():
-                    email_address = EmailAddress(
-                        email_address=formatted_email_address,
-                        status=EmailAddress.PRIMARY_STATUS,
-                        tenant_id=tenant_id
-                    )
-                    email_address.skip_signal = True
-                    email_address.save()
-
-            if u'phone number' in optional_in_upload and row.get(u'phone number'):
-                formatted_phone_number = parse_phone_number(row.get(u'phone number'))
-                phone_number = PhoneNumber(
-                    number=formatted_phone_number,
-                    tenant_id=tenant_id
-                )
-                phone_number.skip_signal = True
-                phone_number.save()
-
-            if u'twitter' in optional_in_upload and row.get(u'twitter'):
-                twitter = SocialMedia(
-                    name='twitter',
-                    username=row.get(u'twitter'),
-                    profile_url='https://twitter.com/{0}'.format(row.get(u'twitter')),
-                    tenant_id=tenant_id
-                )
-                twitter.skip_signal = True
-                twitter.save()
-
-            # An Address consists of multiple, optional fields. So create or update the instance.
-            if u'address' in optional_in_upload and row.get(u'address'):
-                address = Address(
-                    address=row.get(u'address'),
-                    type='visiting',
-                    tenant_id=tenant_id
-                )
-                address.skip_signal = True
-                address.save()
-
-            if u'postal code' in optional_in_upload and row.get(u'postal code'):
-                if address:
-                    address.postal_code = row.get(u'postal code')
-                else:
-                    address = Address(
-                        postal_code=row.get(u'postal code'),
-                        type='visiting',
-                        tenant_id=tenant_id
-                    )
-                address.skip_signal = True
-                address.save()
-
-            if u'city' in optional_in_upload and row.get(u'city'):
-                if address:
-                    address.city = row.get(u'city')
-                else:
-                    address = Address(
-                        city=row.get(u'city'),
-                        type='visiting',
-                        tenant_id=tenant_id
-                    )
-                address.skip_signal = True
-                address.save()
-
-    except Exception as e:
-        # On an exception all database actions are rolled back. Because of the skip_signal=True no data is added to the
-        # search index.
-        logger.error(u'Import error {} for {}'.format(e, company_name))
-    else:
-        if website:
-            website.skip_signal = False
-            website.save()
-            account.websites.add(website)
-        if email_address:
-            email_address.skip_signal = False
-            email_address.save()
-            account.email_addresses.add(email_address)
-        if phone_number:
-            phone_number.skip_signal = False
-            phone_number.save()
-            account.phone_numbers.add(phone_number)
-        if twitter:
-            twitter.skip_signal = False
-            twitter.save()
-            account.social_media.add(twitter)
-        if address:
-            address.skip_signal = False
-            address.save()
-            account.addresses.add(address)
-
-        account.skip_signal = False
-        account.save()
+                    account.description = u'{0}\n{1}'.format(account.description.strip(), description)
+                    if account.pk:
+                        changed_accounts[account.pk] = account
+            else:
+                account = self.new_account(company_name, description)
+                account.import_email_addresses = set()
+                accounts[company_name] = account
+            imported_accounts.append(account)
+
+            website = self.get_value(row, u'website')
+            if website:
+                websites.append((account, website))
+
+            email_address = self.get_value(row, u'email address')
+            if email_address:
+                email_address = email_address.lower()
+                if email_address not in account.import_email_addresses:
+                    relations['email_addresses'].append((account, self.new_email_address(email_address)))
+                    account.import_email_addresses.add(email_address)
+
+            phone_number = self.get_value(row, u'phone number')
+            if phone_number:
+                relations['phone_numbers'].append((account, self.new_phone_number(parse_phone_number(phone_number))))
+
+            twitter = self.get_value(row, u'twitter')
+            if twitter:
+                relations['social_media'].append((account, self.new_social_media(
+                    'twitter', twitter, 'https://twitter.com/{0}'.format(twitter)
+                )))
+
+            address = self.new_address(row)
+            if address:
+                relations['addresses'].append((account, address))
+
+        for account in changed_accounts.values():
+            account.save()
+
+        self.save_new_objects()
+
+        Website.objects.bulk_create([Website(
+            website=clean_website(website_url),
+            is_primary=True,
+            account=website_account,
+            tenant_id=self.tenant_id
+        ) for website_account, website_url in websites])
+        for field_name, pairs in relations.items():
+            add_relations(Account, field_name, pairs)
+
+        account_mapping = ModelMappings.model_to_mappings[Account]
+        for account in imported_accounts:
+            enqueue_index(account_mapping, account.pk)
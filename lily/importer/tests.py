@@ -0,0 +1,73 @@
+import codecs
+from itertools import islice
+from StringIO import StringIO
+
+from django.test import TestCase
+
+from lily.accounts.factories import AccountStatusFactory
+from lily.accounts.models import Account
+from lily.contacts.models import Contact, Function
+from lily.importer.tasks import ContactImporter, CSVRowReader
+from lily.tenant.factories import TenantFactory
+
+
+class ImporterTests(TestCase):
+    def test_read_from_offset(self):
+        """
+        Test that reading the file can be continued from the offset after the last read row.
+        """
+        csv_file = StringIO('first name,last name\nJohn,Doe\n"Jane\nMary",Doe\n\nJack,Doe\n')
+
+        reader = CSVRowReader(csv_file)
+        rows = list(islice(reader, 2))
+
+        self.assertEqual(rows, [
+            {u'first name': u'John', u'last name': u'Doe'},
+            {u'first name': u'Jane\nMary', u'last name': u'Doe'},
+        ])
+
+        reader = CSVRowReader(csv_file, offset=reader.offset)
+
+        self.assertEqual(reader.headers, [u'first name', u'last name'])
+        self.assertEqual(list(reader), [{u'first name': u'Jack', u'last name': u'Doe'}])
+
+    def test_read_excel_export(self):
+        """
+        Test that tab separated files with a byte order mark and Windows-1252 characters can be read.
+        """
+        csv_file = StringIO(codecs.BOM_UTF8 + 'first name\tlast name\nJos\xe9\tDoe\nJohn\tD\xc3\xb6e\n')
+
+        reader = CSVRowReader(csv_file)
+
+        self.assertEqual(reader.headers, [u'first name', u'last name'])
+        self.assertEqual(list(reader), [
+            {u'first name': u'Jos\xe9', u'last name': u'Doe'},
+            {u'first name': u'John', u'last name': u'D\xf6e'},
+        ])
+        self.assertEqual(reader.offset, len(csv_file.getvalue()))
+
+    def test_import_contacts(self):
+        """
+        Test that rows of the same contact in one batch result in one contact, account and function.
+        """
+        tenant = TenantFactory.create()
+        AccountStatusFactory.create(tenant=tenant, name='Relation')
+
+        headers = [u'first name', u'last name', u'company name', u'email address', u'phone number']
+        rows = [
+            dict(zip(headers, [u'John', u'Doe', u'Acme', u'John@example.com', u''])),
+            dict(zip(headers, [u'John', u'Doe', u'Acme', u'john@example.com', u'0612345678'])),
+        ]
+
+        ContactImporter(tenant.id, headers).run(rows)
+
+        contact = Contact.objects.get(tenant=tenant)
+        account = Account.objects.get(tenant=tenant)
+
+        self.assertEqual(account.name, u'Acme')
+        self.assertEqual(
+            list(contact.email_addresses.values_list('email_address', flat=True)),
+            [u'john@example.com']
+        )
+        self.assertEqual(list(contact.phone_numbers.values_list('number', flat=True)), [u'+31612345678'])
+        self.assertEqual(Function.objects.filter(account=account, contact=contact).count(), 1)
@@ -2,7 +2,6 @@ import anyjson
 import datetime
 import logging
 import re
-import requests
 import time
 import urllib
 from hashlib import sha256
@@ -27,6 +26,7 @@ from lily.api.drf_extensions.authentication import PandaDocSignatureAuthenticati
 from lily.contacts.models import Contact
 from lily.deals.models import Deal, DealStatus, DealNextStep
 from lily.notes.models import Note
+from lily.utils import http
 from lily.utils.functions import send_get_request
 from lily.utils.models.models import EmailAddress
 from lily.utils.api.permissions import IsAccountAdmin, IsFeatureAvailable
@@ -555,7 +555,7 @@ class SlackEventCatch(APIView):
             model = matches.group(2)
             obj_id = matches.group(3)
 
-            content_type = ContentType.objects.get(app_label=app_label, model=model)
+            content_type = ContentType.objects.get_by_natural_key(app_label, model)
 
             try:
                 obj = content_type.get_object_for_this_type(pk=obj_id, tenant=details.tenant)
@@ -739,7 +739,7 @@ class SlackEventCatch(APIView):
                         'unfurls': unfurls,
                     }
 
-                    request = requests.post('https://slack.com/api/chat.unfurl?' + urllib.urlencode(data))
+                    http.request('post', 'https://slack.com/api/chat.unfurl?' + urllib.urlencode(data))
 
                     return Response(status=status.HTTP_200_OK)
 
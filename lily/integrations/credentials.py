@@ -1,10 +1,11 @@
 from datetime import timedelta
 
-import requests
 from django.utils import timezone
 from oauth2client.client import Credentials
 from oauth2client.contrib.django_orm import Storage
 
+from lily.utils import http
+
 from .models import IntegrationCredentials, IntegrationDetails, SlackDetails, IntegrationType
 
 
@@ -97,7 +98,8 @@ def get_access_token(credentials, integration_type, code=None):
         # Sometimes we pass just a string, so fetch the actual integration type.
         integration_type = IntegrationType.objects.get(name__iexact=integration_type)
 
-    response = requests.post(
+    response = http.request(
+        'post',
         url=integration_type.token_url,
         data=payload,
     )
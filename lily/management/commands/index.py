@@ -1,17 +1,121 @@
 import os
 import traceback
 import time
+from datetime import datetime, timedelta
+from multiprocessing import Pool
 
+import redis
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db import connection
+from django.db import connection, connections
+from django.db.models import Max, Min
+from django.utils import timezone
 
 from slacker import Slacker
 
 from lily.search.analyzers import get_analyzers
 from lily.search.connections_utils import get_es_client, get_index_name
-from lily.search.indexing import index_objects
+from lily.search.index_queue import get_index_queue
+from lily.search.indexing import get_changed_pks, index_objects, process_index_markers
 from lily.search.scan_search import ModelMappings
+from lily.utils import logutil
+from lily.utils.functions import chunks
+
+
+# Number of shards per worker, more shards than workers keeps all workers busy when the pks aren't evenly spread.
+SHARDS_PER_WORKER = 4
+
+# Changes are caught up from slightly before the watermark, so differences between server clocks don't matter.
+CATCH_UP_MARGIN = timedelta(minutes=1)
+
+# Catching up is repeated until at most this many changes are left before switching to the new index.
+CATCH_UP_THRESHOLD = 1000
+CATCH_UP_MAX_PASSES = 5
+
+# The Elasticsearch client of a worker process.
+worker_es = None
+
+
+def get_index_queryset(mapping):
+    """
+    Return the objects of the mapping that should be in the index.
+    """
+    model = mapping.get_model()
+
+    if mapping.has_deleted():
+        return model.objects.filter(is_deleted=False)
+    return model.objects.all()
+
+
+class IndexCheckpoints(object):
+    """
+    The last indexed pk per shard of an index that is being built, stored in Redis so an interrupted run can resume.
+
+    A shard is a pk range from start (exclusive) to end (inclusive), the shard is done when its checkpoint is the end.
+    """
+    key = 'search:index_checkpoints:%s'
+
+    def __init__(self, index):
+        self.client = redis.StrictRedis.from_url(settings.REDIS_URL)
+        self.key = self.key % index
+
+    def exists(self):
+        return bool(self.client.exists(self.key))
+
+    def create(self, shards):
+        self.client.hmset(self.key, {'%s-%s' % shard: shard[0] for shard in shards})
+
+    def get_shards(self):
+        """
+        Return the shards that aren't done as (start, end, last pk) tuples.
+        """
+        shards = []
+        for field, pk in self.client.hgetall(self.key).iteritems():
+            start, end = [int(boundary) for boundary in field.split('-')]
+            if int(pk) < end:
+                shards.append((start, end, int(pk)))
+        return sorted(shards)
+
+    def update(self, start, end, pk):
+        self.client.hset(self.key, '%s-%s' % (start, end), pk)
+
+    def delete(self):
+        self.client.delete(self.key)
+
+
+def init_worker():
+    """
+    Give the worker process its own Elasticsearch client, database connections are opened by the worker itself.
+    """
+    global worker_es
+    worker_es = get_es_client(maxsize=1)
+
+
+def index_shard(args):
+    """
+    Index the objects of one shard in a worker process, the checkpoint is updated after every bulk request.
+
+    Args:
+        args (tuple): mapping type name, base name of the index, start, end and last indexed pk of the shard
+
+    Returns:
+        tuple: the start and end of the shard
+    """
+    mapping_name, index_base, start, end, last_pk = args
+    mapping = ModelMappings.get_mapping_by_type_name(mapping_name)
+    checkpoints = IndexCheckpoints(get_index_name(index_base, mapping))
+
+    queryset = get_index_queryset(mapping).filter(pk__gt=last_pk, pk__lte=end)
+    index_objects(
+        mapping,
+        queryset,
+        index_base,
+        es_client=worker_es,
+        callback=lambda pk: checkpoints.update(start, end, pk)
+    )
+    checkpoints.update(start, end, end)
+
+    return start, end
 
 
 class Command(BaseCommand):
@@ -21,6 +125,12 @@ creating a new index, then changing the alias to point to the new index.
 
 It uses custom index implementation for fast and synchronous indexing.
 
+Objects that are changed or deleted while the new index is built are
+indexed again (using their modified field, the tombstones of deleted
+objects and the objects that were queued for indexing) before and right
+after changing the alias. Models without a modified field need Lily to be
+in maintenance mode, unless all their changes go through the index queue.
+
 There are basically two ways to use this command, the first to index all
 configured mappings:
 
@@ -33,7 +143,15 @@ The second way is to target a specific model:
     index -t contacts_contact
     index -t lily.contacts
 
-It is possible to specify multiple models, using comma separation."""
+It is possible to specify multiple models, using comma separation.
+
+Large indexes can be built by multiple processes, each model is split in
+shards by pk and every shard is indexed by one of the workers:
+
+    index -t email_emailmessage --workers 8
+
+The progress of every shard is saved, so an interrupted run can be
+continued by running the same command with --resume."""
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -61,10 +179,22 @@ It is possible to specify multiple models, using comma separation."""
             dest='force',
             help='Force the creation of the new index, removing the old one (leftovers).'
         )
+        parser.add_argument(
+            '-w', '--workers',
+            action='store',
+            dest='workers',
+            type=int,
+            default=0,
+            help='Index every model in shards using a pool of worker processes.'
+        )
+        parser.add_argument(
+            '-r', '--resume',
+            action='store_true',
+            dest='resume',
+            help='Continue an interrupted run with workers, using the leftover index and its checkpoints.'
+        )
 
     def handle(self, *args, **kwargs):
-        self.stdout.write('Please remember that Lily needs to be in maintenance mode. \n\n')
-
         try:
             self.handle_args(*args)
             self.handle_kwargs(**kwargs)
@@ -119,6 +249,14 @@ It is possible to specify multiple models, using comma separation."""
         # Validate the force kwarg.
         self.force = kwargs['force'] is True
 
+        # Validate the workers and resume kwargs.
+        self.workers = kwargs['workers']
+        self.resume = kwargs['resume'] is True
+        if self.workers < 0:
+            raise Exception('The number of workers should be positive.')
+        if self.resume and not self.workers:
+            raise Exception('Resuming is only possible with --workers.')
+
     def validate_targets(self, targets_to_check):
         """
         Validate every target that is passed to the command.
@@ -163,12 +301,16 @@ It is possible to specify multiple models, using comma separation."""
         """
         Do the actual indexing for all specified targets.
         """
+        queue = get_index_queue()
+
         for mapping in self.target_list:
             model_name = mapping.get_mapping_type_name()
             main_index_base = settings.ES_INDEXES['default']
             main_index = get_index_name(main_index_base, mapping)
 
             self.stdout.write('==> %s' % model_name)
+            if not mapping.has_modified():
+                self.stdout.write('Please remember that Lily needs to be in maintenance mode for %s.' % model_name)
 
             # Check if we currently have an index for this mapping.
             old_index = None
@@ -180,6 +322,7 @@ It is possible to specify multiple models, using comma separation."""
 
             # Check any indices with no alias (leftovers from failed indexing).
             # Or it could be that it is still in progress,
+            temp_index = None
             aliases = self.es.indices.get_aliases()
             for key, value in aliases.iteritems():
                 if not key.endswith(model_name):
@@ -189,31 +332,63 @@ It is possible to specify multiple models, using comma separation."""
                     # This is an auto created index. Will be removed at end of command.
                     continue
                 if not value['aliases']:
-                    if self.force:
+                    if self.resume and not temp_index and IndexCheckpoints(key).exists():
+                        self.stdout.write('Resuming leftover "%s"' % key)
+                        temp_index = key
+                    elif self.force:
                         self.stdout.write('Removing leftover "%s"' % key)
                         self.es.indices.delete(key)
+                        if self.workers:
+                            IndexCheckpoints(key).delete()
                     else:
                         raise Exception('Found leftover %s, proceed with -f to remove.'
                                         ' Make sure indexing this model is not already running!' % key)
 
-            # Create new index.
-            index_settings = {
-                'mappings': {
-                    model_name: mapping.get_mapping()
-                },
-                'settings': {
-                    'analysis': get_analyzers()['analysis'],
-                    'number_of_shards': 1,
+            # Keep the objects that are indexed in the current index from now on, to index them in the new one too.
+            queue.start_rebuild(model_name)
+
+            if temp_index:
+                temp_index_base = temp_index[:-len('.%s' % model_name)]
+            else:
+                # Create new index, without refreshing and replicas, because those only slow down the bulk load.
+                index_settings = {
+                    'mappings': {
+                        model_name: mapping.get_mapping()
+                    },
+                    'settings': {
+                        'analysis': get_analyzers()['analysis'],
+                        'number_of_shards': 1,
+                        'number_of_replicas': 0,
+                        'refresh_interval': -1,
+                    }
                 }
-            }
-            temp_index_base = 'index_%s' % (int(time.time()))
-            temp_index = get_index_name(temp_index_base, mapping)
+                temp_index_base = 'index_%s' % (int(time.time()))
+                temp_index = get_index_name(temp_index_base, mapping)
 
-            self.stdout.write('Creating new index "%s"' % temp_index)
-            self.es.indices.create(temp_index, body=index_settings)
+                self.stdout.write('Creating new index "%s"' % temp_index)
+                self.es.indices.create(temp_index, body=index_settings)
 
             # Index documents.
-            self.index_documents(mapping, temp_index_base)
+            if self.workers:
+                self.index_documents_in_shards(mapping, temp_index_base)
+            else:
+                self.index_documents(mapping, temp_index_base)
+
+            # The name of the index contains the time it was created, so a resumed run catches up from the same time.
+            since = timezone.make_aware(datetime.utcfromtimestamp(int(temp_index_base.split('_')[1])), timezone.utc)
+            for catch_up_pass in range(CATCH_UP_MAX_PASSES):
+                since, changes = self.catch_up(mapping, temp_index_base, since, queue)
+                if changes <= CATCH_UP_THRESHOLD:
+                    break
+
+            # Restore refreshing and replicas before the index is put to use.
+            self.es.indices.put_settings(index=temp_index, body={
+                'index': {
+                    'number_of_replicas': settings.ES_NUMBER_OF_REPLICAS,
+                    'refresh_interval': '1s',
+                }
+            })
+            self.es.indices.refresh(temp_index)
 
             # Switch aliases.
             if old_index:
@@ -240,6 +415,12 @@ It is possible to specify multiple models, using comma separation."""
                         {'add': {'index': temp_index, 'alias': main_index_base}},
                     ]
                 })
+            # Changes between the last catch up and switching the aliases were made in the previous index.
+            self.catch_up(mapping, temp_index_base, since, queue)
+            self.es.indices.refresh(temp_index)
+            queue.finish_rebuild(model_name)
+            if self.workers:
+                IndexCheckpoints(temp_index).delete()
             self.stdout.write('')
 
         self.stdout.write('Indexing finished.')
@@ -251,9 +432,75 @@ It is possible to specify multiple models, using comma separation."""
         model = mapping.get_model()
         self.stdout.write('Indexing {0}.{1}'.format(model.__module__, model.__name__).lower())
 
-        if mapping.has_deleted():
-            model_objs = model.objects.filter(is_deleted=False)
-        else:
-            model_objs = model.objects.all()
+        index_objects(mapping, get_index_queryset(mapping), temp_index_base, print_progress=True)
+
+    def catch_up(self, mapping, temp_index_base, since, queue):
+        """
+        Index the objects that were changed or deleted since the given time, or queued for indexing, again.
+
+        Returns:
+            tuple: the time to catch up from in the next pass and the number of changes
+        """
+        started = timezone.now()
+        pks = queue.pop_rebuild(mapping.get_mapping_type_name())
+        if mapping.has_modified():
+            pks |= get_changed_pks(mapping, since - CATCH_UP_MARGIN)
+        self.stdout.write('Catching up on %s changes' % len(pks))
+
+        for chunk in chunks(pks, 100):
+            process_index_markers(mapping, chunk, index=temp_index_base)
+
+        return started, len(pks)
+
+    def index_documents_in_shards(self, mapping, temp_index_base):
+        """
+        Index all non deleted objects by splitting them in shards by pk and indexing the shards in worker processes.
+        """
+        model = mapping.get_model()
+        self.stdout.write('Indexing {0}.{1} with {2} workers'.format(
+            model.__module__, model.__name__, self.workers
+        ).lower())
+
+        checkpoints = IndexCheckpoints(get_index_name(temp_index_base, mapping))
+        if not checkpoints.exists():
+            shards = self.get_shards(mapping)
+            if not shards:
+                return
+            checkpoints.create(shards)
+
+        shards = checkpoints.get_shards()
+        tasks = [(mapping.get_mapping_type_name(), temp_index_base, start, end, pk) for start, end, pk in shards]
+
+        # The workers can't share the connections of this process, so close them before the workers are forked.
+        connections.close_all()
+
+        pool = Pool(self.workers, initializer=init_worker)
+        try:
+            for progress, shard in enumerate(pool.imap_unordered(index_shard, tasks), 1):
+                logutil.print_progress(progress, len(tasks))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def get_shards(self, mapping):
+        """
+        Split the pk range of the objects in shards.
+
+        Returns:
+            list: tuples with the start (exclusive) and end (inclusive) pk of every shard
+        """
+        pks = get_index_queryset(mapping).aggregate(min=Min('pk'), max=Max('pk'))
+        if pks['min'] is None:
+            return []
+
+        start = pks['min'] - 1
+        size = max((pks['max'] - start) / (self.workers * SHARDS_PER_WORKER), 1)
+
+        shards = []
+        while start < pks['max']:
+            end = min(start + size, pks['max'])
+            shards.append((start, end))
+            start = end
 
-        index_objects(mapping, model_objs, temp_index_base, print_progress=True)
+        return shards
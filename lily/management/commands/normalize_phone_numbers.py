@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from lily.utils.functions import normalize_phone_number
+from lily.utils.models.models import PhoneNumber
+
+
+class Command(BaseCommand):
+    help = """Fill in the normalized version of every phone number, used to match incoming calls.
+
+Existing phone numbers are normalized by a migration. By default only phone numbers without a normalized version are
+processed, use --all to normalize every phone number again (e.g. after changing the normalization)."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-b', '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of phone numbers to update per transaction.'
+        )
+        parser.add_argument(
+            '-a', '--all',
+            action='store_true',
+            dest='all',
+            default=False,
+            help='Also normalize phone numbers that already have a normalized version.'
+        )
+
+    def handle(self, *args, **options):
+        queryset = PhoneNumber._base_manager.order_by('pk')
+        if not options['all']:
+            queryset = queryset.filter(normalized_number__isnull=True)
+
+        last_pk = 0
+        updated = 0
+        while True:
+            # Walk through the table by primary key, so every batch is a cheap index range scan.
+            batch = list(queryset.filter(pk__gt=last_pk).values_list('pk', 'number')[:options['batch_size']])
+            if not batch:
+                break
+
+            with transaction.atomic():
+                for pk, number in batch:
+                    PhoneNumber._base_manager.filter(pk=pk).update(normalized_number=normalize_phone_number(number))
+
+            last_pk = batch[-1][0]
+            updated += len(batch)
+            self.stdout.write('Normalized %s phone numbers.' % updated)
+
+        self.stdout.write('Done.')
@@ -1,6 +1,7 @@
 import analytics
 import logging
 import re
+from collections import OrderedDict
 
 from django.conf import settings
 from django.core.validators import RegexValidator
@@ -110,6 +111,25 @@ class EmailMessageSerializer(serializers.ModelSerializer):
     labels = EmailLabelSerializer(many=True, read_only=True)
     sent_date = serializers.ReadOnlyField()
 
+    # Fields that are visible for messages of email accounts which only share metadata.
+    metadata_fields = ('id', 'account', 'sender', 'received_by', 'received_by_cc', 'sent_date', )
+
+    def to_representation(self, instance):
+        """
+        Only serialize the metadata fields when the message is annotated as metadata only.
+        """
+        if getattr(instance, 'effective_privacy', None) != EmailAccount.METADATA:
+            return super(EmailMessageSerializer, self).to_representation(instance)
+
+        data = OrderedDict()
+        for field_name in self.metadata_fields:
+            field = self.fields.get(field_name)
+            if field:
+                attribute = field.get_attribute(instance)
+                data[field_name] = field.to_representation(attribute) if attribute is not None else None
+
+        return data
+
     class Meta:
         model = EmailMessage
         fields = (
@@ -2,6 +2,7 @@ import logging
 
 from ddtrace import tracer
 from django.conf import settings
+from django.db import transaction
 from django.db.models import Q
 from django_filters import rest_framework as filters
 import phonenumbers
@@ -10,6 +11,7 @@ from rest_framework import viewsets, mixins, status
 from rest_framework.filters import OrderingFilter
 from rest_framework.decorators import detail_route, list_route
 from rest_framework.exceptions import NotFound
+from rest_framework.fields import BooleanField
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.viewsets import GenericViewSet
@@ -31,7 +33,7 @@ from ..models.models import (EmailLabel, EmailAccount, EmailMessage, EmailTempla
                              SharedEmailConfig, TemplateVariable, EmailDraft)
 from ..tasks import (trash_email_message, toggle_read_email_message, add_and_remove_labels_for_message,
                      toggle_star_email_message, toggle_spam_email_message)
-from ..utils import get_filtered_message
+from ..utils import adjust_unread_counts, filter_email_messages_by_privacy, get_filtered_message
 
 
 logger = logging.getLogger(__name__)
@@ -182,23 +184,15 @@ class EmailMessageViewSet(mixins.RetrieveModelMixin,
         return email_message
 
     def get_queryset(self):
-        user = self.request.user
-        email_messages = EmailMessage.objects.filter(account__tenant=user.tenant)
-
-        # Get all email accounts.
-        email_accounts = EmailAccount.objects.filter(tenant=user.tenant, is_deleted=False).distinct('id')
-
-        filtered_queryset = []
-
-        for email_message in email_messages:
-            email_account = email_accounts.get(pk=email_message.account.id)
-
-            filtered_message = get_filtered_message(email_message, email_account, user)
-
-            if filtered_message:
-                filtered_queryset.append(filtered_message)
-
-        return filtered_queryset
+        return filter_email_messages_by_privacy(self.request.user).select_related(
+            'account',
+            'sender',
+        ).prefetch_related(
+            'labels',
+            'received_by',
+            'received_by_cc',
+            'attachments',
+        )
 
     def perform_update(self, serializer):
         """
@@ -207,9 +201,16 @@ class EmailMessageViewSet(mixins.RetrieveModelMixin,
         update database directly. Save will trigger an update of the search index.
         """
         email = self.get_object()
-        email.read = self.request.data['read']
+        read = BooleanField().to_internal_value(self.request.data['read'])
+
+        with transaction.atomic():
+            # Only the request that actually changes the read status adjusts the unread counters of the labels.
+            if EmailMessage.objects.filter(pk=email.pk).exclude(read=read).update(read=read):
+                adjust_unread_counts({label.pk: -1 if read else 1 for label in email.labels.all()})
+
+        email.read = read
         email.save()
-        toggle_read_email_message.apply_async(args=(email.id, self.request.data['read']))
+        toggle_read_email_message.apply_async(args=(email.id, read))
 
     def perform_destroy(self, instance):
         """
@@ -676,6 +677,7 @@ class SearchView(APIView):
                             connector = GmailConnector(email_account)
                             messages = connector.search(query=q, size=max_results)
                             messages_ids.extend([message['id'] for message in messages])
+                            connector.cleanup()
                         except (InvalidCredentialsError, NotFoundError, HttpAccessTokenRefreshError,
                                 FailedServiceCallException) as e:
                             logger.error(
@@ -1,8 +1,13 @@
 import gc
+import logging
+
 from django.db import IntegrityError
 
+from ..connector import LabelNotFoundError
 from ..models.models import EmailLabel
 
+logger = logging.getLogger(__name__)
+
 
 class LabelBuilder(object):
     """
@@ -54,3 +59,91 @@ class LabelBuilder(object):
         """
         self.manager = None
         self.label = None
+
+
+class LabelRegistry(object):
+    """
+    The EmailLabels of an email account by label_id.
+
+    The labels are loaded once per manager and labels missing in the database are retrieved once through the API, so
+    the labels of every message can be resolved without any queries.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self._labels = None
+        self._missing_label_ids = set()
+
+    @property
+    def labels(self):
+        if self._labels is None:
+            self._labels = {label.label_id: label for label in self.manager.email_account.labels.all()}
+        return self._labels
+
+    def __contains__(self, label_id):
+        return label_id in self.labels
+
+    def get(self, label_id):
+        """
+        Return the label, retrieving and storing it through the API when it's not in the database.
+
+        Args:
+            label_id (string): label_id of the label
+
+        Returns:
+            EmailLabel instance
+
+        Raises:
+            LabelNotFoundError: the label doesn't exist in Gmail either
+        """
+        label = self.labels.get(label_id)
+
+        if label is None:
+            if label_id in self._missing_label_ids:
+                raise LabelNotFoundError(label_id)
+
+            try:
+                label_info = self.manager.connector.get_label_info(label_id)
+            except LabelNotFoundError:
+                self._missing_label_ids.add(label_id)
+                raise
+
+            label = self.manager.label_builder.get_or_create_label(label_info)[0]
+            self.labels[label_id] = label
+
+        return label
+
+    def get_labels(self, label_ids):
+        """
+        Return the labels for the label_ids, skipping the labels that don't exist.
+
+        Args:
+            label_ids (iterable): label_ids of the labels
+
+        Returns:
+            list with EmailLabel instances
+        """
+        labels = []
+        for label_id in label_ids:
+            try:
+                labels.append(self.get(label_id))
+            except LabelNotFoundError:
+                logger.error('Label {} missing in db also not found via API for {}'.format(
+                    label_id,
+                    self.manager.email_account
+                ))
+        return labels
+
+    def invalidate(self):
+        """
+        Forget the loaded labels, so they are loaded from the database again when needed.
+        """
+        self._labels = None
+        self._missing_label_ids = set()
+
+    def cleanup(self):
+        """
+        Cleanup references, to prevent reference cycle
+        """
+        self.manager = None
+        self.invalidate()
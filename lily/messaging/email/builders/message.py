@@ -6,17 +6,47 @@ import re
 
 from dateutil.parser import parse
 from django.conf import settings
-from django.db import transaction
+from django.db import IntegrityError, transaction
 import pytz
 
-from lily.messaging.email.connector import LabelNotFoundError
-from lily.messaging.email.utils import determine_message_type
+from lily.messaging.email.utils import (
+    adjust_unread_counts, classify_threads, reindex_email_message, render_email_message_body
+)
+from lily.search.index_queue import deferred_indexing
 
 from ..models.models import EmailMessage, EmailHeader, Recipient, NoEmailMessageId
 from .utils import get_attachments_from_payload, get_body_html_from_payload, get_body_text_from_payload
 
 logger = logging.getLogger(__name__)
 
+# Labels that we won't use in Lily.
+IGNORED_LABEL_IDS = frozenset([
+    'CATEGORY_PROMOTIONS', 'IMPORTANT', 'CATEGORY_FORUMS', 'CHAT', 'CATEGORY_SOCIAL', 'CATEGORY_UPDATES',
+    'CATEGORY_PERSONAL',
+])
+
+
+def split_recipients(header_value):
+    """
+    Split a recipient header into name and email address pairs.
+
+    Args:
+        header_value (string): with value of header
+
+    Returns:
+        list of (name, email_address) tuples
+    """
+    # Selects all comma's with the following conditions:
+    # 1. Preceded by a TLD (with a max of 16 chars) or
+    # 2. Preceded by an angle bracket (>)
+    # Then swap out with regex group 1 + a semicolon (\1;)
+    # After that split by semicolon (;)
+    # Note: Basic tests have shown that char limit on the TLD can be increased without problems
+    # 16 chars seems to be enough for now though
+    recipients = re.sub(r'(\.[A-Z]{2,16}|>)(,)', r'\1;', header_value, flags=re.IGNORECASE).split('; ')
+
+    return [email.utils.parseaddr(recipient) for recipient in recipients]
+
 
 class MessageBuilderException(Exception):
     pass
@@ -34,11 +64,14 @@ class MessageBuilder(object):
         self.manager = manager
         self.message = None
         self.labels = []
+        self.was_read = None
         self.headers = []
         self.received_by = None
         self.received_by_cc = None
         self.attachments = []
+        self.payload_stored = False
         self.created = False
+        self.recipients = {}
 
     def get_or_create_message(self, message_dict):
         """
@@ -58,6 +91,7 @@ class MessageBuilder(object):
         self.received_by = set()
         self.received_by_cc = set()
         self.attachments = []
+        self.payload_stored = False
 
         # Prevent memory leaks.
         gc.collect()
@@ -69,11 +103,14 @@ class MessageBuilder(object):
                 message_id=message_dict['id'],
                 account=self.manager.email_account,
             )
+            # Remember the stored state, so the unread counters can be adjusted on save.
+            self.was_read = self.message.read
         except EmailMessage.DoesNotExist:
             self.message = EmailMessage(
                 message_id=message_dict['id'],
                 account=self.manager.email_account,
             )
+            self.was_read = None
             created = True
 
         if 'threadId' in message_dict:
@@ -92,7 +129,6 @@ class MessageBuilder(object):
         self.store_labels_and_thread_for_message(message_info, message_id)
         self.message.snippet = message_info['snippet']
         self._save_message_payload(message_info['payload'])
-        self._save_message_type()
 
     def store_labels_and_thread_for_message(self, message_info, message_id):
         """
@@ -105,8 +141,19 @@ class MessageBuilder(object):
         _, self.created = self.get_or_create_message({'id': message_id})
         self.message.thread_id = message_info['threadId']
 
-        # Set boolean identifier for some labels for faster filtering.
         labels = message_info.get('labelIds', [])
+        self._set_label_flags(labels)
+
+        # Get the available Label objects for the message from the database and the missing ones by the API.
+        self.labels = self._get_labels(labels)
+
+    def _set_label_flags(self, labels):
+        """
+        Set boolean identifier for some labels for faster filtering.
+
+        Args:
+            labels (list): label_ids of the message
+        """
         self.message.read = settings.GMAIL_LABEL_UNREAD not in labels
         self.message.is_inbox_message = settings.GMAIL_LABEL_INBOX in labels
         self.message.is_sent_message = settings.GMAIL_LABEL_SENT in labels
@@ -115,41 +162,18 @@ class MessageBuilder(object):
         self.message.is_spam_message = settings.GMAIL_LABEL_SPAM in labels
         self.message.is_starred_message = settings.GMAIL_LABEL_STAR in labels
 
-        # Get the available Label objects for the message from the database and the missing ones by the API.
-        # First, get all labels from the database.
-        db_labels = self.manager.email_account.labels.all()
-
-        message_label_set = set(label for label in labels)
-        # Remove labels the we won't use in Lily.
-        remove = {'CATEGORY_PROMOTIONS', 'IMPORTANT', 'CATEGORY_FORUMS', 'CHAT', 'CATEGORY_SOCIAL', 'CATEGORY_UPDATES',
-                  'CATEGORY_PERSONAL'}
-        message_label_set = message_label_set - remove
-        db_label_set = set(label.label_id for label in db_labels)
-
-        # Use set operations to get the available and missing labels.
-        # Labels that exist in Gmail for this message but are not in our db.
-        missing_label_ids = message_label_set - db_label_set
-        if missing_label_ids:
-            # Labels missing in our database should be retrieved by the API.
-            for label_id in missing_label_ids:
-                try:
-                    db_label = self.manager.get_label(label_id, use_db=False)
-                    self.labels.append(db_label)
-                except LabelNotFoundError:
-                    logger.error(
-                        'Label {} missing in db also not found via API for {}'.format(
-                            label_id,
-                            self.manager.email_account
-                        )
-                    )
+    def _get_labels(self, labels):
+        """
+        Return the EmailLabels for the given label_ids.
 
-        # Labels that exist both in Gmail and in our db. Those labels are already retrieved from the db above.
-        available_label_ids = message_label_set & db_label_set
-        if available_label_ids:
-            # Use dict comprehension to get a dictionary with the label_id as the keys and the label as the value.
-            db_label_dict = {label.label_id: label for label in db_labels}
-            for label_id in available_label_ids:
-                self.labels.append(db_label_dict[label_id])
+        Args:
+            labels (list): label_ids of the message
+
+        Returns:
+            list with EmailLabel instances
+        """
+        # Labels missing in our database are retrieved by the API once per manager.
+        return self.manager.label_registry.get_labels(set(labels) - IGNORED_LABEL_IDS)
 
     def _save_message_payload(self, payload):
         """
@@ -158,6 +182,8 @@ class MessageBuilder(object):
         Args:
             payload: dict with message payload
         """
+        self.payload_stored = True
+
         if 'headers' in payload:
             self._create_message_headers(payload['headers'])
 
@@ -214,24 +240,9 @@ class MessageBuilder(object):
         """
         header_name = header_name.lower()
 
-        # Selects all comma's with the following conditions:
-        # 1. Preceded by a TLD (with a max of 16 chars) or
-        # 2. Preceded by an angle bracket (>)
-        # Then swap out with regex group 1 + a semicolon (\1;)
-        # After that split by semicolon (;)
-        # Note: Basic tests have shown that char limit on the TLD can be increased without problems
-        # 16 chars seems to be enough for now though
-        recipients = re.sub(r'(\.[A-Z]{2,16}|>)(,)', r'\1;', header_value, flags=re.IGNORECASE).split('; ')
-
-        for recipient in recipients:
-            # Get or create recipient
-            email_address = email.utils.parseaddr(recipient)
-
-            if email_address[1] != '':
-                recipient = Recipient.objects.get_or_create(
-                    name=email_address[0],
-                    email_address=email_address[1],
-                )[0]
+        for name, email_address in split_recipients(header_value):
+            if email_address != '':
+                recipient = self._get_recipient(name, email_address)
 
                 # Set recipient to correct field
                 if header_name == 'from':
@@ -241,19 +252,17 @@ class MessageBuilder(object):
                 elif header_name == 'cc':
                     self.received_by_cc.add(recipient)
 
-    def _save_message_type(self):
-        if self.created:
-            # Only determine message_type at creation, no need to update the message type at label changes.
-            if self.message.sent_date and self.message.sender_id:
-                # Message is an email, not a chat.
-                message_type, message_type_to_id = determine_message_type(
-                    self.message.thread_id,
-                    self.message.sent_date,
-                    self.message.account.email_address
-                )
-                self.message.message_type = message_type
-                if message_type_to_id:
-                    self.message.message_type_to_id = message_type_to_id
+    def _get_recipient(self, name, email_address):
+        """
+        Return the Recipient, from the recipients resolved in bulk if available.
+        """
+        recipient = self.recipients.get((name, email_address))
+        if not recipient:
+            recipient = Recipient.objects.get_or_create(
+                name=name,
+                email_address=email_address,
+            )[0]
+        return recipient
 
     def save(self):
         # Only save if there is a sent date, otherwise it's a chat message.
@@ -265,9 +274,13 @@ class MessageBuilder(object):
             if self.attachments:
                 self.message.has_attachment = True
 
+            # The labels of which the message counted as unread before this save.
+            old_unread_label_ids = set()
             if not self.message.pk:
                 # Save before we can add many-to-many and foreign keys.
                 self.message.save()
+            elif self.was_read is False:
+                old_unread_label_ids = set(self.message.labels.values_list('pk', flat=True))
 
             # Save recipients.
             self.message.received_by.add(*self.received_by)
@@ -282,6 +295,11 @@ class MessageBuilder(object):
             elif self.message.labels:
                 self.message.labels.clear()
 
+            new_unread_label_ids = set() if self.message.read else set(label.pk for label in self.labels)
+            deltas = {label_id: -1 for label_id in old_unread_label_ids - new_unread_label_ids}
+            deltas.update({label_id: 1 for label_id in new_unread_label_ids - old_unread_label_ids})
+            adjust_unread_counts(deltas)
+
             # Save headers.
             if len(self.headers):
                 self.message.headers.all().delete()
@@ -292,8 +310,17 @@ class MessageBuilder(object):
                 self.message.attachments.all().delete()
                 self.message.attachments.add(bulk=False, *self.attachments)
 
+            if self.payload_stored:
+                # The inline images are linked by the primary keys of the attachments, so render after saving them.
+                # Only the labels changed otherwise, which leaves the rendered body as it is.
+                render_email_message_body(self.message, self.attachments)
+
             self.message.skip_signal = False  # Re-enable indexing of the email on the last save.
             self.message.save()
+
+            if self.created:
+                # Only (re)classify the thread when a message is added, label changes don't affect the message types.
+                classify_threads(self.manager.email_account, [self.message.thread_id])
         else:
             logger.warning('Downloaded a message other than an email.')
 
@@ -302,6 +329,172 @@ class MessageBuilder(object):
                 account=self.manager.email_account
             )
 
+    def store_and_save_messages(self, message_infos):
+        """
+        Create EmailMessages for multiple new messages in one transaction with a fixed number of queries.
+
+        Existing messages, labels and recipients are resolved with one query each. Messages, headers and the
+        many-to-many relations are inserted with bulk_create. Messages that already exist are updated one by one.
+
+        Args:
+            message_infos (dict): message info dicts by message_id
+        """
+        email_account = self.manager.email_account
+
+        existing_message_ids = set(EmailMessage.objects.filter(
+            account=email_account,
+            message_id__in=message_infos.keys(),
+        ).order_by().values_list('message_id', flat=True))
+
+        for message_id in existing_message_ids:
+            self.store_message_info(message_infos[message_id], message_id)
+            self.save()
+
+        message_infos = {
+            message_id: message_info for message_id, message_info in message_infos.iteritems()
+            if message_id not in existing_message_ids
+        }
+        if not message_infos:
+            return
+
+        with transaction.atomic():
+            self.recipients = self._get_or_create_recipients(message_infos.values())
+
+            messages = []
+            no_messages = []
+            for message_id, message_info in message_infos.iteritems():
+                self.message = EmailMessage(
+                    message_id=message_id,
+                    account=email_account,
+                    thread_id=message_info['threadId'],
+                    snippet=message_info['snippet'],
+                )
+                self.created = True
+                self.headers = []
+                self.received_by = set()
+                self.received_by_cc = set()
+
+                labels = message_info.get('labelIds', [])
+                self._set_label_flags(labels)
+                self.labels = self._get_labels(labels)
+
+                self._save_message_payload(message_info['payload'])
+
+                # Only save if there is a sent date, otherwise it's a chat message.
+                if self.message.sent_date and self.message.sender_id:
+                    self.message.has_attachment = bool(self.attachments)
+                    if not self.attachments:
+                        # Messages with attachments are rendered once the attachments are saved.
+                        render_email_message_body(self.message, [])
+                    messages.append((
+                        self.message, self.labels, self.received_by, self.received_by_cc, self.headers,
+                        self.attachments,
+                    ))
+                else:
+                    logger.warning('Downloaded a message other than an email.')
+                    no_messages.append(NoEmailMessageId(message_id=message_id, account=email_account))
+
+            # The primary keys are set on the instances, so the relations can be created afterwards.
+            EmailMessage.objects.bulk_create([message[0] for message in messages])
+
+            label_relations = []
+            received_by_relations = []
+            received_by_cc_relations = []
+            headers = []
+            unread_deltas = {}
+            for message, labels, received_by, received_by_cc, message_headers, attachments in messages:
+                label_relations += [
+                    EmailMessage.labels.through(emailmessage_id=message.pk, emaillabel_id=label.pk) for label in labels
+                ]
+                if not message.read:
+                    for label in labels:
+                        unread_deltas[label.pk] = unread_deltas.get(label.pk, 0) + 1
+                received_by_relations += [
+                    EmailMessage.received_by.through(emailmessage_id=message.pk, recipient_id=recipient.pk)
+                    for recipient in received_by
+                ]
+                received_by_cc_relations += [
+                    EmailMessage.received_by_cc.through(emailmessage_id=message.pk, recipient_id=recipient.pk)
+                    for recipient in received_by_cc
+                ]
+                for header in message_headers:
+                    header.message = message
+                    headers.append(header)
+
+                # Attachments are uploaded to the storage on save, so they can't be created in bulk.
+                for attachment in attachments:
+                    attachment.message = message
+                    attachment.save()
+
+                if attachments:
+                    render_email_message_body(message, attachments)
+                    EmailMessage.objects.filter(pk=message.pk).update(
+                        rendered_body_html=message.rendered_body_html,
+                        rendered_body_version=message.rendered_body_version,
+                    )
+
+            EmailMessage.labels.through.objects.bulk_create(label_relations)
+            adjust_unread_counts(unread_deltas)
+            EmailMessage.received_by.through.objects.bulk_create(received_by_relations)
+            EmailMessage.received_by_cc.through.objects.bulk_create(received_by_cc_relations)
+            EmailHeader.objects.bulk_create(headers)
+            NoEmailMessageId.objects.bulk_create(no_messages)
+
+            classify_threads(email_account, set(message[0].thread_id for message in messages))
+
+        # Bulk creation doesn't send the post_save signal, so queue the messages for indexing explicitly.
+        with deferred_indexing():
+            for message in messages:
+                reindex_email_message(message[0])
+
+        self.recipients = {}
+
+    def _get_or_create_recipients(self, message_infos):
+        """
+        Return the Recipients of all given messages, creating the missing ones in bulk.
+
+        Args:
+            message_infos (list): message info dicts
+
+        Returns:
+            dict with Recipient instances by (name, email_address)
+        """
+        keys = set()
+        for message_info in message_infos:
+            for header in message_info['payload'].get('headers', []):
+                if header['name'].lower() in ['to', 'from', 'cc', 'delivered-to']:
+                    keys.update(
+                        (name, email_address) for name, email_address in split_recipients(header['value'])
+                        if email_address != ''
+                    )
+
+        recipients = {
+            (recipient.name, recipient.email_address): recipient for recipient in Recipient.objects.filter(
+                email_address__in=set(email_address for name, email_address in keys)
+            )
+        }
+
+        missing_recipients = [
+            Recipient(name=name, email_address=email_address) for name, email_address in keys
+            if (name, email_address) not in recipients
+        ]
+        if missing_recipients:
+            try:
+                with transaction.atomic():
+                    Recipient.objects.bulk_create(missing_recipients)
+            except IntegrityError:
+                # Created in the meantime by another process, fall back to one by one.
+                missing_recipients = [
+                    Recipient.objects.get_or_create(name=recipient.name, email_address=recipient.email_address)[0]
+                    for recipient in missing_recipients
+                ]
+
+            recipients.update({
+                (recipient.name, recipient.email_address): recipient for recipient in missing_recipients
+            })
+
+        return recipients
+
     def cleanup(self):
         """
         Cleanup references, to prevent reference cycle
@@ -309,6 +502,7 @@ class MessageBuilder(object):
         self.manager = None
         self.message = None
         self.labels = []
+        self.was_read = None
         self.headers = []
         self.received_by = None
         self.received_by_cc = None
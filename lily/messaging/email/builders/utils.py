@@ -3,6 +3,7 @@ import re
 import logging
 import StringIO
 
+from django.conf import settings
 from django.core.files import File
 from bs4 import BeautifulSoup, UnicodeDammit
 from lily.messaging.email.utils import get_extensions_for_type
@@ -29,7 +30,7 @@ NON_ATTACHMENT_MIME_TYPES = (
 )
 
 
-def get_attachments_from_payload(payload, body_html, message_id, connector):
+def get_attachments_from_payload(payload, body_html, message_id, connector, lazy=None):
     """
     Appends to the given attachments the attachments that are created by extracting information from the payload.
 
@@ -38,19 +39,24 @@ def get_attachments_from_payload(payload, body_html, message_id, connector):
         body_html (string): body that could contain references to attachments
         message_id (string): containing a reference to the message stored on Gmail
         connector (GmailConnector): active connector to communicate with Gmail
+        lazy (bool, optional): don't download attachments stored separately on Gmail, defaults to the
+            EMAIL_ATTACHMENTS_LAZY setting
 
     Returns:
         attachments (list): list of attachment
     """
+    if lazy is None:
+        lazy = settings.EMAIL_ATTACHMENTS_LAZY
+
     attachments = []
     if 'parts' in payload:
         for part in payload['parts']:
-            attachments += get_attachments_from_payload(part, body_html, message_id, connector)
+            attachments += get_attachments_from_payload(part, body_html, message_id, connector, lazy)
 
     if payload['mimeType'] in NON_ATTACHMENT_MIME_TYPES:
         return attachments
 
-    attachment = create_attachment(payload, body_html, message_id, attachments, connector)
+    attachment = create_attachment(payload, body_html, message_id, attachments, connector, lazy)
     if not attachment:
         return attachments
 
@@ -65,7 +71,7 @@ def get_attachments_from_payload(payload, body_html, message_id, connector):
     return attachments
 
 
-def create_attachment(part, body_html, message_id, attachments, connector):
+def create_attachment(part, body_html, message_id, attachments, connector, lazy=False):
     """
     Create and add attachment to the given attachments for the given part.
 
@@ -75,6 +81,8 @@ def create_attachment(part, body_html, message_id, attachments, connector):
         message_id (string): containing a reference to the message stored on Gmail
         attachments (list): list of attachments previously created for naming purposes
         connector (GmailConnector): active connector to communicate with Gmail
+        lazy (bool, optional): only store the Gmail attachment id of attachments that aren't part of the payload, so
+            they are downloaded on first use
 
     Returns:
         attachment (EmailAttachment)
@@ -105,6 +113,41 @@ def create_attachment(part, body_html, message_id, attachments, connector):
             # Look if the cid is in the body html.
             inline = re.search("cid:{0}".format(cid), body) is not None
 
+    if headers and 'content-type' in headers:
+        content_type = headers['content-type'].split(';')[0]
+    else:
+        content_type = 'application/octet-stream'
+
+    name = part.get('filename', '').rsplit('\\')[-1]
+    if len(name) > 200:
+        name = None
+
+    # No filename in part, create a name.
+    if not name:
+        extensions = get_extensions_for_type(content_type)
+        if part.get('partId'):
+            name = 'attachment-%s%s' % (part.get('partId'), extensions.next())
+        else:
+            logger.warning('No part id, no filename')
+            name = 'attachment-{}-0'.format(len(attachments), extensions.next())
+
+    # Create a EmailAttachment object.
+    attachment = EmailAttachment()
+    attachment.content_type = content_type
+    attachment.inline = inline
+    attachment.tenant_id = connector.email_account.tenant_id
+
+    # Check if inline attachment.
+    if inline:
+        attachment.cid = headers.get('content-id')
+
+    if lazy and 'data' not in part['body'] and 'attachmentId' in part['body']:
+        # Only remember where to find the attachment, it's downloaded when it's used for the first time.
+        attachment.gmail_attachment_id = part['body']['attachmentId']
+        attachment.filename = name
+        attachment.size = part['body'].get('size', 0)
+        return attachment
+
     # Get file data from part or from remote.
     if 'data' in part['body']:
         file_data = part['body']['data']
@@ -123,35 +166,12 @@ def create_attachment(part, body_html, message_id, attachments, connector):
 
     # Create as string file.
     file = StringIO.StringIO(file_data)
-    if headers and 'content-type' in headers:
-        file.content_type = headers['content-type'].split(';')[0]
-    else:
-        file.content_type = 'application/octet-stream'
-
+    file.content_type = content_type
     file.size = len(file_data)
-    file.name = part.get('filename', '').rsplit('\\')[-1]
-    if len(file.name) > 200:
-        file.name = None
-
-    # No filename in part, create a name.
-    if not file.name:
-        extensions = get_extensions_for_type(file.content_type)
-        if part.get('partId'):
-            file.name = 'attachment-%s%s' % (part.get('partId'), extensions.next())
-        else:
-            logger.warning('No part id, no filename')
-            file.name = 'attachment-{}-0'.format(len(attachments), extensions.next())
+    file.name = name
 
-    # Create a EmailAttachment object.
-    attachment = EmailAttachment()
     attachment.attachment = File(file, file.name)
     attachment.size = file.size
-    attachment.inline = inline
-    attachment.tenant_id = connector.email_account.tenant_id
-
-    # Check if inline attachment.
-    if inline:
-        attachment.cid = headers.get('content-id')
 
     return attachment
 
@@ -1,4 +1,5 @@
 import logging
+import os
 import random
 import time
 import anyjson
@@ -10,8 +11,10 @@ from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseUpload
 from oauth2client.client import HttpAccessTokenRefreshError
 
+from lily.utils.functions import chunks
+
 from .credentials import get_credentials, InvalidCredentialsError
-from .services import GmailService
+from .services import gmail_service_pool
 
 logger = logging.getLogger(__name__)
 
@@ -44,22 +47,59 @@ class MailNotEnabledError(ConnectorError):
     pass
 
 
+def is_transient_error(error):
+    """
+    Return whether the request that failed with the given error can succeed when it's tried again.
+
+    Args:
+        error (Exception): the error of the failed request
+
+    Returns:
+        bool: True for rate limiting and server errors
+    """
+    if not isinstance(error, HttpError):
+        return False
+
+    if error.resp.status in (429, 500, 502, 503):
+        return True
+
+    if error.resp.status == 403:
+        try:
+            content = anyjson.loads(error.content)
+        except ValueError:
+            return False
+        errors = content.get('error', content).get('errors') or [{}]
+        return errors[0].get('reason') in ['rateLimitExceeded', 'userRateLimitExceeded']
+
+    return False
+
+
 class GmailConnector(object):
     gmail_service = None
 
-    def __init__(self, email_account):
+    def __init__(self, email_account, retry=True):
+        """
+        Args:
+            email_account (instance): EmailAccount instance
+            retry (bool, optional): retry calls that fail on a transient error, callers that can't wait for the backoff
+                (like web requests) turn this off so the call fails right away instead
+        """
         self.email_account = email_account
         self.history_id = self.email_account.history_id
+        self.retry = retry
 
         try:
-            credentials = get_credentials(self.email_account)
+            credentials = get_credentials(self.email_account, cached=True)
         except InvalidCredentialsError:
             logger.exception('cannot sync account, no valid credentials')
             raise
         else:
-            self.gmail_service = GmailService(credentials)
+            self.gmail_service = gmail_service_pool.acquire(self.email_account.pk, credentials)
 
     def backoff(self, msg, attempt):
+        if not self.retry:
+            raise FailedServiceCallException('Service call failed on a transient error, not retrying')
+
         if not settings.TESTING:  # Disable sleeping while running tests.
             sleep_time = (2 ** attempt) + random.randint(0, 1000) / 1000
 
@@ -67,20 +107,22 @@ class GmailConnector(object):
 
             time.sleep(sleep_time)
 
-    def execute_service_call(self, service):
+    def execute_service_call(self, service, num_retries=0):
         """
         Try to execute a service call.
 
-        If the call fails because the rate limit is exceeded, sleep x seconds to try again.
+        If the call fails because the rate limit is exceeded, sleep x seconds to try again. Resumable uploads continue
+        where they left off when they're tried again.
 
         Args:
             service (instance): service instance
+            num_retries (int, optional): number of times the client retries requests that fail on a transient error
         Returns
             response from service instance
         """
         for n in range(0, 6):
             try:
-                return self.gmail_service.execute_service(service)
+                return self.gmail_service.execute_service(service, num_retries=num_retries)
             except HttpError as error:
                 if error.resp.status == 502:
                     # Apply exponential backoff.
@@ -228,6 +270,35 @@ class GmailConnector(object):
 
         return messages
 
+    def get_message_ids_for_label(self, label_id):
+        """
+        Fetch the ids of all messages with the given label from the gmail api.
+
+        Args:
+            label_id (string): id of the label
+
+        Returns:
+            set with messageIds
+        """
+        message_ids = set()
+        page_token = None
+
+        while True:
+            response = self.execute_service_call(self.gmail_service.service.users().messages().list(
+                userId='me',
+                quotaUser=self.email_account.id,
+                labelIds=[label_id],
+                includeSpamTrash=True,
+                maxResults=settings.GMAIL_LABEL_LIST_PAGE_SIZE,
+                fields='messages/id,nextPageToken',
+                pageToken=page_token,
+            ))
+            message_ids.update(message['id'] for message in response.get('messages', []))
+
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return message_ids
+
     def get_message_info(self, message_id):
         """
         Fetch message information given message_id.
@@ -246,6 +317,62 @@ class GmailConnector(object):
 
         return response
 
+    def get_message_info_batch(self, message_ids):
+        """
+        Fetch message information for multiple messages with the batch endpoint.
+
+        Requests that failed because of rate limiting or server errors are retried with exponential backoff. Messages
+        that could still not be fetched after all retries, or that failed on another error, are fetched one by one.
+
+        Args:
+            message_ids (list): ids of the messages
+
+        Returns:
+            dict with the message id as key and the message info as value, messages deleted from remote are omitted
+        """
+        messages = {}
+        pending = list(message_ids)
+        # Messages that failed on an error that won't go away by retrying the batch.
+        rejected = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                messages[request_id] = response
+            elif isinstance(exception, HttpError) and exception.resp.status == 404:
+                logger.debug('Message %s already deleted from remote' % request_id)
+            elif is_transient_error(exception):
+                failed.append(request_id)
+            else:
+                rejected.append(request_id)
+
+        for n in range(0, 6):
+            failed = []
+            for chunk in chunks(pending, settings.GMAIL_BATCH_REQUEST_SIZE):
+                batch = self.gmail_service.service.new_batch_http_request(callback=callback)
+                for message_id in chunk:
+                    batch.add(self.gmail_service.service.users().messages().get(
+                        userId='me',
+                        id=message_id,
+                        quotaUser=self.email_account.id,
+                    ), request_id=message_id)
+
+                self.gmail_service.execute_service(batch)
+
+            pending = failed
+            if not pending:
+                break
+
+            self.backoff(msg='Batch request partially failed, sleeping for %s seconds', attempt=n)
+
+        # Let the regular error handling deal with the messages that keep failing.
+        for message_id in rejected + pending:
+            try:
+                messages[message_id] = self.get_message_info(message_id)
+            except NotFoundError:
+                logger.debug('Message %s already deleted from remote' % message_id)
+
+        return messages
+
     def get_label_list(self):
         """
         Fetch all labels from the email account.
@@ -350,17 +477,33 @@ class GmailConnector(object):
             ))
         return response
 
-    def send_email_message(self, message_string, thread_id=None):
-        # Possible TODO: only use MediaIOBaseUpload on large email bodys instead of always:
-        # http://stackoverflow.com/questions/27875858/#33155212
-        fd = StringIO(message_string)
-        media = MediaIoBaseUpload(
-            fd,
+    def get_message_upload(self, message):
+        """
+        Return the upload of a message, which is sent in resumable chunks when the message is large.
+
+        Args:
+            message (string or file): the message as a string or a file positioned at the start
+
+        Returns:
+            MediaIoBaseUpload
+        """
+        if isinstance(message, basestring):
+            message = StringIO(message)
+
+        message.seek(0, os.SEEK_END)
+        size = message.tell()
+        message.seek(0)
+
+        return MediaIoBaseUpload(
+            message,
             mimetype='message/rfc822',
             chunksize=settings.GMAIL_CHUNK_SIZE,
-            resumable=settings.GMAIL_UPLOAD_RESUMABLE
+            resumable=size > settings.GMAIL_RESUMABLE_UPLOAD_THRESHOLD
         )
 
+    def send_email_message(self, message, thread_id=None):
+        media = self.get_message_upload(message)
+
         message_dict = {}
         if thread_id:
             message_dict.update({'threadId': thread_id})
@@ -371,39 +514,27 @@ class GmailConnector(object):
                 body=message_dict,
                 media_body=media,
                 quotaUser=self.email_account.id,
-            ))
+            ),
+            num_retries=settings.GMAIL_UPLOAD_RETRIES,
+        )
 
         return response
 
-    def create_draft_email_message(self, message_string):
-        # Possible TODO: only use MediaIOBaseUpload on large email bodys instead of always:
-        # http://stackoverflow.com/questions/27875858/#33155212
-        fd = StringIO(message_string)
-        media = MediaIoBaseUpload(
-            fd,
-            mimetype='message/rfc822',
-            chunksize=settings.GMAIL_CHUNK_SIZE,
-            resumable=settings.GMAIL_UPLOAD_RESUMABLE
-        )
+    def create_draft_email_message(self, message):
+        media = self.get_message_upload(message)
 
         response = self.execute_service_call(
             self.gmail_service.service.users().drafts().create(
                 userId='me',
                 media_body=media,
                 quotaUser=self.email_account.id,
-            ))
+            ),
+            num_retries=settings.GMAIL_UPLOAD_RETRIES,
+        )
         return response
 
-    def update_draft_email_message(self, message_string, draft_id):
-        # Possible TODO: only use MediaIOBaseUpload on large email bodys instead of always:
-        # http://stackoverflow.com/questions/27875858/#33155212
-        fd = StringIO(message_string)
-        media = MediaIoBaseUpload(
-            fd,
-            mimetype='message/rfc822',
-            chunksize=settings.GMAIL_CHUNK_SIZE,
-            resumable=settings.GMAIL_UPLOAD_RESUMABLE
-        )
+    def update_draft_email_message(self, message, draft_id):
+        media = self.get_message_upload(message)
 
         response = self.execute_service_call(
             self.gmail_service.service.users().drafts().update(
@@ -411,7 +542,9 @@ class GmailConnector(object):
                 media_body=media,
                 id=draft_id,
                 quotaUser=self.email_account.id,
-            ))
+            ),
+            num_retries=settings.GMAIL_UPLOAD_RETRIES,
+        )
         return response
 
     def delete_draft_email_message(self, message_id):
@@ -460,8 +593,10 @@ class GmailConnector(object):
 
     def cleanup(self):
         """
-        Cleanup references, to prevent reference cycle.
+        Return the service to the pool and cleanup references, to prevent reference cycle.
         """
+        if self.gmail_service is not None:
+            gmail_service_pool.release(self.email_account.pk, self.gmail_service)
         self.gmail_service = None
         self.email_account = None
         self.history_id = None
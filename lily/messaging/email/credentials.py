@@ -1,17 +1,44 @@
 import logging
+from datetime import datetime, timedelta
+
+from django.conf import settings
 from oauth2client.contrib.django_orm import Storage
 
+from lily.utils.cache import LRUCache
+
 from .models.models import GmailCredentialsModel
 
 
 logger = logging.getLogger(__name__)
 
+credentials_cache = LRUCache(
+    size=settings.GMAIL_CREDENTIALS_CACHE_SIZE,
+    timeout=settings.GMAIL_CREDENTIALS_CACHE_TIMEOUT,
+)
+
 
 class InvalidCredentialsError(Exception):
     pass
 
 
-def get_credentials(gmail_account):
+def is_fresh(credentials):
+    """
+    Return whether the access token of the credentials is valid for a while.
+
+    Arguments:
+        credentials (instance): OAuth2Credentials instance
+
+    Returns:
+        bool: True if the token doesn't expire within the configured margin
+    """
+    if credentials.invalid or credentials.token_expiry is None:
+        return False
+
+    margin = timedelta(seconds=settings.GMAIL_CREDENTIALS_EXPIRY_MARGIN)
+    return credentials.token_expiry - datetime.utcnow() > margin
+
+
+def get_credentials(gmail_account, cached=False):
     """
     Get the credentials for the given EmailAccount, what should be a Gmail account.
 
@@ -20,6 +47,8 @@ def get_credentials(gmail_account):
 
     Arguments:
         gmail_account (instance): EmailAccount instance
+        cached (bool, optional): reuse the credentials of the worker until the access token is about to expire,
+            instead of loading them from the database
 
     Returns:
         credentials for the EmailAccount
@@ -28,12 +57,20 @@ def get_credentials(gmail_account):
         InvalidCredentialsError, if there are no valid credentials for the account.
 
     """
+    if cached:
+        credentials = credentials_cache.get(gmail_account.pk)
+        if credentials is not None and is_fresh(credentials):
+            return credentials
+
     storage = Storage(GmailCredentialsModel, 'id', gmail_account, 'credentials')
     credentials = storage.get()
 
     if credentials is not None and credentials.invalid is False:
+        if cached:
+            credentials_cache.set(gmail_account.pk, credentials)
         return credentials
     else:
+        credentials_cache.delete(gmail_account.pk)
         gmail_account.is_authorized = False
         gmail_account.save()
         logger.error('No or invalid credentials for account %s' % gmail_account)
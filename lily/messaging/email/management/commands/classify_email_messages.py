@@ -0,0 +1,29 @@
+from django.core.management import BaseCommand
+
+from ...utils import classify_unclassified_threads
+
+
+class Command(BaseCommand):
+    help = """Determine the message type of every email message without one, classifying whole threads at a time.
+
+This is the fast alternative to the migrate_email_messages task, which spreads the work over time."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-b', '--batch-size',
+            type=int,
+            default=10000,
+            help='Number of unclassified messages to look up the threads of per batch.'
+        )
+
+    def handle(self, *args, **options):
+        classified = 0
+        while True:
+            found = classify_unclassified_threads(options['batch_size'])
+            if not found:
+                break
+
+            classified += found
+            self.stdout.write('Classified the threads of %s messages.' % classified)
+
+        self.stdout.write('Done.')
@@ -2,14 +2,19 @@ import logging
 import gc
 
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, CharField, Value, When
 from googleapiclient.errors import HttpError
 
 from lily.celery import app
-from .builders.label import LabelBuilder
-from .builders.message import MessageBuilder
+from lily.utils.functions import chunks
+from .builders.label import LabelBuilder, LabelRegistry
+from .builders.message import IGNORED_LABEL_IDS, MessageBuilder
 from .connector import GmailConnector, NotFoundError, LabelNotFoundError, MailNotEnabledError
 from .credentials import InvalidCredentialsError
+from .mime import spool_email_message
 from .models.models import EmailLabel, EmailMessage, NoEmailMessageId
+from .utils import adjust_unread_counts, delete_email_messages, reconcile_unread_counts, reindex_email_messages
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +28,7 @@ class GmailManager(object):
         email_account: EmailAccount instance
         message_builder: MessageBuilder instance
         label_builder: LabelBuilder instance
+        label_registry: LabelRegistry instance
     """
     def __init__(self, email_account):
         """
@@ -38,6 +44,7 @@ class GmailManager(object):
         else:
             self.message_builder = MessageBuilder(self)
             self.label_builder = LabelBuilder(self)
+            self.label_registry = LabelRegistry(self)
 
     def full_synchronize(self):
         message_ids = self.connector.get_all_message_id_list()
@@ -57,6 +64,8 @@ class GmailManager(object):
         )
 
         # What do we need to do with every email message?
+        new_message_ids = []
+        existing_thread_ids = {}
         for i, message_dict in enumerate(message_ids):
             logger.debug('Check for existing messages, %s/%s' % (i, len(message_ids)))
             if message_dict['id'] in no_message_ids_in_db:
@@ -64,11 +73,10 @@ class GmailManager(object):
                 pass
             elif message_dict['id'] not in message_ids_in_db:
                 # Message is new.
-                app.send_task(
-                    'download_email_message',
-                    args=[self.email_account.id, message_dict['id']],
-                    queue='email_first_sync'
-                )
+                new_message_ids.append(message_dict['id'])
+            elif settings.GMAIL_FULL_SYNC_RECONCILE_LABELS:
+                # We only need to update the labels for this message, which is done for all of them at once.
+                existing_thread_ids[message_dict['id']] = message_dict['threadId']
             else:
                 # We only need to update the labels for this message.
                 app.send_task(
@@ -77,6 +85,22 @@ class GmailManager(object):
                     queue='email_first_sync'
                 )
 
+        # Download the new messages in batches instead of one task per message.
+        for message_id_batch in chunks(new_message_ids, settings.GMAIL_FULL_MESSAGE_BATCH_SIZE):
+            app.send_task(
+                'download_email_messages',
+                args=[self.email_account.id, message_id_batch],
+                queue='email_first_sync'
+            )
+
+        if existing_thread_ids:
+            # Update the labels of the existing messages in a separate task, so a failure doesn't abort the full sync.
+            app.send_task(
+                'reconcile_email_labels',
+                args=[self.email_account.id, existing_thread_ids],
+                queue='email_first_sync'
+            )
+
         # Finally, add a task to keep track when the sync queue is finished.
         app.send_task(
             'full_sync_finished',
@@ -87,6 +111,172 @@ class GmailManager(object):
         self.connector.save_history_id()
         logger.debug('Finished queuing up tasks for email sync, storing history id for %s' % self.email_account)
 
+    def reconcile_labels(self, thread_ids):
+        """
+        Update the labels, label flags and thread of the existing email messages to the state in Gmail.
+
+        Instead of fetching the labels of every message, the messages of every label are listed and compared with the
+        database in bulk. The number of API calls depends on the number of labels instead of the number of messages.
+
+        Args:
+            thread_ids (dict): threadIds of the email messages to update by message_id
+        """
+        flag_labels = (
+            ('is_inbox_message', settings.GMAIL_LABEL_INBOX),
+            ('is_sent_message', settings.GMAIL_LABEL_SENT),
+            ('is_draft_message', settings.GMAIL_LABEL_DRAFT),
+            ('is_trashed_message', settings.GMAIL_LABEL_TRASH),
+            ('is_spam_message', settings.GMAIL_LABEL_SPAM),
+            ('is_starred_message', settings.GMAIL_LABEL_STAR),
+        )
+        flag_fields = ['read'] + [field for field, _ in flag_labels]
+
+        # Fields of the email messages by message_id.
+        email_messages = {}
+        for values in EmailMessage.objects.filter(account=self.email_account).order_by().values_list(
+                'pk', 'message_id', 'thread_id', *flag_fields):
+            if values[1] in thread_ids:
+                email_messages[values[1]] = values
+
+        if not email_messages:
+            return
+
+        db_labels = self.label_registry.labels
+        label_ids = (set(db_labels) - IGNORED_LABEL_IDS) | set(label_id for _, label_id in flag_labels)
+        label_ids.add(settings.GMAIL_LABEL_UNREAD)
+
+        # Message ids of the email messages by label_id.
+        message_ids = set(email_messages)
+        label_message_ids = {}
+        for label_id in label_ids:
+            logger.debug('Listing messages of label %s, account %s' % (label_id, self.email_account))
+            try:
+                label_message_ids[label_id] = self.connector.get_message_ids_for_label(label_id) & message_ids
+            except (NotFoundError, LabelNotFoundError):
+                # The label was removed in the meantime, messages keep what they have for this label.
+                logger.warning('Skipping label %s, it no longer exists for %s' % (label_id, self.email_account))
+
+        def has_label(message_id, label_id, current):
+            if label_id in label_message_ids:
+                return message_id in label_message_ids[label_id]
+            return current
+
+        changed_pks = set()
+
+        # The threads of the email messages.
+        thread_changes = {
+            values[0]: thread_ids[message_id]
+            for message_id, values in email_messages.items() if values[2] != thread_ids[message_id]
+        }
+        for batch in chunks(thread_changes.items(), settings.GMAIL_LABEL_UPDATE_BATCH_SIZE):
+            EmailMessage.objects.filter(pk__in=[pk for pk, _ in batch]).update(
+                thread_id=Case(
+                    *[When(pk=pk, then=Value(thread_id)) for pk, thread_id in batch],
+                    output_field=CharField()
+                ),
+            )
+        changed_pks.update(thread_changes)
+
+        # The label flags, grouped by the new combination of flags so every combination is one update.
+        read_changes = {}
+        flag_changes = {}
+        for message_id, values in email_messages.items():
+            read = not has_label(message_id, settings.GMAIL_LABEL_UNREAD, not values[3])
+            flags = (read, ) + tuple(
+                has_label(message_id, label_id, current) for (_, label_id), current in zip(flag_labels, values[4:])
+            )
+            if flags != values[3:]:
+                flag_changes.setdefault(flags, []).append(values[0])
+            if read != values[3]:
+                read_changes[values[0]] = read
+
+        # The labels, by comparing the rows of the many-to-many table with the listed messages.
+        EmailMessageLabel = EmailMessage.labels.through
+        reconciled_labels = {
+            db_labels[label_id].pk: label_id for label_id in label_message_ids if label_id in db_labels
+        }
+        email_message_pks = {message_id: values[0] for message_id, values in email_messages.items()}
+        reconciled_pks = set(email_message_pks.values())
+
+        current = set(
+            row for row in EmailMessageLabel.objects.filter(
+                emaillabel_id__in=reconciled_labels
+            ).values_list('emailmessage_id', 'emaillabel_id') if row[0] in reconciled_pks
+        )
+        wanted = set(
+            (email_message_pks[message_id], label_pk)
+            for label_pk, label_id in reconciled_labels.items() for message_id in label_message_ids[label_id]
+        )
+        removed = current - wanted
+        added = wanted - current
+
+        with transaction.atomic():
+            for flags, pks in flag_changes.items():
+                for batch in chunks(pks, settings.GMAIL_LABEL_UPDATE_BATCH_SIZE):
+                    EmailMessage.objects.filter(pk__in=batch).update(**dict(zip(flag_fields, flags)))
+                changed_pks.update(pks)
+
+            removed_pks = {}
+            for email_message_pk, label_pk in removed:
+                removed_pks.setdefault(label_pk, []).append(email_message_pk)
+            for label_pk, pks in removed_pks.items():
+                for batch in chunks(pks, settings.GMAIL_LABEL_UPDATE_BATCH_SIZE):
+                    EmailMessageLabel.objects.filter(emaillabel_id=label_pk, emailmessage_id__in=batch).delete()
+                changed_pks.update(pks)
+
+            EmailMessageLabel.objects.bulk_create(
+                [EmailMessageLabel(emailmessage_id=pk, emaillabel_id=label_pk) for pk, label_pk in added],
+                batch_size=settings.GMAIL_LABEL_UPDATE_BATCH_SIZE
+            )
+            changed_pks.update(pk for pk, _ in added)
+
+            # The changes bypassed the signals, so adjust the unread counters by the difference. A recount would race
+            # with the downloads of the full sync that adjust the same counters.
+            adjust_unread_counts(self.get_reconciled_unread_deltas(email_messages, read_changes, removed, added))
+
+        logger.debug('Reconciled labels of %s messages, %s changed, account %s' % (
+            len(email_messages),
+            len(changed_pks),
+            self.email_account
+        ))
+
+        if changed_pks:
+            reindex_email_messages(changed_pks)
+
+    def get_reconciled_unread_deltas(self, email_messages, read_changes, removed, added):
+        """
+        Return the change of the unread counters caused by reconciling the labels, after the labels were updated.
+
+        Args:
+            email_messages (dict): values of the email messages by message_id, starting with the pk and read fields
+            read_changes (dict): the new read value of the email messages of which it changed, by pk
+            removed (set): (email message pk, label pk) rows that were removed
+            added (set): (email message pk, label pk) rows that were added
+
+        Returns:
+            dict: the change of the number of unread messages by EmailLabel pk
+        """
+        EmailMessageLabel = EmailMessage.labels.through
+        was_unread = {values[0]: not values[3] for values in email_messages.values()}
+        deltas = {}
+
+        # Messages that changed read status leave or join the unread count of every label they kept.
+        for batch in chunks(list(read_changes), settings.GMAIL_LABEL_UPDATE_BATCH_SIZE):
+            for row in EmailMessageLabel.objects.filter(emailmessage_id__in=batch).values_list(
+                    'emailmessage_id', 'emaillabel_id'):
+                if row not in added:
+                    deltas[row[1]] = deltas.get(row[1], 0) + (-1 if read_changes[row[0]] else 1)
+
+        # Unread messages that lost or gained a label.
+        for pk, label_pk in removed:
+            if was_unread[pk]:
+                deltas[label_pk] = deltas.get(label_pk, 0) - 1
+        for pk, label_pk in added:
+            if not read_changes.get(pk, not was_unread[pk]):
+                deltas[label_pk] = deltas.get(label_pk, 0) + 1
+
+        return deltas
+
     def download_message(self, message_id):
         """
         Download message from Google and parse into an EmailMessage.
@@ -109,6 +299,32 @@ class GmailManager(object):
             self.message_builder.store_message_info(message_info, message_id)
             self.message_builder.save()
 
+    def download_messages(self, message_ids):
+        """
+        Download multiple messages from Google with batch requests and parse them into EmailMessages.
+
+        Arguments:
+            message_ids (list): message_ids of the messages
+        """
+        # Messages that are already downloaded only need a label update.
+        existing_message_ids = set(EmailMessage.objects.filter(
+            account=self.email_account,
+            message_id__in=message_ids,
+        ).order_by().values_list('message_id', flat=True))
+
+        for message_id in existing_message_ids:
+            self.update_labels_for_message(message_id)
+
+        new_message_ids = [message_id for message_id in message_ids if message_id not in existing_message_ids]
+        if not new_message_ids:
+            return
+
+        # Messages that are deleted from remote in the meantime are absent in the response.
+        message_infos = self.connector.get_message_info_batch(new_message_ids)
+
+        if message_infos:
+            self.message_builder.store_and_save_messages(message_infos)
+
     def sync_by_history(self):
         """
         Synchronize EmailAccount by history.
@@ -116,7 +332,6 @@ class GmailManager(object):
         Fetches the changes from the GMail api and creates tasks for the mutations.
         """
         logger.info('updating history for %s with history_id %s' % (self.email_account, self.email_account.history_id))
-        old_history_id = self.email_account.history_id
 
         try:
             history = self.connector.get_history()
@@ -148,6 +363,7 @@ class GmailManager(object):
 
         new_messages = set()
         edit_labels = set()
+        deleted_messages = set()
 
         # Collect message ids for new, removed email messages and email messages with label changes.
         for history_item in history:
@@ -186,27 +402,23 @@ class GmailManager(object):
                 # When deleting the message, there is no need anymore to create a download it or update its labels.
                 new_messages.discard(message['message']['id'])
                 edit_labels.discard(message['message']['id'])
+                deleted_messages.add(message['message']['id'])
 
-                EmailMessage.objects.filter(
-                    message_id=message['message']['id'], account=self.email_account
-                ).order_by().delete()
+        if deleted_messages:
+            delete_email_messages(
+                EmailMessage.objects.filter(message_id__in=deleted_messages, account=self.email_account)
+            )
 
         # Create tasks to download email messages.
-        for message_id in new_messages:
-            logger.info('creating download_email_message for %s', message_id)
-            app.send_task('download_email_message', args=[self.email_account.id, message_id])
+        for message_id_batch in chunks(new_messages, settings.GMAIL_FULL_MESSAGE_BATCH_SIZE):
+            logger.info('creating download_email_messages for %s', message_id_batch)
+            app.send_task('download_email_messages', args=[self.email_account.id, message_id_batch])
 
         # Creates tasks to update labeling for email messages.
         for message_id in edit_labels:
             logger.info('creating update_labels_for_message for %s', message_id)
             app.send_task('update_labels_for_message', args=[self.email_account.id, message_id])
 
-        # Only update the unread count if the history id was updated.
-        if old_history_id != self.email_account.history_id:
-            # TODO: Find out if there is a better place to update unread count. download_email_message tasks aren't
-            # finished yet.
-            self.update_unread_count()
-
     def sync_labels(self):
         """
         Synchronize labels.
@@ -264,16 +476,17 @@ class GmailManager(object):
                 label_id__in=delete_label_ids
             ).delete()
 
+        # The labels changed, so load them from the database again when needed.
+        self.label_registry.invalidate()
+
     def update_unread_count(self):
         """
-        Update unread count on every label.
+        Recount the unread messages of every label.
+
+        The counters are adjusted whenever messages are stored, relabeled or deleted, so this only fixes drift.
         """
-        pass
-        # logger.debug('Updating unread count for every label, account %s' % self.email_account)
-        # for label in self.email_account.labels.all():
-        #     unread_count = label.messages.filter(read=False).count()
-        #     label.unread = unread_count
-        #     label.save()
+        logger.debug('Updating unread count for every label, account %s' % self.email_account)
+        reconcile_unread_counts(self.email_account)
 
     def administer_sync_status(self, is_syncing):
         """
@@ -294,19 +507,13 @@ class GmailManager(object):
         Returns:
             EmailLabel instance
         """
-        label = None
-
-        if use_db:
-            try:
-                label = EmailLabel.objects.get(account=self.email_account, label_id=label_id)
-            except EmailLabel.DoesNotExist:
-                pass
-
-        if not label:
+        if not use_db:
             label_info = self.connector.get_label_info(label_id)
             label = self.label_builder.get_or_create_label(label_info)[0]
+            self.label_registry.labels[label_id] = label
+            return label
 
-        return label
+        return self.label_registry.get(label_id)
 
     def get_attachment(self, message_id, attachment_id):
         """
@@ -384,7 +591,7 @@ class GmailManager(object):
                 message_info = self.connector.get_labels_and_thread_id_for_message_id(email_message.message_id)
             except NotFoundError:
                 logger.debug('Message not available on remote.')
-                EmailMessage.objects.get(pk=email_message.id).delete()
+                delete_email_messages(EmailMessage.objects.filter(pk=email_message.id))
                 return
 
             # Initialize a label update object.
@@ -392,7 +599,7 @@ class GmailManager(object):
 
             for label in add_labels:
                 if label not in message_info.get('labelIds', []) and label != settings.GMAIL_LABEL_SENT:
-                    if email_message.account.labels.filter(label_id=label).exists():
+                    if label in self.label_registry:
                         labels['addLabelIds'].append(label)
 
             for label in remove_labels:
@@ -412,19 +619,27 @@ class GmailManager(object):
                     raise
                 else:
                     # API call to update labelling successfull, so also update the labelling in the database.
-                    email_message.labels.remove(
-                        *list(EmailLabel.objects.filter(label_id__in=labels['removeLabelIds'],
-                                                        account=self.email_account))
-                    )
-                    email_message.labels.add(
-                        *list(EmailLabel.objects.filter(label_id__in=labels['addLabelIds'],
-                                                        account=self.email_account))
-                    )
+                    current_label_ids = set(email_message.labels.values_list('pk', flat=True))
+                    db_labels = self.label_registry.labels
+                    removed_labels = [
+                        db_labels[label_id] for label_id in labels['removeLabelIds']
+                        if label_id in db_labels and db_labels[label_id].pk in current_label_ids
+                    ]
+                    added_labels = [
+                        db_labels[label_id] for label_id in labels['addLabelIds']
+                        if db_labels[label_id].pk not in current_label_ids
+                    ]
+                    email_message.labels.remove(*removed_labels)
+                    email_message.labels.add(*added_labels)
+
+                    if EmailMessage.objects.filter(pk=email_message.pk, read=False).exists():
+                        deltas = {label.pk: -1 for label in removed_labels}
+                        deltas.update({label.pk: 1 for label in added_labels})
+                        adjust_unread_counts(deltas)
+
                     # Labels updated in the database, so no need to retry / continue the for-loop.
                     break
 
-        self.update_unread_count()
-
     def toggle_star_email_message(self, email_message, star=True):
         """
         (Un)star a message.
@@ -498,7 +713,6 @@ class GmailManager(object):
             # Store updated message.
             self.message_builder.store_message_info(full_message_dict, message_dict['id'])
             self.message_builder.save()
-            self.update_unread_count()
 
     def delete_email_message(self, email_message):
         """
@@ -511,8 +725,6 @@ class GmailManager(object):
             self.connector.delete_email_message(email_message.message_id)
         except NotFoundError:
             logger.debug('Message already deleted from remote')
-        else:
-            self.update_unread_count()
 
     def send_email_message(self, email_message, thread_id=None):
         """
@@ -523,7 +735,12 @@ class GmailManager(object):
             thread_id (string): Thread ID of original message that is replied or forwarded on
         """
         # Send message.
-        message_dict = self.connector.send_email_message(email_message.as_string(), thread_id)
+        message_file = spool_email_message(email_message)
+        try:
+            message_dict = self.connector.send_email_message(message_file, thread_id)
+        finally:
+            message_file.close()
+
         try:
             full_message_dict = self.connector.get_message_info(message_dict['id'])
         except NotFoundError:
@@ -532,7 +749,6 @@ class GmailManager(object):
             # Store updated message.
             self.message_builder.store_message_info(full_message_dict, message_dict['id'])
             self.message_builder.save()
-            self.update_unread_count()
 
     def create_draft_email_message(self, email_message):
         """
@@ -542,7 +758,11 @@ class GmailManager(object):
             email_message (instance): Email instance
         """
         # Create draft message.
-        draft_dict = self.connector.create_draft_email_message(email_message.as_string())
+        message_file = spool_email_message(email_message)
+        try:
+            draft_dict = self.connector.create_draft_email_message(message_file)
+        finally:
+            message_file.close()
 
         try:
             message_dict = self.connector.get_message_info(draft_dict['message']['id'])
@@ -553,7 +773,6 @@ class GmailManager(object):
             self.message_builder.store_message_info(message_dict, draft_dict['message']['id'])
             self.message_builder.message.draft_id = draft_dict.get('id', '')
             self.message_builder.save()
-            self.update_unread_count()
 
     def update_draft_email_message(self, email_message, draft_id):
         """
@@ -564,7 +783,11 @@ class GmailManager(object):
             draft_id (string): id of current draft
         """
         # Update draft message.
-        draft_dict = self.connector.update_draft_email_message(email_message.as_string(), draft_id)
+        message_file = spool_email_message(email_message)
+        try:
+            draft_dict = self.connector.update_draft_email_message(message_file, draft_id)
+        finally:
+            message_file.close()
 
         try:
             message_dict = self.connector.get_message_info(draft_dict['message']['id'])
@@ -575,7 +798,6 @@ class GmailManager(object):
             self.message_builder.store_message_info(message_dict, draft_dict['message']['id'])
             self.message_builder.message.draft_id = draft_dict.get('id', '')
             self.message_builder.save()
-            self.update_unread_count()
 
     def delete_draft_email_message(self, email_message):
         """
@@ -589,9 +811,9 @@ class GmailManager(object):
         except NotFoundError:
             # Draft exists in Lily but not anymore on remote, so remove it from the database.
             logger.debug('Draft already deleted from remote.')
-            EmailMessage.objects.filter(message_id=email_message.message_id, account=self.email_account).delete()
-        else:
-            self.update_unread_count()
+            delete_email_messages(
+                EmailMessage.objects.filter(message_id=email_message.message_id, account=self.email_account)
+            )
 
     def cleanup(self):
         """
@@ -601,6 +823,8 @@ class GmailManager(object):
         self.message_builder = None
         self.label_builder.cleanup()
         self.label_builder = None
+        self.label_registry.cleanup()
+        self.label_registry = None
         self.connector.cleanup()
         self.connector = None
         self.email_account = None
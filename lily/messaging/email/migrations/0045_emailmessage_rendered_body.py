@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email', '0044_auto_20181106_1003'),
+    ]
+
+    operations = [
+        # Nullable, so adding the columns doesn't rewrite the table. Existing messages are rendered when viewed.
+        migrations.AddField(
+            model_name='emailmessage',
+            name='rendered_body_html',
+            field=models.TextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='emailmessage',
+            name='rendered_body_version',
+            field=models.PositiveSmallIntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import lily.messaging.email.models.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email', '0045_emailmessage_rendered_body'),
+    ]
+
+    operations = [
+        # Nullable, so adding the columns doesn't rewrite the table.
+        migrations.AddField(
+            model_name='emailattachment',
+            name='content_type',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='emailattachment',
+            name='filename',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='emailattachment',
+            name='gmail_attachment_id',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='emailattachment',
+            name='attachment',
+            field=models.FileField(blank=True, max_length=255, upload_to=lily.messaging.email.models.models.get_attachment_upload_path),
+        ),
+    ]
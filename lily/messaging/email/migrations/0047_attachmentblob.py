@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import lily.messaging.email.models.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tenant', '0008_auto_20180822_1308'),
+        ('email', '0046_emailattachment_lazy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AttachmentBlob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64)),
+                ('file', models.FileField(max_length=255, upload_to=lily.messaging.email.models.models.get_attachment_blob_upload_path)),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('references', models.PositiveIntegerField(db_index=True, default=0)),
+                ('tenant', models.ForeignKey(blank=True, on_delete=django.db.models.deletion.CASCADE, to='tenant.Tenant')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='attachmentblob',
+            unique_together=set([('tenant', 'digest')]),
+        ),
+        # Nullable, so adding the columns doesn't rewrite the tables. Existing attachments keep their own files.
+        migrations.AddField(
+            model_name='emailattachment',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='email.AttachmentBlob'),
+        ),
+        migrations.AddField(
+            model_name='emaildraftattachment',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='email.AttachmentBlob'),
+        ),
+        migrations.AddField(
+            model_name='emaildraftattachment',
+            name='filename',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='emailoutboxattachment',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='email.AttachmentBlob'),
+        ),
+        migrations.AddField(
+            model_name='emailoutboxattachment',
+            name='filename',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
@@ -0,0 +1,132 @@
+import base64
+import tempfile
+from email.generator import NL, Generator, _make_boundary, fcre
+from email.mime.base import MIMEBase
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+
+# Base64 encodes 57 bytes into a line of 76 characters, so chunks of a multiple of 57 bytes encode into whole lines.
+BASE64_CHUNK_SIZE = 57 * 1024
+
+
+class StorageMIMEBase(MIMEBase):
+    """
+    Base64 encoded MIME part of which the content is read from storage when the message is written.
+
+    The StreamingGenerator reads and encodes the file in chunks, other generators get the whole encoded payload.
+    """
+
+    def __init__(self, _maintype, _subtype, storage_name, **_params):
+        MIMEBase.__init__(self, _maintype, _subtype, **_params)
+        self['Content-Transfer-Encoding'] = 'base64'
+        self.storage_name = storage_name
+
+    def iter_encoded_payload(self):
+        storage_file = default_storage.open(self.storage_name)
+        try:
+            chunk = encoded_chunk = None
+            for next_chunk in storage_file.chunks(BASE64_CHUNK_SIZE):
+                if encoded_chunk is not None:
+                    yield encoded_chunk
+                chunk, encoded_chunk = next_chunk, base64.encodestring(next_chunk)
+        finally:
+            storage_file.close()
+
+        if encoded_chunk:
+            # Like email.encoders, only end with a newline if the content does.
+            yield encoded_chunk if chunk.endswith('\n') else encoded_chunk.rstrip('\n')
+
+    def get_payload(self, i=None, decode=False):
+        if self._payload is None:
+            self._payload = ''.join(self.iter_encoded_payload())
+        return MIMEBase.get_payload(self, i, decode)
+
+
+class StreamingGenerator(Generator):
+    """
+    Generator that writes every part of a message straight to the file.
+
+    The default generator writes every part to a string before writing it to the file, to find a boundary that isn't
+    used in the message. The boundaries are chosen up front instead, they're random enough not to collide.
+    """
+
+    def _write(self, msg):
+        if msg.is_multipart() and not msg.get_boundary():
+            msg.set_boundary(_make_boundary())
+
+        meth = getattr(msg, '_write_headers', None)
+        if meth is None:
+            self._write_headers(msg)
+        else:
+            meth(self)
+
+        self._dispatch(msg)
+
+    def _dispatch(self, msg):
+        if isinstance(msg, StorageMIMEBase) and msg._payload is None:
+            for encoded_chunk in msg.iter_encoded_payload():
+                self._fp.write(encoded_chunk)
+            return
+
+        Generator._dispatch(self, msg)
+
+    def _handle_multipart(self, msg):
+        subparts = msg.get_payload()
+        if subparts is None:
+            subparts = []
+        elif isinstance(subparts, basestring):
+            self._fp.write(subparts)
+            return
+        elif not isinstance(subparts, list):
+            subparts = [subparts]
+
+        boundary = msg.get_boundary()
+
+        if msg.preamble is not None:
+            preamble = fcre.sub('>From ', msg.preamble) if self._mangle_from_ else msg.preamble
+            self._fp.write(preamble + NL)
+
+        self._fp.write('--' + boundary + NL)
+        for i, part in enumerate(subparts):
+            if i:
+                self._fp.write(NL + '--' + boundary + NL)
+            self.clone(self._fp).flatten(part, unixfrom=False)
+
+        self._fp.write(NL + '--' + boundary + '--' + NL)
+
+        if msg.epilogue is not None:
+            epilogue = fcre.sub('>From ', msg.epilogue) if self._mangle_from_ else msg.epilogue
+            self._fp.write(epilogue)
+
+
+class Utf8Writer(object):
+    """
+    Write to a file, encoding unicode parts of the message as UTF-8.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def write(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        self.fp.write(value)
+
+
+def spool_email_message(email_message):
+    """
+    Write the email message to a temporary file, which is only kept in memory while the message is small.
+
+    Args:
+        email_message (Message): the MIME message to write
+
+    Returns:
+        SpooledTemporaryFile: the written message, positioned at the start
+    """
+    message_file = tempfile.SpooledTemporaryFile(max_size=settings.EMAIL_MESSAGE_SPOOL_SIZE)
+    StreamingGenerator(Utf8Writer(message_file), mangle_from_=False).flatten(email_message)
+    message_file.seek(0)
+
+    return message_file
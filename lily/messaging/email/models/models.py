@@ -5,15 +5,11 @@ import logging
 import os
 
 from email.header import Header
-from email import Encoders
-from email.mime.audio import MIMEAudio
-from email.mime.base import MIMEBase
 from email.mime.image import MIMEImage
 from email.mime.text import MIMEText
 from email.utils import parseaddr
 
 from django.conf import settings
-from django.contrib.contenttypes.models import ContentType
 from django.contrib.postgres.fields import ArrayField, JSONField
 from django.core.files.uploadedfile import InMemoryUploadedFile, TemporaryUploadedFile
 from django.core.files.storage import default_storage
@@ -21,15 +17,16 @@ from django.core.mail import SafeMIMEText, SafeMIMEMultipart, EmailMultiAlternat
 from django.urls import reverse
 from django.core.validators import validate_comma_separated_integer_list
 from django.db import models
-from django.db.models.signals import post_delete
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 from oauth2client.contrib.django_orm import CredentialsField
 
 from lily.tenant.models import TenantMixin
 from lily.users.models import LilyUser
-from lily.utils.models.mixins import DeletedMixin, TimeStampedModel
+from lily.utils.models.mixins import ContentTypeMixin, DeletedMixin, TimeStampedModel
 
+from ..mime import StorageMIMEBase
 from ..sanitize import sanitize_html_email
 
 
@@ -49,6 +46,13 @@ def get_attachment_upload_path(instance, filename):
     }
 
 
+def get_attachment_blob_upload_path(instance, filename):
+    return settings.EMAIL_ATTACHMENT_BLOB_UPLOAD_TO % {
+        'tenant_id': instance.tenant_id,
+        'digest': instance.digest,
+    }
+
+
 def get_template_attachment_upload_path(instance, filename):
     return settings.EMAIL_TEMPLATE_ATTACHMENT_UPLOAD_TO % {
         'tenant_id': instance.tenant_id,
@@ -67,7 +71,6 @@ def get_outbox_attachment_upload_path(instance, filename):
 
 def add_attachments_to_email(email, email_message, inline_headers):
     """ Retrieves all the attachments and adds them to the email. """
-    from ..utils import get_attachment_filename_from_url
     for attachment in email.attachments.all():
         if attachment.inline:
             continue
@@ -83,11 +86,7 @@ def add_attachments_to_email(email, email_message, inline_headers):
             )
             raise
 
-        filename = get_attachment_filename_from_url(attachment.attachment.name)
-
-        storage_file.open()
-        content = storage_file.read()
-        storage_file.close()
+        filename = attachment.name
 
         content_type, encoding = mimetypes.guess_type(filename)
         if content_type is None or encoding is not None:
@@ -95,15 +94,17 @@ def add_attachments_to_email(email, email_message, inline_headers):
         main_type, sub_type = content_type.split('/', 1)
 
         if main_type == 'text':
+            # The encoding of text depends on the content, so it's read at once.
+            storage_file.open()
+            content = storage_file.read()
+            storage_file.close()
+
             msg = MIMEText(content, _subtype=sub_type)
-        elif main_type == 'image':
-            msg = MIMEImage(content, _subtype=sub_type)
-        elif main_type == 'audio':
-            msg = MIMEAudio(content, _subtype=sub_type)
         else:
-            msg = MIMEBase(main_type, sub_type)
-            msg.set_payload(content)
-            Encoders.encode_base64(msg)
+            # Other files are base64 encoded in chunks while the message is written.
+            storage_file.close()
+
+            msg = StorageMIMEBase(main_type, sub_type, attachment.attachment.name)
 
         msg.add_header('Content-Disposition', 'attachment', filename=os.path.basename(filename))
 
@@ -130,6 +131,21 @@ def add_attachments_to_email(email, email_message, inline_headers):
     return True
 
 
+def get_privacy_map_values(instance):
+    """
+    Return the values of the instance that the cached privacy maps depend on.
+
+    Deferred fields aren't loaded for this, they count as unchanged until they're loaded.
+
+    Args:
+        instance (EmailAccount or SharedEmailConfig): the instance to get the values of
+
+    Returns:
+        tuple: the values of the PRIVACY_MAP_FIELDS of the instance
+    """
+    return tuple(instance.__dict__.get(field) for field in instance.PRIVACY_MAP_FIELDS)
+
+
 class EmailAccount(TenantMixin, DeletedMixin):
     """
     Email account linked to a user.
@@ -167,9 +183,18 @@ class EmailAccount(TenantMixin, DeletedMixin):
 
     color = models.CharField(max_length=7, blank=True)
 
+    # The fields that determine which users see the email account with which privacy.
+    PRIVACY_MAP_FIELDS = ('tenant_id', 'privacy', 'owner_id', 'is_active', 'is_deleted')
+
     def __unicode__(self):
         return u'%s (%s)' % (self.label, self.email_address)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(EmailAccount, cls).from_db(db, field_names, values)
+        instance.loaded_privacy_map_values = get_privacy_map_values(instance)
+        return instance
+
     @property
     def is_public(self):
         return self.privacy == EmailAccount.PUBLIC
@@ -202,6 +227,14 @@ class SharedEmailConfig(TenantMixin):
     is_hidden = models.BooleanField(default=False)
     privacy = models.IntegerField(choices=EmailAccount.PRIVACY_CHOICES, default=EmailAccount.PUBLIC)
 
+    PRIVACY_MAP_FIELDS = ('tenant_id', 'email_account_id', 'user_id', 'privacy')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(SharedEmailConfig, cls).from_db(db, field_names, values)
+        instance.loaded_privacy_map_values = get_privacy_map_values(instance)
+        return instance
+
     class Meta:
         app_label = 'email'
         unique_together = ('tenant', 'email_account', 'user')
@@ -257,7 +290,7 @@ class Recipient(models.Model):
         unique_together = ('name', 'email_address')
 
 
-class EmailMessage(models.Model):
+class EmailMessage(ContentTypeMixin):
     """
     EmailMessage has all information from an email message.
     """
@@ -273,6 +306,10 @@ class EmailMessage(models.Model):
     account = models.ForeignKey(EmailAccount, related_name='messages')
     body_html = models.TextField(default='')
     body_text = models.TextField(default='')
+    # The sanitized html body with linked inline images as displayed, rendered when the message is stored.
+    rendered_body_html = models.TextField(null=True)
+    # Version of the rendering, so outdated bodies are rendered again when they are viewed.
+    rendered_body_version = models.PositiveSmallIntegerField(null=True)
     draft_id = models.CharField(max_length=50, db_index=True, default='')
     has_attachment = models.BooleanField(default=False)
     labels = models.ManyToManyField(EmailLabel, related_name='messages')
@@ -406,13 +443,6 @@ class EmailMessage(models.Model):
         else:
             return self.sender.email_address
 
-    @property
-    def content_type(self):
-        """
-        Return the content type (Django model) for this model
-        """
-        return ContentType.objects.get(app_label="email", model="emailmessage")
-
     def __unicode__(self):
         return u'%s: %s' % (self.sender, self.snippet)
 
@@ -437,22 +467,98 @@ class EmailHeader(models.Model):
         app_label = 'email'
 
 
-class EmailAttachment(models.Model):
+class AttachmentBlob(TenantMixin):
+    """
+    The content of attachments, stored once per tenant no matter how many attachments have the same content.
+
+    The blob keeps count of the attachments referencing it, blobs without references are garbage collected.
+    """
+    digest = models.CharField(max_length=64)
+    file = models.FileField(upload_to=get_attachment_blob_upload_path, max_length=255)
+    size = models.PositiveIntegerField(default=0)
+    references = models.PositiveIntegerField(default=0, db_index=True)
+
+    def __unicode__(self):
+        return self.digest
+
+    class Meta:
+        app_label = 'email'
+        unique_together = ('tenant', 'digest')
+
+
+class AttachmentBlobMixin(models.Model):
+    """
+    Store the file of an attachment in a blob, so files with the same content are only stored once.
+
+    The file field of the attachment points to the file of the blob, the original filename is kept separately.
+    Files are added as usual, they're moved to a blob when the attachment is saved.
+    """
+    blob = models.ForeignKey(AttachmentBlob, null=True, blank=True, on_delete=models.PROTECT, related_name='+')
+    filename = models.CharField(max_length=255, null=True, blank=True)
+
+    @property
+    def name(self):
+        if self.filename:
+            return self.filename
+        return self.attachment.name.split('/')[-1]
+
+    def get_blob_tenant_id(self):
+        return self.tenant_id
+
+    def save(self, *args, **kwargs):
+        from ..utils import reference_attachment_blob, release_attachment_blob, store_attachment_blob
+
+        if self.attachment and not self.attachment._committed:
+            previous_blob_id = self.blob_id
+
+            blob = store_attachment_blob(self.get_blob_tenant_id(), self.attachment.file)
+            self.filename = os.path.basename(self.attachment.name)
+            self.attachment = blob.file.name
+            self.blob = blob
+
+            if previous_blob_id:
+                release_attachment_blob(previous_blob_id)
+        elif self.pk is None and self.blob_id:
+            # Copied from another attachment, so only the blob gets another reference.
+            reference_attachment_blob(self.blob_id)
+
+        super(AttachmentBlobMixin, self).save(*args, **kwargs)
+
+    class Meta:
+        abstract = True
+
+
+class EmailAttachment(AttachmentBlobMixin):
     """
     Email attachment for an EmailMessage.
+
+    Attachments can be synced without their file, which is then downloaded from Gmail on first use.
     """
-    attachment = models.FileField(upload_to=get_attachment_upload_path, max_length=255)
+    attachment = models.FileField(upload_to=get_attachment_upload_path, max_length=255, blank=True)
     cid = models.TextField(default='')
     inline = models.BooleanField(default=False)
     message = models.ForeignKey(EmailMessage, related_name='attachments')
     size = models.PositiveIntegerField(default=0)
+    # Only set for attachments of which the file hasn't been downloaded yet.
+    gmail_attachment_id = models.TextField(null=True, blank=True)
+    content_type = models.CharField(max_length=255, null=True, blank=True)
 
     def __unicode__(self):
-        return self.attachment.name.split('/')[-1]
+        return self.name
 
     @property
     def name(self):
-        return self.attachment.name.split('/')[-1]
+        if not self.attachment:
+            return self.filename or ''
+        return super(EmailAttachment, self).name
+
+    def get_blob_tenant_id(self):
+        # The tenant is only set on attachments that are being stored.
+        return getattr(self, 'tenant_id', None) or self.message.tenant_id
+
+    @property
+    def is_downloaded(self):
+        return bool(self.attachment)
 
     def download_url(self):
         return reverse('download', kwargs={
@@ -646,7 +752,7 @@ class EmailOutboxMessage(TenantMixin, models.Model):
         verbose_name_plural = _('email outbox messages')
 
 
-class EmailOutboxAttachment(TenantMixin):
+class EmailOutboxAttachment(TenantMixin, AttachmentBlobMixin):
     inline = models.BooleanField(default=False)
     attachment = models.FileField(upload_to=get_outbox_attachment_upload_path, max_length=255)
     size = models.PositiveIntegerField(default=0)
@@ -654,7 +760,7 @@ class EmailOutboxAttachment(TenantMixin):
     email_outbox_message = models.ForeignKey(EmailOutboxMessage, related_name='attachments')
 
     def __unicode__(self):
-        return self.attachment.name
+        return self.name
 
     class Meta:
         app_label = 'email'
@@ -662,11 +768,20 @@ class EmailOutboxAttachment(TenantMixin):
         verbose_name_plural = _('email outbox attachments')
 
 
-@receiver(post_delete, sender=EmailAttachment)
-def post_delete_mail_attachment_handler(sender, **kwargs):
-    attachment = kwargs['instance']
-    storage, filename = attachment.attachment.storage, attachment.attachment.name
-    storage.delete(filename)
+@receiver(post_save, sender=EmailAccount)
+@receiver(post_delete, sender=EmailAccount)
+@receiver(post_save, sender=SharedEmailConfig)
+@receiver(post_delete, sender=SharedEmailConfig)
+def email_account_privacy_changed_handler(sender, instance, **kwargs):
+    from ..utils import invalidate_email_account_privacy_map
+
+    values = get_privacy_map_values(instance)
+    if kwargs.get('created') is False and values == getattr(instance, 'loaded_privacy_map_values', None):
+        # Saved without changing the privacy, e.g. the sync status of the email account.
+        return
+
+    invalidate_email_account_privacy_map(instance.tenant_id)
+    instance.loaded_privacy_map_values = values
 
 
 class EmailDraft(TenantMixin, models.Model):
@@ -721,7 +836,7 @@ class EmailDraft(TenantMixin, models.Model):
         verbose_name_plural = _('email draft messages')
 
 
-class EmailDraftAttachment(TenantMixin):
+class EmailDraftAttachment(TenantMixin, AttachmentBlobMixin):
     inline = models.BooleanField(default=False)
     attachment = models.FileField(upload_to=get_outbox_attachment_upload_path, max_length=255)
     size = models.PositiveIntegerField(default=0)
@@ -729,9 +844,26 @@ class EmailDraftAttachment(TenantMixin):
     email_draft = models.ForeignKey(EmailDraft, related_name='attachments')
 
     def __unicode__(self):
-        return self.attachment.name
+        return self.name
 
     class Meta:
         app_label = 'email'
         verbose_name = _('email draft attachment')
         verbose_name_plural = _('email draft attachments')
+
+
+@receiver(post_delete, sender=EmailAttachment)
+@receiver(post_delete, sender=EmailOutboxAttachment)
+@receiver(post_delete, sender=EmailDraftAttachment)
+def post_delete_mail_attachment_handler(sender, **kwargs):
+    """
+    Release the blob of the deleted attachment, so it's garbage collected when nothing references it anymore.
+    """
+    from ..utils import release_attachment_blob
+
+    attachment = kwargs['instance']
+    if attachment.blob_id:
+        release_attachment_blob(attachment.blob_id)
+    elif sender is EmailAttachment and attachment.attachment.name:
+        # Stored before the blobs existed, so it has a file of its own.
+        attachment.attachment.storage.delete(attachment.attachment.name)
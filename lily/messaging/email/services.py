@@ -1,13 +1,52 @@
+import json
+import threading
+from collections import OrderedDict
+
 import httplib2
+from django.conf import settings
+from googleapiclient.discovery import DISCOVERY_URI, build_from_document
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
+
+
+_discovery_document = None
+_discovery_document_lock = threading.Lock()
+
+
+def get_discovery_document():
+    """
+    Return the parsed discovery document of the Gmail API, which is loaded once per process.
 
-from googleapiclient.discovery import build
+    The document is read from GMAIL_DISCOVERY_DOCUMENT when it's configured, otherwise it's retrieved from Google.
+
+    Returns:
+        dict: the discovery document
+    """
+    global _discovery_document
+
+    with _discovery_document_lock:
+        if _discovery_document is None:
+            if settings.GMAIL_DISCOVERY_DOCUMENT:
+                with open(settings.GMAIL_DISCOVERY_DOCUMENT) as infile:
+                    content = infile.read()
+            else:
+                uri = DISCOVERY_URI.format(api='gmail', apiVersion='v1')
+                response, content = httplib2.Http().request(uri)
+                if response.status >= 400:
+                    raise HttpError(response, content, uri=uri)
+
+            _discovery_document = json.loads(content)
+
+    return _discovery_document
 
 
 class GmailService(object):
+    credentials = None
     http = None
     service = None
 
     def __init__(self, credentials):
+        self.credentials = credentials
         self.http = self.authorize(credentials)
         self.service = self.build_service()
 
@@ -15,10 +54,23 @@ class GmailService(object):
         return credentials.authorize(httplib2.Http())
 
     def build_service(self):
-        return build('gmail', 'v1', http=self.http)
+        return build_from_document(get_discovery_document(), http=self.http)
+
+    def execute_service(self, service, num_retries=0):
+        if isinstance(service, BatchHttpRequest):
+            # Batch requests can't be retried as a whole, the connector retries the failed requests instead.
+            return service.execute(http=self._get_http())
 
-    def execute_service(self, service):
-        return service.execute(http=self._get_http())
+        return service.execute(http=self._get_http(), num_retries=num_retries)
+
+    def close(self):
+        """
+        Close the connections that are kept alive.
+        """
+        if self.http is not None:
+            for connection in self.http.connections.values():
+                connection.close()
+            self.http.connections.clear()
 
     def _get_http(self):
         """
@@ -27,3 +79,90 @@ class GmailService(object):
         :return: current http instance
         """
         return self.http
+
+
+class GmailServicePool(object):
+    """
+    Gmail services of the recently used email accounts, kept per process so the next connector can reuse them.
+
+    Every service keeps its authorized connection alive, so reusing one saves building the client and setting up a new
+    connection. The pool keeps a limited number of services per account for a limited number of accounts.
+    """
+    def __init__(self, size, accounts):
+        self.size = size
+        self.accounts = accounts
+        self._services = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, account_id, credentials):
+        """
+        Return a service of the account for the given credentials, from the pool when there is one.
+
+        Args:
+            account_id (int): id of the EmailAccount
+            credentials (instance): OAuth2Credentials of the EmailAccount
+
+        Returns:
+            GmailService instance
+        """
+        service = None
+        stale = []
+
+        with self._lock:
+            services = self._services.get(account_id, [])
+            while services and service is None:
+                candidate = services.pop()
+                if candidate.credentials is credentials:
+                    service = candidate
+                else:
+                    # The credentials were reloaded, the services authorized with the old ones are of no use anymore.
+                    stale.append(candidate)
+
+        for stale_service in stale:
+            stale_service.close()
+
+        return service or GmailService(credentials)
+
+    def release(self, account_id, service):
+        """
+        Return the service to the pool, or close it when the pool of the account is full.
+
+        Args:
+            account_id (int): id of the EmailAccount
+            service (instance): GmailService instance
+        """
+        if settings.TESTING:  # Disable reuse while running tests, every test mocks its own service.
+            service.close()
+            return
+
+        evicted = []
+
+        with self._lock:
+            services = self._services.pop(account_id, [])
+            if len(services) < self.size:
+                services.append(service)
+            else:
+                evicted.append(service)
+
+            # Re-insert the services so the account becomes the most recently used one.
+            self._services[account_id] = services
+
+            while len(self._services) > self.accounts:
+                evicted.extend(self._services.popitem(last=False)[1])
+
+        for evicted_service in evicted:
+            evicted_service.close()
+
+    def clear(self):
+        with self._lock:
+            services, self._services = self._services, OrderedDict()
+
+        for account_services in services.values():
+            for service in account_services:
+                service.close()
+
+
+gmail_service_pool = GmailServicePool(
+    size=settings.GMAIL_SERVICE_POOL_SIZE,
+    accounts=settings.GMAIL_SERVICE_POOL_ACCOUNTS,
+)
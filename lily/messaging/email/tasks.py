@@ -7,7 +7,10 @@ from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
 from oauth2client.client import HttpAccessTokenRefreshError
 
-from lily.messaging.email.utils import determine_message_type
+from lily.messaging.email.utils import (
+    EMAIL_BODY_RENDER_VERSION, classify_unclassified_threads, collect_attachment_blobs, download_attachment,
+    reconcile_unread_counts, render_email_message_body
+)
 from lily.utils.functions import post_intercom_event
 from .manager import GmailManager
 from .models.models import (EmailAccount, EmailMessage, EmailOutboxMessage, EmailTemplateAttachment,
@@ -53,6 +56,52 @@ def synchronize_labels_scheduler():
         logger.info('Adding task for label sync for: %s', email_account)
 
 
+@task(name='reconcile_unread_counts', logger=logger)
+def reconcile_unread_counts_scheduler():
+    """
+    Recount the unread messages of the labels of every mailbox, to fix counters that drifted.
+    """
+    for email_account in EmailAccount.objects.filter(is_deleted=False):
+        logger.debug('Reconciling unread counts for %s', email_account)
+        reconcile_unread_counts(email_account)
+
+
+@task(name='collect_attachment_blobs', logger=logger)
+def collect_attachment_blobs_scheduler():
+    """
+    Delete the stored attachment content that's no longer referenced by any attachment.
+    """
+    batch_size = settings.EMAIL_ATTACHMENT_BLOB_COLLECT_BATCH_SIZE
+    collected = collect_attachment_blobs(batch_size)
+    while collected == batch_size:
+        collected = collect_attachment_blobs(batch_size)
+
+
+@task(name='rerender_email_message_body', logger=logger)
+def rerender_email_message_body(email_message_id):
+    """
+    Render the body of an email message again, when it was rendered by an older version.
+
+    Args:
+        email_message_id (int): id of the EmailMessage
+    """
+    try:
+        email_message = EmailMessage.objects.get(pk=email_message_id)
+    except EmailMessage.DoesNotExist:
+        logger.warning('EmailMessage no longer exists: %s', email_message_id)
+        return
+
+    if email_message.rendered_body_version == EMAIL_BODY_RENDER_VERSION:
+        # Already rendered by an earlier task.
+        return
+
+    render_email_message_body(email_message, email_message.attachments.all())
+    EmailMessage.objects.filter(pk=email_message.pk).update(
+        rendered_body_html=email_message.rendered_body_html,
+        rendered_body_version=email_message.rendered_body_version,
+    )
+
+
 @task(name='incremental_synchronize_email_account', logger=logger)
 def incremental_synchronize_email_account(account_id):
     """
@@ -212,6 +261,39 @@ def download_email_message(self, account_id, message_id):
             logger.warning('Not syncing, no authorization for: %s', email_account)
 
 
+@task(name='download_email_messages', logger=logger, acks_late=True, bind=True)
+def download_email_messages(self, account_id, message_ids):
+    """
+    Download multiple messages with batch requests.
+
+    Args:
+        account_id (int): id of the EmailAccount
+        message_ids (list): google ids of EmailMessages
+    """
+    try:
+        email_account = EmailAccount.objects.get(pk=account_id, is_deleted=False)
+    except EmailAccount.DoesNotExist:
+        logger.warning('EmailAccount no longer exists: %s', account_id)
+    else:
+        if email_account.is_authorized:
+            manager = None
+            try:
+                manager = GmailManager(email_account)
+                logger.debug('Fetch %s messages for: %s' % (len(message_ids), email_account))
+                manager.download_messages(message_ids)
+            except HttpAccessTokenRefreshError:
+                logger.warning('Not syncing, no authorization for: %s', email_account)
+                pass
+            except Exception as exc:
+                logger.exception('Fetch %s messages for: %s failed' % (len(message_ids), email_account))
+                raise self.retry(exc=exc)
+            finally:
+                if manager:
+                    manager.cleanup()
+        else:
+            logger.warning('Not syncing, no authorization for: %s', email_account)
+
+
 @task(name='update_labels_for_message', logger=logger, bind=True)
 def update_labels_for_message(self, account_id, email_id):
     """
@@ -245,6 +327,39 @@ def update_labels_for_message(self, account_id, email_id):
             logger.warning('Not syncing, no authorization for: %s', email_account)
 
 
+@task(name='reconcile_email_labels', logger=logger, bind=True)
+def reconcile_email_labels(self, account_id, thread_ids):
+    """
+    Update the labels of the existing EmailMessages of the email account during a full sync.
+
+    Args:
+        account_id (int): id of the EmailAccount
+        thread_ids (dict): threadIds of the email messages to update by message_id
+    """
+    try:
+        email_account = EmailAccount.objects.get(pk=account_id, is_deleted=False)
+    except EmailAccount.DoesNotExist:
+        logger.warning('EmailAccount no longer exists: %s', account_id)
+    else:
+        if email_account.is_authorized:
+            manager = None
+            try:
+                manager = GmailManager(email_account)
+                logger.debug('Reconciling labels for: %s', email_account)
+                manager.reconcile_labels(thread_ids)
+            except HttpAccessTokenRefreshError:
+                logger.warning('Not syncing, no authorization for: %s', email_account)
+                pass
+            except Exception as exc:
+                logger.exception('Failed reconciling labels for %s' % email_account)
+                raise self.retry(exc=exc)
+            finally:
+                if manager:
+                    manager.cleanup()
+        else:
+            logger.warning('Not syncing, no authorization for: %s', email_account)
+
+
 @task(name='toggle_read_email_message', logger=logger, acks_late=True, bind=True)
 def toggle_read_email_message(self, email_id, read=True):
     """
@@ -427,17 +542,29 @@ def send_message(email_id, original_message_id=None, draft=False):
                 setattr(outbox_attachment, email_attachment_to_email_class_field_name, email)
                 outbox_attachment.tenant_id = original_attachment.message.tenant_id
 
-                file = default_storage._open(original_attachment.attachment.name)
-                file.open()
-                content = file.read()
-                file.close()
+                if not download_attachment(original_attachment):
+                    logger.error('Couldn\'t forward attachment %s, it couldn\'t be downloaded' % attachment_id)
+                    continue
+
+                if original_attachment.blob_id:
+                    # The content is stored already, so the attachment only has to reference it.
+                    outbox_attachment.attachment = original_attachment.attachment.name
+                    outbox_attachment.blob_id = original_attachment.blob_id
+                    outbox_attachment.filename = original_attachment.name
+                else:
+                    file = default_storage._open(original_attachment.attachment.name)
+                    file.open()
+                    content = file.read()
+                    file.close()
+
+                    file = ContentFile(content)
+                    file.name = original_attachment.attachment.name
 
-                file = ContentFile(content)
-                file.name = original_attachment.attachment.name
+                    outbox_attachment.attachment = file
 
-                outbox_attachment.attachment = file
+                outbox_attachment.content_type = original_attachment.content_type or ''
                 outbox_attachment.inline = original_attachment.inline
-                outbox_attachment.size = file.size
+                outbox_attachment.size = original_attachment.size
                 outbox_attachment.save()
 
     manager = None
@@ -652,37 +779,7 @@ def cleanup_deleted_email_accounts():
 
 @task(name='migrate_email_messages', trail=False, ignore_result=False)
 def migrate_email_messages():
-    messages = EmailMessage.objects.filter(
-        message_type__isnull=True
-    ).order_by()[0:100]
-
-    if messages:
-        logger.debug('Migrating the next %s messages.' % (len(messages)))
-        for message in messages:
-            try:
-                message_type, message_type_to_id = determine_message_type(
-                    message.thread_id,
-                    message.sent_date,
-                    message.account.email_address
-                )
-            except:
-                # If for some reason a message is not having a thread id, sent date or account with an email address,
-                # don't let the task fail. Just set the message type to the default type.
-                logger.debug("Failed to determine message type for %s" % (message.id))
-                message_type = EmailMessage.NORMAL
-
-            message.message_type = message_type
-            if message_type_to_id:
-                message.message_type_to_id = message_type_to_id
-
-            message.skip_signal = True  # Above fields aren't part of the search index, so skip the post_save signal.
-            message.save(
-                update_fields=[
-                    "message_type",
-                    "message_type_to_id"
-                ]
-            )
-
+    if classify_unclassified_threads(settings.MIGRATE_EMAIL_BATCH_SIZE):
         # There are possibly messages left to migrate, so add new batch in the queue. Process next batch with a delay
         # so there are resources for normal db usage.
         migrate_email_messages.apply_async(
@@ -1,14 +1,19 @@
 import json
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
 
+from django.test import override_settings
 from googleapiclient.discovery import build
-from googleapiclient.http import HttpMock
+from googleapiclient.http import HttpMock, HttpMockSequence
 from oauth2client.client import HttpAccessTokenRefreshError
 from rest_framework.test import APITestCase
 
 from lily.messaging.email.connector import GmailConnector, FailedServiceCallException
 from lily.messaging.email.factories import EmailAccountFactory
+from lily.messaging.email.mime import spool_email_message
 from lily.messaging.email.models.models import EmailAccount
-from lily.messaging.email.services import GmailService
+from lily.messaging.email.services import GmailService, gmail_service_pool
 from lily.tests.utils import UserBasedTest, get_dummy_credentials
 
 from mock import patch
@@ -286,6 +291,81 @@ class GmailConnectorTests(UserBasedTest, APITestCase):
         # Verify that the history id is not retrieved from the get API response.
         self.assertEqual(connector.history_id, None)
 
+    @patch.object(GmailService, '_get_http')
+    def test_get_message_info_batch(self, get_http_mock):
+        """
+        Test the GmailConnector in retrieving the info of multiple email messages with one batch request.
+        """
+        with open('lily/messaging/email/tests/data/get_message_info_15a6008a4baa65f3.json') as infile:
+            json_obj = json.load(infile)
+
+        # The second message is deleted from remote in the meantime.
+        batch_response = (
+            '--batch_foobarbaz\n'
+            'Content-Type: application/http\n'
+            'Content-Transfer-Encoding: binary\n'
+            'Content-ID: <response-randomness+15a6008a4baa65f3>\n'
+            '\n'
+            'HTTP/1.1 200 OK\n'
+            'Content-Type: application/json\r\n\r\n'
+            '%s\n'
+            '--batch_foobarbaz\n'
+            'Content-Type: application/http\n'
+            'Content-Transfer-Encoding: binary\n'
+            'Content-ID: <response-randomness+15a60025b255c626>\n'
+            '\n'
+            'HTTP/1.1 404 Not Found\n'
+            'Content-Type: application/json\r\n\r\n'
+            '{"error": {"code": 404, "message": "Not Found"}}\n'
+            '--batch_foobarbaz--'
+        ) % json.dumps(json_obj)
+
+        get_http_mock.return_value = HttpMockSequence([
+            ({'status': '200', 'content-type': 'multipart/mixed; boundary="batch_foobarbaz"'}, batch_response),
+        ])
+
+        email_account = EmailAccount.objects.first()
+
+        connector = GmailConnector(email_account)
+        response = connector.get_message_info_batch(['15a6008a4baa65f3', '15a60025b255c626'])
+
+        # Verify that only the message that still exists is returned, without falling back to single requests.
+        self.assertEqual(response, {'15a6008a4baa65f3': json_obj})
+
+    @patch.object(GmailConnector, 'backoff')
+    @patch.object(GmailConnector, 'get_message_info')
+    @patch.object(GmailService, '_get_http')
+    def test_get_message_info_batch_permanent_error(self, get_http_mock, get_message_info_mock, backoff_mock):
+        """
+        Test the GmailConnector in not retrying the batch for messages that failed on a permanent error.
+        """
+        batch_response = (
+            '--batch_foobarbaz\n'
+            'Content-Type: application/http\n'
+            'Content-Transfer-Encoding: binary\n'
+            'Content-ID: <response-randomness+15a6008a4baa65f3>\n'
+            '\n'
+            'HTTP/1.1 400 Bad Request\n'
+            'Content-Type: application/json\r\n\r\n'
+            '{"error": {"code": 400, "message": "Invalid id value"}}\n'
+            '--batch_foobarbaz--'
+        )
+
+        get_http_mock.return_value = HttpMockSequence([
+            ({'status': '200', 'content-type': 'multipart/mixed; boundary="batch_foobarbaz"'}, batch_response),
+        ])
+        get_message_info_mock.return_value = {'id': '15a6008a4baa65f3'}
+
+        email_account = EmailAccount.objects.first()
+
+        connector = GmailConnector(email_account)
+        response = connector.get_message_info_batch(['15a6008a4baa65f3'])
+
+        # Verify that the message is handed to the regular error handling right away.
+        backoff_mock.assert_not_called()
+        get_message_info_mock.assert_called_once_with('15a6008a4baa65f3')
+        self.assertEqual(response, {'15a6008a4baa65f3': {'id': '15a6008a4baa65f3'}})
+
     @patch.object(GmailService, '_get_http')
     def test_get_label_info(self, get_http_mock):
         """
@@ -450,6 +530,32 @@ per inceptos himenaeos. Ut aliquet elit sed augue bibendum malesuada.</body></ht
             json_obj = json.load(infile)
             self.assertEqual(response, json_obj)
 
+    @override_settings(GMAIL_RESUMABLE_UPLOAD_THRESHOLD=1024 * 1024, GMAIL_CHUNK_SIZE=256 * 1024)
+    def test_get_message_upload(self):
+        """
+        Test that only large messages are uploaded in resumable chunks.
+        """
+        email_message = MIMEMultipart()
+        email_message.attach(MIMEText('In hac habitasse platea dictumst.'))
+        message_file = spool_email_message(email_message)
+
+        connector = GmailConnector(EmailAccount.objects.first())
+
+        media = connector.get_message_upload(message_file)
+        self.assertFalse(media.resumable())
+        self.assertEqual(media.getbytes(0, media.size()), email_message.as_string())
+
+        # Strings are still accepted.
+        self.assertFalse(connector.get_message_upload(email_message.as_string()).resumable())
+
+        email_message.attach(MIMEApplication('0' * 2 * 1024 * 1024))
+        message_file = spool_email_message(email_message)
+
+        media = connector.get_message_upload(message_file)
+        self.assertTrue(media.resumable())
+        self.assertEqual(media.chunksize(), 256 * 1024)
+        self.assertEqual(media.getbytes(0, media.size()), email_message.as_string())
+
     @patch.object(GmailService, '_get_http')
     def test_send_email_message_reply(self, get_http_mock):
         """
@@ -551,3 +657,27 @@ per inceptos himenaeos. Ut aliquet elit sed augue bibendum malesuada.</body></ht
         self.assertIsNone(connector.gmail_service)
         self.assertIsNone(connector.email_account)
         self.assertIsNone(connector.history_id)
+
+    @override_settings(TESTING=False)
+    def test_cleanup_reuses_service(self):
+        """
+        Test if the GmailConnector returns the service to the pool for the next connector of the account.
+        """
+        self.addCleanup(gmail_service_pool.clear)
+
+        email_account = EmailAccount.objects.first()
+        connector = GmailConnector(email_account)
+        gmail_service = connector.gmail_service
+        connector.cleanup()
+
+        # The next connector with the same credentials gets the pooled service.
+        connector = GmailConnector(email_account)
+        self.assertIs(connector.gmail_service, gmail_service)
+        connector.cleanup()
+
+        # A service authorized with other credentials isn't reused.
+        with patch('lily.messaging.email.connector.get_credentials') as get_credentials_mock:
+            get_credentials_mock.return_value = get_dummy_credentials()
+            connector = GmailConnector(email_account)
+
+        self.assertIsNot(connector.gmail_service, gmail_service)
@@ -7,6 +7,7 @@ from rest_framework.test import APITestCase
 
 from lily.celery import app
 from lily.messaging.email.factories import EmailAccountFactory
+from lily.messaging.email.manager import GmailManager
 from lily.messaging.email.models.models import EmailAccount, EmailMessage, EmailOutboxMessage
 from lily.messaging.email.services import GmailService
 from lily.messaging.email.tasks import synchronize_email_account_scheduler, send_message
@@ -19,6 +20,14 @@ def get_mock(filename, status):
     return HttpMock('lily/messaging/email/tests/data/{}'.format(filename), {'status': status})
 
 
+def download_messages_one_by_one(manager, message_ids):
+    """
+    Replacement for GmailManager.download_messages, so the mocked API calls are consumed one message at a time.
+    """
+    for message_id in message_ids:
+        manager.download_message(message_id)
+
+
 class EmailTests(UserBasedTest, APITestCase):
     """
     Class for integrated email testing.
@@ -103,6 +112,10 @@ class EmailTests(UserBasedTest, APITestCase):
         build_service_mock = self.build_service_mock_patcher.start()
         build_service_mock.return_value = build('gmail', 'v1', credentials=credentials)
 
+        # The mocked API calls are single requests, so don't combine them in batch requests.
+        self.download_messages_patcher = patch.object(GmailManager, 'download_messages', download_messages_one_by_one)
+        self.download_messages_patcher.start()
+
         # Reset changes made to the email account in a test.
         self.email_account.refresh_from_db()
 
@@ -118,6 +131,7 @@ class EmailTests(UserBasedTest, APITestCase):
         self.get_credentials_mock_patcher.stop()
         self.authorize_mock_patcher.stop()
         self.build_service_mock_patcher.stop()
+        self.download_messages_patcher.stop()
 
     def test_full_synchronize_single_page_history(self):
         """
@@ -916,6 +930,10 @@ class EmailTests(UserBasedTest, APITestCase):
                         self.assertEqual(db_count_per_label_unread, label_data[2],
                                          "Number of unread messages for label %s was %d but should be %d." %
                                          (label_name, db_count_per_label_unread, label_data[2]))
+                        # The unread counter is maintained incrementally, so it should match the actual count.
+                        self.assertEqual(label.unread, db_count_per_label_unread,
+                                         "Unread counter for label %s was %d but should be %d." %
+                                         (label_name, label.unread, db_count_per_label_unread))
                     else:
                         self.assertEqual(0, label_data[1],
                                          "Total number of messages for label %s was %d but should be %d." % (
@@ -5,7 +5,7 @@ import anyjson
 from googleapiclient.discovery import build
 from rest_framework.test import APITestCase
 
-from lily.messaging.email.connector import GmailConnector
+from lily.messaging.email.connector import GmailConnector, LabelNotFoundError
 from lily.messaging.email.factories import EmailAccountFactory, EmailMessageFactory, EmailLabelFactory
 from lily.messaging.email.manager import GmailManager
 from lily.messaging.email.models.models import EmailAccount, EmailMessage, EmailLabel, EmailOutboxMessage
@@ -67,14 +67,19 @@ class GmailManagerTests(UserBasedTest, APITestCase):
         manager = GmailManager(email_account)
         manager.full_synchronize()
 
-        # Count the number of times the send_task mock was called to download a new message or to administer the
+        # Count the number of times the send_task mock was called to download new messages or to administer the
         # synchronization finished.
-        call_download_email_message_count = sum(
-            call[0][0] == 'download_email_message' for call in send_task_mock.call_args_list)
+        download_email_messages_calls = [
+            call for call in send_task_mock.call_args_list if call[0][0] == 'download_email_messages']
         call_full_sync_finished_count = sum(
             call[0][0] == 'full_sync_finished' for call in send_task_mock.call_args_list)
 
-        self.assertEqual(call_download_email_message_count, len(messages))
+        # All new messages fit in one batch, so they are downloaded by a single task.
+        self.assertEqual(len(download_email_messages_calls), 1)
+        self.assertEqual(
+            download_email_messages_calls[0][1]['args'][1],
+            [message['id'] for message in messages]
+        )
         self.assertEqual(call_full_sync_finished_count, 1)
 
     @patch.object(GmailConnector, 'get_message_info')
@@ -106,6 +111,45 @@ class GmailManagerTests(UserBasedTest, APITestCase):
         email_message_labels = set(email_message.labels.all().values_list('label_id', flat=True))
         self.assertEqual(email_message_labels, set([settings.GMAIL_LABEL_UNREAD, settings.GMAIL_LABEL_INBOX]))
 
+    @patch.object(GmailConnector, 'get_message_info_batch')
+    def test_download_messages(self, get_message_info_batch_mock):
+        """
+        Test the GmailManager on downloading multiple messages with one batch call and storing them in the database.
+        """
+        message_ids = ['15a6008a4baa65f3', '15a600543e10c8e4', '15a60053dea565fa']
+        deleted_message_id = '15a60044bb3e2a7a'
+
+        message_infos = {}
+        for message_id in message_ids:
+            with open('lily/messaging/email/tests/data/get_message_info_{0}.json'.format(message_id)) as infile:
+                message_infos[message_id] = json.load(infile)
+        get_message_info_batch_mock.return_value = message_infos
+
+        email_account = EmailAccount.objects.first()
+
+        labels = [settings.GMAIL_LABEL_UNREAD, settings.GMAIL_LABEL_INBOX]
+        for label in labels:
+            EmailLabelFactory.create(account=email_account, label_id=label)
+
+        manager = GmailManager(email_account)
+        # The deleted message isn't present in the batch response.
+        manager.download_messages(message_ids + [deleted_message_id])
+
+        get_message_info_batch_mock.assert_called_once_with(message_ids + [deleted_message_id])
+
+        # Verify that the email messages are stored in the db.
+        self.assertEqual(
+            set(EmailMessage.objects.filter(account=email_account).values_list('message_id', flat=True)),
+            set(message_ids)
+        )
+
+        # Verify that the relations are created in bulk as well.
+        email_message = EmailMessage.objects.get(account=email_account, message_id=message_ids[0])
+        email_message_labels = set(email_message.labels.all().values_list('label_id', flat=True))
+        self.assertEqual(email_message_labels, set([settings.GMAIL_LABEL_UNREAD, settings.GMAIL_LABEL_INBOX]))
+        self.assertTrue(email_message.received_by.exists())
+        self.assertIsNotNone(email_message.sender_id)
+
     @patch.object(GmailConnector, 'get_labels_and_thread_id_for_message_id')
     @patch.object(GmailConnector, 'get_message_info')
     def test_download_message_exists(self, get_message_info_mock, get_labels_and_thread_id_for_message_id_mock):
@@ -127,6 +171,7 @@ class GmailManagerTests(UserBasedTest, APITestCase):
 
         # Message isn't present in the db, so it will do a mocked API call.
         manager.download_message(message_id)
+        rendered_body_html = EmailMessage.objects.get(account=email_account, message_id=message_id).rendered_body_html
 
         # The message with labels is now present in the database so downloading it again will only update it's labels.
         with open('lily/messaging/email/tests/data/get_labels_and_thread_id_for_message_id_{0}_archived.json'.format(
@@ -146,6 +191,80 @@ class GmailManagerTests(UserBasedTest, APITestCase):
         email_message_labels = set(email_message.labels.all().values_list('label_id', flat=True))
         self.assertEqual(email_message_labels, set([settings.GMAIL_LABEL_UNREAD]))
 
+        # Updating the labels leaves the rendered body as it is.
+        self.assertEqual(email_message.rendered_body_html, rendered_body_html)
+
+    @patch.object(GmailConnector, 'get_message_ids_for_label')
+    def test_reconcile_labels(self, get_message_ids_for_label_mock):
+        """
+        Test the GmailManager on updating the labels of existing messages by listing the messages per label.
+        """
+        email_account = EmailAccount.objects.first()
+        manager = GmailManager(email_account)
+
+        inbox_label = EmailLabelFactory.create(account=email_account, label_id=settings.GMAIL_LABEL_INBOX, unread=1)
+        unread_label = EmailLabelFactory.create(account=email_account, label_id=settings.GMAIL_LABEL_UNREAD, unread=1)
+        user_label = EmailLabelFactory.create(account=email_account, label_id='Label_1', unread=0)
+        removed_label = EmailLabelFactory.create(account=email_account, label_id='Label_2', unread=0)
+
+        # An unread inbox message that is read and archived in Gmail.
+        archived_message = EmailMessageFactory.create(
+            account=email_account,
+            thread_id='thread-1',
+            read=False,
+            is_inbox_message=True,
+        )
+        archived_message.labels.add(inbox_label, unread_label)
+
+        # A read message that is labeled, marked as unread and moved to another thread in Gmail.
+        labeled_message = EmailMessageFactory.create(
+            account=email_account,
+            thread_id='thread-2',
+            read=True,
+            is_inbox_message=True,
+        )
+        labeled_message.labels.add(inbox_label)
+
+        # A label that was removed in Gmail in the meantime is skipped.
+        labeled_message.labels.add(removed_label)
+
+        def get_message_ids_for_label(label_id):
+            if label_id == 'Label_2':
+                raise LabelNotFoundError
+            return {
+                settings.GMAIL_LABEL_INBOX: {labeled_message.message_id, 'not-downloaded'},
+                settings.GMAIL_LABEL_UNREAD: {labeled_message.message_id},
+                'Label_1': {labeled_message.message_id},
+            }.get(label_id, set())
+
+        get_message_ids_for_label_mock.side_effect = get_message_ids_for_label
+
+        manager.reconcile_labels({
+            archived_message.message_id: 'thread-1',
+            labeled_message.message_id: 'thread-3',
+        })
+
+        archived_message = EmailMessage.objects.get(pk=archived_message.pk)
+        self.assertTrue(archived_message.read)
+        self.assertFalse(archived_message.is_inbox_message)
+        self.assertEqual(archived_message.thread_id, 'thread-1')
+        self.assertFalse(archived_message.labels.exists())
+
+        labeled_message = EmailMessage.objects.get(pk=labeled_message.pk)
+        self.assertFalse(labeled_message.read)
+        self.assertTrue(labeled_message.is_inbox_message)
+        self.assertEqual(labeled_message.thread_id, 'thread-3')
+        self.assertEqual(
+            set(labeled_message.labels.values_list('label_id', flat=True)),
+            {settings.GMAIL_LABEL_INBOX, settings.GMAIL_LABEL_UNREAD, 'Label_1', 'Label_2'}
+        )
+
+        # The unread counters are adjusted by the changes.
+        self.assertEqual(EmailLabel.objects.get(pk=user_label.pk).unread, 1)
+        self.assertEqual(EmailLabel.objects.get(pk=inbox_label.pk).unread, 1)
+        self.assertEqual(EmailLabel.objects.get(pk=unread_label.pk).unread, 1)
+        self.assertEqual(EmailLabel.objects.get(pk=removed_label.pk).unread, 1)
+
     @patch.object(GmailConnector, 'get_label_list')
     def test_sync_labels(self, get_label_list_mock):
         """
@@ -250,6 +369,27 @@ class GmailManagerTests(UserBasedTest, APITestCase):
             # Because the label is already in the database it should not do a (mocked) API call again.
             self.fail('StopIteration should have been raised.')
 
+    @patch.object(GmailConnector, 'get_label_info')
+    def test_label_registry(self, get_label_info_mock):
+        """
+        Test that the labels are loaded once per manager and reloaded after the labels are synchronized.
+        """
+        email_account = EmailAccount.objects.first()
+        EmailLabelFactory.create(account=email_account, label_id=settings.GMAIL_LABEL_INBOX)
+        EmailLabelFactory.create(account=email_account, label_id=settings.GMAIL_LABEL_UNREAD)
+        manager = GmailManager(email_account)
+
+        with self.assertNumQueries(1):
+            manager.get_label(settings.GMAIL_LABEL_INBOX)
+            manager.get_label(settings.GMAIL_LABEL_UNREAD)
+            manager.get_label(settings.GMAIL_LABEL_INBOX)
+
+        get_label_info_mock.assert_not_called()
+
+        manager.label_registry.invalidate()
+        with self.assertNumQueries(1):
+            manager.get_label(settings.GMAIL_LABEL_INBOX)
+
     def test_administer_sync_status_true(self):
         """
         Test the GmailManager on setting the full sync status to in progress on the email account.
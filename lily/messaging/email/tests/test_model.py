@@ -5,7 +5,9 @@ from rest_framework.test import APITestCase
 from lily.messaging.email.factories import EmailAccountFactory, EmailMessageFactory
 from lily.messaging.email.models.models import EmailLabel, EmailHeader, EmailAccount, EmailOutboxMessage, EmailDraft
 
-from lily.messaging.email.utils import get_filtered_message
+from lily.messaging.email.utils import (
+    filter_email_messages_by_privacy, get_email_account_privacy_map, get_filtered_message
+)
 from lily.settings import settings
 from lily.tenant.factories import TenantFactory
 from lily.tests.utils import UserBasedTest, EmailBasedTest
@@ -385,6 +387,67 @@ class EmailAccountTests(UserBasedTest, APITestCase):
             else:
                 self.assertEqual(filtered_messages, [])
 
+    def test_filter_email_messages_by_privacy(self):
+        """
+        Test if filtering the email messages in the database gives the same result as filtering them one by one.
+        """
+        # Filtering in the database is restricted to the tenant of the user.
+        users = LilyUserFactory.create_batch(size=3, tenant=self.tenant)
+
+        for privacy in [EmailAccount.PUBLIC, EmailAccount.METADATA, EmailAccount.PRIVATE]:
+            email_account = EmailAccountFactory.create(tenant=self.tenant, privacy=privacy, owner=users[0])
+            # Share the email account with a user.
+            config = {
+                'user': users[1],
+                'email_account': email_account,
+                'privacy': EmailAccount.PUBLIC,
+                'tenant': self.tenant,
+            }
+            email_account.sharedemailconfig_set.create(**config)
+
+            email_messages = EmailMessageFactory.create_batch(account=email_account, size=5)
+
+            for user in users:
+                queryset = filter_email_messages_by_privacy(user).filter(account=email_account)
+
+                expected_messages = {}
+                for email_message in email_messages:
+                    filtered_message = get_filtered_message(email_message, email_account, user)
+
+                    if filtered_message:
+                        # Metadata only messages are returned as a dict.
+                        expected_messages[email_message.id] = isinstance(filtered_message, dict)
+
+                self.assertEqual(
+                    {message.id: message.effective_privacy == EmailAccount.METADATA for message in queryset},
+                    expected_messages
+                )
+
+    def test_get_email_account_privacy_map(self):
+        """
+        Test if the privacy map contains the effective privacy of every active email account for the user.
+        """
+        users = LilyUserFactory.create_batch(size=2, tenant=self.tenant)
+
+        public_account = EmailAccountFactory.create(tenant=self.tenant, privacy=EmailAccount.PUBLIC, owner=users[0])
+        shared_account = EmailAccountFactory.create(tenant=self.tenant, privacy=EmailAccount.PRIVATE, owner=users[0])
+        shared_account.sharedemailconfig_set.create(
+            user=users[1],
+            privacy=EmailAccount.METADATA,
+            tenant=self.tenant
+        )
+        inactive_account = EmailAccountFactory.create(tenant=self.tenant, is_active=False, owner=users[0])
+
+        self.assertEqual(get_email_account_privacy_map(users[0]), {
+            public_account.id: EmailAccount.PUBLIC,
+            shared_account.id: EmailAccount.PUBLIC,
+        })
+        self.assertEqual(get_email_account_privacy_map(users[1]), {
+            public_account.id: EmailAccount.PUBLIC,
+            shared_account.id: EmailAccount.METADATA,
+        })
+        self.assertNotIn(inactive_account.id, get_email_account_privacy_map(users[1]))
+
     def _can_view_full_message(self, email_account, user):
         shared_config = email_account.sharedemailconfig_set.filter(user=user).first()
 
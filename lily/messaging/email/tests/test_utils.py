@@ -1,11 +1,23 @@
 import json
-from django.test import TestCase
+from datetime import timedelta
+
+from django.core.files.base import ContentFile
+from django.test import TestCase, override_settings
 
 from googleapiclient.discovery import build
 from lily.tests.utils import UserBasedTest, EmailBasedTest, get_dummy_credentials
 from lily.messaging.email.services import GmailService
-from lily.messaging.email.connector import GmailConnector
-from lily.messaging.email.utils import get_formatted_email_body, get_formatted_reply_email_subject
+from lily.messaging.email.connector import FailedServiceCallException, GmailConnector, NotFoundError
+from django.urls import reverse
+from lily.messaging.email.models.models import (
+    AttachmentBlob, EmailAccount, EmailAttachment, EmailLabel, EmailMessage, Recipient
+)
+from lily.messaging.email.utils import (
+    EMAIL_BODY_RENDER_VERSION, adjust_unread_counts, classify_threads, collect_attachment_blobs, delete_email_messages,
+    download_attachment, get_formatted_email_body, get_formatted_reply_email_subject, reconcile_unread_counts,
+    render_email_message_body
+)
+from lily.messaging.email.views import parse_range_header
 from lily.messaging.email.builders.utils import get_attachments_from_payload, get_body_html_from_payload
 from mock import patch
 
@@ -58,7 +70,7 @@ class EmailUtilsTestCase(UserBasedTest, EmailBasedTest, TestCase):
         payload = message_info['payload']
 
         body_html = get_body_html_from_payload(payload, message_id)
-        attachments = get_attachments_from_payload(payload, body_html, message_id, connector)
+        attachments = get_attachments_from_payload(payload, body_html, message_id, connector, lazy=False)
         self.email_message.attachments.add(bulk=False, *attachments)
 
         get_message_info_mock.assert_called_once()
@@ -79,7 +91,7 @@ class EmailUtilsTestCase(UserBasedTest, EmailBasedTest, TestCase):
         payload = message_info['payload']
 
         body_html = get_body_html_from_payload(payload, message_id)
-        attachments = get_attachments_from_payload(payload, body_html, message_id, connector)
+        attachments = get_attachments_from_payload(payload, body_html, message_id, connector, lazy=False)
 
         get_message_info_mock.assert_called_once()
         get_attachment_mock.assert_called_once()
@@ -89,6 +101,84 @@ class EmailUtilsTestCase(UserBasedTest, EmailBasedTest, TestCase):
         self.assertEqual(len(attachments), 1)
         self.assertTrue(attachments[0].inline)
 
+    @patch.object(GmailConnector, 'get_attachment')
+    @patch.object(GmailConnector, 'get_message_info')
+    def test_extracting_lazy_attachment(self, get_message_info_mock, get_attachment_mock):
+        message_id = '16740205f39700d1'
+        self.mock_get_message_info(get_message_info_mock, message_id)
+        self.mock_get_attachment(get_attachment_mock, message_id)
+
+        connector = GmailConnector(self.email_account)
+        message_info = connector.get_message_info(message_id)
+
+        payload = message_info['payload']
+
+        body_html = get_body_html_from_payload(payload, message_id)
+        attachments = get_attachments_from_payload(payload, body_html, message_id, connector, lazy=True)
+        self.email_message.attachments.add(bulk=False, *attachments)
+
+        # The file isn't downloaded while syncing.
+        get_attachment_mock.assert_not_called()
+        self.assertEqual(len(attachments), 1)
+
+        attachment = attachments[0]
+        self.assertFalse(attachment.is_downloaded)
+        self.assertTrue(attachment.gmail_attachment_id)
+        self.assertEqual(attachment.name, attachment.filename)
+
+        # But on first use.
+        self.assertTrue(download_attachment(attachment))
+        get_attachment_mock.assert_called_once()
+
+        attachment.refresh_from_db()
+        self.assertTrue(attachment.is_downloaded)
+        self.assertEqual(attachment.name, attachment.filename)
+
+        # And only once.
+        self.assertTrue(download_attachment(attachment))
+        get_attachment_mock.assert_called_once()
+
+    @patch.object(GmailConnector, 'get_attachment')
+    def test_download_attachment_failure(self, get_attachment_mock):
+        """
+        Test that an attachment that can't be downloaded from Gmail is reported as missing instead of raising.
+        """
+        attachment = EmailAttachment.objects.create(
+            message=self.email_message,
+            gmail_attachment_id='ANGjdJ8',
+        )
+
+        for error in (NotFoundError, FailedServiceCallException):
+            get_attachment_mock.side_effect = error
+            self.assertFalse(download_attachment(attachment, retry=False))
+
+        attachment.refresh_from_db()
+        self.assertFalse(attachment.is_downloaded)
+
+    def test_attachment_blobs(self):
+        attachments = []
+        for filename in ('logo.png', 'image.png'):
+            attachment = EmailAttachment(message=self.email_message, content_type='image/png')
+            attachment.attachment = ContentFile('logo', name=filename)
+            attachment.save()
+            attachments.append(attachment)
+
+        first, second = attachments
+
+        # The content is only stored once, but the attachments keep their own names.
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(first.attachment.name, second.attachment.name)
+        self.assertEqual(first.name, 'logo.png')
+        self.assertEqual(second.name, 'image.png')
+        self.assertEqual(AttachmentBlob.objects.get(pk=first.blob_id).references, 2)
+
+        first.delete()
+        self.assertEqual(collect_attachment_blobs(10), 0)
+
+        second.delete()
+        self.assertEqual(collect_attachment_blobs(10), 1)
+        self.assertFalse(AttachmentBlob.objects.filter(pk=first.blob_id).exists())
+
     def get_expected_email_body_parts(self, subject='Simple Subject',
                                       recipient='Simple Name &lt;someuser@example.com&gt;'):
         expected_body_html_part_one = unicode(
@@ -165,3 +255,168 @@ class EmailUtilsTestCase(UserBasedTest, EmailBasedTest, TestCase):
     def test_get_formatted_reply_email_subject(self):
         subject = get_formatted_reply_email_subject(u'\u2265')
         self.assertEqual(u'Re: {}'.format(u'\u2265'), subject)
+
+    def test_render_email_message_body(self):
+        """
+        Test that the rendered body links the inline images and mailto links and is sanitized.
+        """
+        attachment = EmailAttachment.objects.create(
+            message=self.email_message,
+            attachment='messaging/email/attachments/image001.png',
+            cid='<image001>',
+            inline=True,
+        )
+        self.email_message.body_html = (
+            '<p>Hello <a href="mailto:user1@example.com">you</a></p>'
+            '<img src="cid:image001"><script>alert(1);</script>'
+        )
+
+        render_email_message_body(self.email_message, [attachment])
+        html = self.email_message.rendered_body_html
+
+        self.assertEqual(self.email_message.rendered_body_version, EMAIL_BODY_RENDER_VERSION)
+        self.assertIn('src="%s"' % reverse('email_attachment_proxy_view', kwargs={'pk': attachment.pk}), html)
+        self.assertIn('href="/#/email/compose/user1@example.com"', html)
+        self.assertNotIn('script', html)
+
+    def test_unread_counts(self):
+        """
+        Test that the unread counters are adjusted, never go negative and are fixed by the reconciliation.
+        """
+        inbox = EmailLabel.objects.create(account=self.email_account, label_id='INBOX', name='INBOX')
+        other = EmailLabel.objects.create(account=self.email_account, label_id='Label_1', name='Label 1', unread=5)
+        self.email_message.read = False
+        self.email_message.save()
+        self.email_message.labels.add(inbox)
+
+        adjust_unread_counts({inbox.pk: 2, other.pk: -10})
+        inbox.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(inbox.unread, 2)
+        self.assertEqual(other.unread, 0)
+
+        reconcile_unread_counts(self.email_account)
+        inbox.refresh_from_db()
+        self.assertEqual(inbox.unread, 1)
+
+        delete_email_messages(self.email_account.messages.filter(pk=self.email_message.pk))
+        inbox.refresh_from_db()
+        self.assertEqual(inbox.unread, 0)
+
+    def test_classify_threads(self):
+        """
+        Test that messages get the type of the first later message sent by the email account in the thread.
+        """
+        self.email_message.thread_id = 'thread'
+        self.email_message.save()
+        sender = Recipient.objects.create(name='Owner', email_address=self.email_account.email_address)
+        reply = EmailMessage.objects.create(
+            subject='Re: Simple Subject',
+            account=self.email_account,
+            thread_id='thread',
+            sent_date=self.email_message.sent_date + timedelta(hours=1),
+            sender=sender,
+        )
+        reply.received_by.add(self.email_message.sender)
+
+        with self.assertNumQueries(4):
+            self.assertEqual(classify_threads(self.email_account, ['thread']), 2)
+
+        self.email_message.refresh_from_db()
+        reply.refresh_from_db()
+        self.assertEqual(self.email_message.message_type, EmailMessage.REPLY)
+        self.assertEqual(self.email_message.message_type_to_id, reply.pk)
+        self.assertEqual(reply.message_type, EmailMessage.NORMAL)
+
+        # A forward to multiple people makes it a forward-multi, the thread is updated as a whole.
+        reply.subject = 'Fwd: Simple Subject'
+        reply.save()
+        reply.received_by_cc.add(Recipient.objects.create(name='Other', email_address='other@example.com'))
+        self.assertEqual(classify_threads(self.email_account, ['thread']), 1)
+        self.email_message.refresh_from_db()
+        self.assertEqual(self.email_message.message_type, EmailMessage.FORWARD_MULTI)
+
+    @patch('lily.messaging.email.utils.invalidate_email_account_privacy_map')
+    def test_privacy_map_invalidation(self, invalidate_mock):
+        """
+        Test that the cached privacy maps are only invalidated when the privacy of the email account changes.
+        """
+        email_account = EmailAccount.objects.get(pk=self.email_account.pk)
+
+        # Saving the sync status keeps the cached privacy maps.
+        email_account.history_id = 1234
+        email_account.save()
+        invalidate_mock.assert_not_called()
+
+        email_account.privacy = EmailAccount.PRIVATE
+        email_account.save()
+        invalidate_mock.assert_called_once_with(email_account.tenant_id)
+
+        # The saved privacy is the new reference.
+        email_account.is_syncing = True
+        email_account.save()
+        self.assertEqual(invalidate_mock.call_count, 1)
+
+
+class ParseRangeHeaderTestCase(TestCase):
+    def test_parse_range_header(self):
+        self.assertEqual(parse_range_header('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(parse_range_header('bytes=900-', 1000), (900, 999))
+        self.assertEqual(parse_range_header('bytes=-100', 1000), (900, 999))
+        # The end is limited to the size of the file.
+        self.assertEqual(parse_range_header('bytes=500-5000', 1000), (500, 999))
+        # Unsatisfiable ranges.
+        self.assertFalse(parse_range_header('bytes=1000-', 1000))
+        self.assertFalse(parse_range_header('bytes=200-100', 1000))
+        # Invalid and multiple ranges are ignored, so the whole file is sent.
+        self.assertIsNone(parse_range_header('bytes=-', 1000))
+        self.assertIsNone(parse_range_header('bytes=0-99,200-299', 1000))
+        self.assertIsNone(parse_range_header('items=0-99', 1000))
+
+
+@override_settings(EMAIL_ATTACHMENT_DELIVERY='proxy')
+class EmailAttachmentProxyTestCase(UserBasedTest, EmailBasedTest, TestCase):
+    def setUp(self):
+        super(EmailAttachmentProxyTestCase, self).setUp()
+        super(EmailAttachmentProxyTestCase, self).setupEmailMessage()
+
+        attachment = EmailAttachment(message=self.email_message, content_type='text/plain')
+        attachment.attachment = ContentFile('0123456789', name='numbers.txt')
+        attachment.save()
+
+        self.url = reverse('email_attachment_proxy_view', kwargs={'pk': attachment.pk})
+
+    def test_full_download(self):
+        response = self.user.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_range_request(self):
+        response = self.user.get(self.url, HTTP_RANGE='bytes=2-5')
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'2345')
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(response['Content-Length'], '4')
+
+        # A range of another version of the file is ignored, so the whole file is sent.
+        response = self.user.get(self.url, HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE='"outdated"')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+
+    def test_unsatisfiable_range(self):
+        response = self.user.get(self.url, HTTP_RANGE='bytes=20-')
+
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+
+    def test_not_modified(self):
+        etag = self.user.get(self.url)['ETag']
+
+        response = self.user.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
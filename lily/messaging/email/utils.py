@@ -1,3 +1,5 @@
+import base64
+import hashlib
 import logging
 import re
 import mimetypes
@@ -11,8 +13,15 @@ import html2text
 from urllib import unquote
 
 from django.apps import apps
+from django.db import IntegrityError, transaction
+from django.db.models import (
+    Case, Count, F, IntegerField, OuterRef, PositiveIntegerField, PositiveSmallIntegerField, Subquery, Value, When
+)
+from django.db.models.functions import Coalesce, Greatest
 from django.db.models.query_utils import Q
 from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
 from django.urls import reverse
 from django.template import Context
@@ -23,13 +32,20 @@ from django.utils.safestring import mark_safe
 
 from jinja2.sandbox import SandboxedEnvironment
 from jinja2 import TemplateSyntaxError
+from googleapiclient.errors import HttpError
+from oauth2client.client import HttpAccessTokenRefreshError
 
 from lily.accounts.models import Account
 from lily.contacts.models import Contact
 from lily.search.scan_search import ModelMappings
-from lily.search.indexing import update_in_index
-
-from .models.models import EmailAttachment, EmailMessage, EmailAccount, SharedEmailConfig
+from lily.search.index_queue import deferred_indexing, enqueue_index
+from lily.utils.functions import chunks
+
+from .credentials import InvalidCredentialsError
+from .models.models import (
+    AttachmentBlob, EmailAttachment, EmailDraftAttachment, EmailLabel, EmailMessage, EmailAccount,
+    EmailOutboxAttachment, SharedEmailConfig, get_attachment_blob_upload_path
+)
 from .sanitize import sanitize_html_email
 
 _EMAIL_PARAMETER_DICT = {}
@@ -46,6 +62,12 @@ SENT = '\\Sent'
 SPAM = '\\Spam'
 TRASH = '\\Trash'
 
+EMAIL_ACCOUNT_PRIVACY_MAP_KEY = 'email_account_privacy:%(tenant)s:%(version)s:%(user)s:%(plan)s'
+EMAIL_ACCOUNT_PRIVACY_VERSION_KEY = 'email_account_privacy_version:%s'
+
+# Increase when the rendering of email bodies changes (e.g. the sanitizer), so stored bodies are rendered again.
+EMAIL_BODY_RENDER_VERSION = 1
+
 
 def get_field_names(field):
     """
@@ -232,7 +254,167 @@ def get_attachment_filename_from_url(url):
     return unquote(url).split('/')[-1]
 
 
-def render_email_body(html, mapped_attachments, request):
+def download_attachment(attachment, retry=True):
+    """
+    Download the file of an attachment that was synced without it and store it.
+
+    Args:
+        attachment (EmailAttachment): the attachment to download the file for
+        retry (bool, optional): wait and retry when Gmail fails on a transient error, turn off in web requests
+
+    Returns:
+        bool: True if the attachment has its file
+    """
+    from .connector import FailedServiceCallException, GmailConnector, NotFoundError
+
+    if attachment.is_downloaded:
+        return True
+
+    if not attachment.gmail_attachment_id:
+        logger.warning('Attachment %s has no file and can\'t be downloaded' % attachment.pk)
+        return False
+
+    message = attachment.message
+    try:
+        connector = GmailConnector(message.account, retry=retry)
+    except InvalidCredentialsError:
+        logger.warning('Attachment %s can\'t be downloaded, the account has no valid credentials' % attachment.pk)
+        return False
+
+    try:
+        response = connector.get_attachment(message.message_id, attachment.gmail_attachment_id)
+    except (NotFoundError, FailedServiceCallException, HttpError, HttpAccessTokenRefreshError) as e:
+        logger.warning('Attachment %s couldn\'t be downloaded from Gmail: %s' % (attachment.pk, e))
+        return False
+    finally:
+        connector.cleanup()
+
+    if not response or 'data' not in response:
+        logger.warning('Attachment %s couldn\'t be downloaded from Gmail' % attachment.pk)
+        return False
+
+    content = base64.urlsafe_b64decode(response['data'].encode('UTF-8'))
+    blob = store_attachment_blob(message.tenant_id, ContentFile(content))
+
+    # Another request could have downloaded the attachment in the meantime, only keep one reference.
+    updated = EmailAttachment.objects.filter(pk=attachment.pk, attachment='').update(
+        attachment=blob.file.name,
+        blob=blob,
+        size=blob.size,
+    )
+    if updated:
+        attachment.attachment = blob.file.name
+        attachment.blob = blob
+        attachment.size = blob.size
+    else:
+        release_attachment_blob(blob.pk)
+        attachment.refresh_from_db()
+
+    return attachment.is_downloaded
+
+
+def get_file_digest(file):
+    """
+    Return the SHA-256 digest of the content of the file, read in chunks so large files aren't loaded at once.
+    """
+    digest = hashlib.sha256()
+
+    file.seek(0)
+    for chunk in file.chunks():
+        digest.update(chunk)
+    file.seek(0)
+
+    return digest.hexdigest()
+
+
+def store_attachment_blob(tenant_id, file):
+    """
+    Return the blob with the content of the file, with a new reference to it.
+
+    The file is only stored when the tenant doesn't have a blob with the same content yet.
+
+    Args:
+        tenant_id (int): the tenant of the attachment
+        file (File): the content of the attachment
+
+    Returns:
+        AttachmentBlob
+    """
+    digest = get_file_digest(file)
+    blobs = AttachmentBlob._base_manager.filter(tenant_id=tenant_id, digest=digest)
+
+    blob = None
+    try:
+        with transaction.atomic():
+            # Most of the time the content is stored already, so only add a reference.
+            if blobs.filter(references__gt=0).update(references=F('references') + 1):
+                return blobs.get()
+
+            # Without references the blob could have lost its file to the garbage collection, so check it's there.
+            blob = blobs.select_for_update().first() or AttachmentBlob(tenant_id=tenant_id, digest=digest)
+            if not blob.file or not blob.file.storage.exists(blob.file.name):
+                blob.file.save(digest, file, save=False)
+            blob.size = file.size
+            blob.references = 1
+            blob.save()
+    except IntegrityError:
+        # Stored by another process at the same time, remove the extra file if it didn't overwrite theirs.
+        if blob and blob.file.name != get_attachment_blob_upload_path(blob, digest):
+            blob.file.delete(save=False)
+
+        return store_attachment_blob(tenant_id, file)
+
+    return blob
+
+
+def reference_attachment_blob(blob_id):
+    """
+    Add a reference to a blob, for an attachment that's copied from another attachment.
+    """
+    AttachmentBlob._base_manager.filter(pk=blob_id).update(references=F('references') + 1)
+
+
+def release_attachment_blob(blob_id):
+    """
+    Remove a reference to a blob, the blob is garbage collected once it has no references.
+    """
+    AttachmentBlob._base_manager.filter(pk=blob_id, references__gt=0).update(references=F('references') - 1)
+
+
+def collect_attachment_blobs(batch_size):
+    """
+    Delete the blobs that aren't referenced anymore, together with their files.
+
+    Args:
+        batch_size (int): the maximum number of blobs to delete
+
+    Returns:
+        int: the number of deleted blobs
+    """
+    attachment_models = (EmailAttachment, EmailOutboxAttachment, EmailDraftAttachment)
+    collected = 0
+
+    with transaction.atomic():
+        # Locked blobs are being referenced again, so skip them.
+        blobs = AttachmentBlob._base_manager.select_for_update(skip_locked=True).filter(references=0)
+
+        for blob in blobs[:batch_size]:
+            references = sum(model._base_manager.filter(blob=blob).count() for model in attachment_models)
+            if references:
+                # The count drifted, fix it instead of deleting content that's still in use.
+                logger.warning('Blob %s has %s unaccounted references' % (blob.pk, references))
+                AttachmentBlob._base_manager.filter(pk=blob.pk).update(references=references)
+                continue
+
+            # Delete the file while the blob is locked, so it can't be stored again in the meantime.
+            blob.file.delete(save=False)
+            blob.delete()
+            collected += 1
+
+    return collected
+
+
+def render_email_body(html, mapped_attachments, request=None):
     """
     Update all the target attributes in the <a> tag.
     After that replace the cid information in the html.
@@ -240,7 +422,7 @@ def render_email_body(html, mapped_attachments, request):
     Args:
         html (string): HTML string of the email body to be sent.
         mapped_attachments (list): List of linked attachments to the email.
-        request (instance): The Django request.
+        request (instance, optional): The Django request, used to link the images with absolute urls.
 
     Returns:
         html body (string)
@@ -255,14 +437,28 @@ def render_email_body(html, mapped_attachments, request):
     return email_body
 
 
-def replace_cid_in_html(html, mapped_attachments, request):
+def render_email_message_body(email_message, attachments):
+    """
+    Render the html body of the email message as it's displayed and store it on the message, without saving.
+
+    Rendering large html bodies is slow, so it's done once when the message is stored instead of on every view.
+
+    Args:
+        email_message (EmailMessage): the message to render the body of
+        attachments (list): the saved attachments of the message
+    """
+    email_message.rendered_body_html = render_email_body(email_message.body_html, attachments) or ''
+    email_message.rendered_body_version = EMAIL_BODY_RENDER_VERSION
+
+
+def replace_cid_in_html(html, mapped_attachments, request=None):
     """
     Replace all the cid image information with a link to the image
 
     Args:
         html (string): HTML string of the email body to be sent.
         mapped_attachments (list): List of linked attachments to the email.
-        request (instance): The Django request.
+        request (instance, optional): The Django request, the links are relative if not given.
 
     Returns:
         html body (string)
@@ -281,10 +477,12 @@ def replace_cid_in_html(html, mapped_attachments, request):
         html = sanitize_html_email(html)
         return html
 
-    protocol = 'http'
-    if request.is_secure():
-        protocol = 'https'
-    host = request.META['HTTP_HOST']
+    url_prefix = ''
+    if request:
+        protocol = 'http'
+        if request.is_secure():
+            protocol = 'https'
+        url_prefix = '%s://%s' % (protocol, request.META['HTTP_HOST'])
 
     for image in inline_images:
         image_cid = image.get('src')[4:]
@@ -292,7 +490,7 @@ def replace_cid_in_html(html, mapped_attachments, request):
         for attachment in mapped_attachments:
             if (attachment.cid[1:-1] == image_cid or attachment.cid == image_cid) and attachment.cid not in cid_done:
                 proxy_url = reverse('email_attachment_proxy_view', kwargs={'pk': attachment.pk})
-                image['src'] = '%s://%s%s' % (protocol, host, proxy_url)
+                image['src'] = url_prefix + proxy_url
                 image['cid'] = image_cid
                 cid_done.append(attachment.cid)
 
@@ -344,12 +542,17 @@ def replace_cid_and_change_headers(html, pk):
 
             for file in attachments:
                 if (file.cid[1:-1] == image_cid or file.cid == image_cid) and file.cid not in cid_done:
+                    if not download_attachment(file):
+                        continue
+
                     image['src'] = "cid:%s" % image_cid
 
                     storage_file = default_storage._open(file.attachment.name)
-                    filename = get_attachment_filename_from_url(file.attachment.name)
+                    filename = get_attachment_filename_from_url(file.name)
 
-                    if hasattr(storage_file, 'key'):
+                    if file.content_type:
+                        content_type = file.content_type
+                    elif hasattr(storage_file, 'key'):
                         content_type = storage_file.key.content_type
                     else:
                         content_type = mimetypes.guess_type(storage_file.file.name)[0]
@@ -421,7 +624,7 @@ def create_a_beautiful_soup_object(html):
 
 def replace_anchors_in_html(html):
     """
-    Make all anchors open outside the iframe.
+    Make all anchors open outside the iframe and let mailto links compose an email within Lily.
     """
     if html is None:
         return None
@@ -437,6 +640,11 @@ def replace_anchors_in_html(html):
             'rel': 'noopener noreferrer',
         })
 
+        href = anchor.get('href')
+        if href and href.startswith('mailto:'):
+            anchor['href'] = href.replace('mailto:', '/#/email/compose/')
+            anchor['target'] = '_top'  # Break out of iframe.
+
     return soup.encode_contents()
 
 
@@ -549,7 +757,87 @@ def reindex_email_message(instance):
         return
     mapping = ModelMappings.model_to_mappings.get(type(instance))
     if mapping:
-        update_in_index(instance, mapping)
+        enqueue_index(mapping, instance.pk)
+
+
+def reindex_email_messages(email_message_ids):
+    """
+    Re-index the email messages with the given ids, for changes made with a queryset update that sends no signals.
+
+    Args:
+        email_message_ids (iterable): ids of the EmailMessages
+    """
+    if settings.ES_DISABLED:
+        return
+    mapping = ModelMappings.model_to_mappings.get(EmailMessage)
+    if mapping:
+        with deferred_indexing():
+            for email_message_id in email_message_ids:
+                enqueue_index(mapping, email_message_id)
+
+
+def get_unread_counts(email_messages):
+    """
+    Count the unread messages per label.
+
+    Args:
+        email_messages (queryset): the EmailMessages to count
+
+    Returns:
+        dict: the number of unread messages by EmailLabel pk
+    """
+    rows = EmailMessage.labels.through.objects.filter(
+        emailmessage__in=email_messages.filter(read=False).order_by().values('pk'),
+    ).values('emaillabel_id').annotate(count=Count('id')).order_by()
+
+    return {row['emaillabel_id']: row['count'] for row in rows}
+
+
+def adjust_unread_counts(deltas):
+    """
+    Atomically adjust the unread counters of labels, with one query for all labels with the same change.
+
+    Args:
+        deltas (dict): the change of the number of unread messages by EmailLabel pk
+    """
+    label_ids_by_delta = {}
+    for label_id, delta in deltas.items():
+        if delta:
+            label_ids_by_delta.setdefault(delta, []).append(label_id)
+
+    for delta, label_ids in label_ids_by_delta.items():
+        # Counters can drift until the next reconciliation, so don't let them go negative.
+        EmailLabel.objects.filter(pk__in=label_ids).update(unread=Greatest(F('unread') + delta, 0))
+
+
+def delete_email_messages(email_messages):
+    """
+    Delete EmailMessages and remove the unread ones from the unread counters of their labels.
+
+    Args:
+        email_messages (queryset): the EmailMessages to delete
+    """
+    with transaction.atomic():
+        adjust_unread_counts({
+            label_id: -count for label_id, count in get_unread_counts(email_messages).items()
+        })
+        email_messages.order_by().delete()
+
+
+def reconcile_unread_counts(email_account):
+    """
+    Recount the unread messages of all labels of the email account, to fix counters that drifted.
+
+    Args:
+        email_account (instance): EmailAccount instance
+    """
+    unread_counts = get_unread_counts(EmailMessage.objects.filter(account=email_account))
+
+    for label in EmailLabel.objects.filter(account=email_account):
+        unread = unread_counts.get(label.pk, 0)
+        if label.unread != unread:
+            logger.info('Unread count of label %s drifted, corrected from %s to %s' % (label.pk, label.unread, unread))
+            EmailLabel.objects.filter(pk=label.pk).update(unread=unread)
 
 
 def fullpath(filename):
@@ -592,6 +880,116 @@ def get_filtered_message(email_message, email_account, user):
     return email_message
 
 
+def filter_email_messages_by_privacy(user, queryset=None):
+    """
+    Restrict the email messages to the ones the user is allowed to see, in the database instead of per message.
+
+    Every message is annotated with the effective privacy for the user, which is what get_filtered_message determines
+    for a single message: public for the owner, otherwise the privacy of the shared config for the user or else the
+    privacy of the email account. Private messages are excluded.
+
+    Args:
+        user (LilyUser): the user viewing the messages
+        queryset (QuerySet, optional): the email messages to filter, defaults to all email messages
+
+    Returns:
+        QuerySet: email messages annotated with effective_privacy
+    """
+    if queryset is None:
+        queryset = EmailMessage.objects.all()
+
+    email_accounts = get_shared_email_accounts(user, only_public=False)
+
+    shared_privacy = SharedEmailConfig.objects.filter(
+        email_account=OuterRef('account'),
+        user=user,
+    ).values('privacy')[:1]
+
+    return queryset.filter(
+        account__in=email_accounts.values('id'),
+    ).annotate(
+        effective_privacy=Case(
+            When(account__owner=user, then=Value(EmailAccount.PUBLIC)),
+            default=Coalesce(Subquery(shared_privacy, output_field=IntegerField()), F('account__privacy')),
+            output_field=IntegerField(),
+        ),
+    ).exclude(
+        effective_privacy=EmailAccount.PRIVATE,
+    )
+
+
+def _get_privacy_map_version(tenant_id):
+    return cache.get(EMAIL_ACCOUNT_PRIVACY_VERSION_KEY % tenant_id, 0)
+
+
+def get_email_account_privacy_map(user):
+    """
+    Return the effective privacy of every active email account for the user.
+
+    The effective privacy is determined the same way as in get_filtered_message: public for the owner, otherwise the
+    privacy of the shared config for the user or else the privacy of the email account. The map is cached per user
+    until invalidate_email_account_privacy_map is called for the tenant.
+
+    Args:
+        user (LilyUser): the user viewing the email accounts
+
+    Returns:
+        dict: privacy per email account id
+    """
+    is_free_plan = user.tenant.billing.is_free_plan
+    # The plan is part of the key, because a free plan only allows access to the user's own email accounts.
+    cache_key = EMAIL_ACCOUNT_PRIVACY_MAP_KEY % {
+        'tenant': user.tenant_id,
+        'version': _get_privacy_map_version(user.tenant_id),
+        'user': user.pk,
+        'plan': int(is_free_plan),
+    }
+
+    privacy_map = cache.get(cache_key)
+    if privacy_map is not None:
+        return privacy_map
+
+    email_accounts = EmailAccount.objects.filter(
+        tenant_id=user.tenant_id,
+        is_deleted=False,
+        is_active=True,
+    )
+
+    if is_free_plan:
+        email_accounts = email_accounts.filter(owner=user)
+
+    shared_privacy = dict(SharedEmailConfig.objects.filter(
+        tenant_id=user.tenant_id,
+        user=user,
+    ).values_list('email_account_id', 'privacy'))
+
+    privacy_map = {}
+    for email_account_id, owner_id, privacy in email_accounts.values_list('id', 'owner_id', 'privacy'):
+        if owner_id == user.pk:
+            privacy_map[email_account_id] = EmailAccount.PUBLIC
+        else:
+            privacy_map[email_account_id] = shared_privacy.get(email_account_id, privacy)
+
+    cache.set(cache_key, privacy_map)
+
+    return privacy_map
+
+
+def invalidate_email_account_privacy_map(tenant_id):
+    """
+    Invalidate the cached privacy maps of all users of the tenant.
+
+    Args:
+        tenant_id (int): the tenant of the changed email account or shared config
+    """
+    key = EMAIL_ACCOUNT_PRIVACY_VERSION_KEY % tenant_id
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Not set yet or expired, so start a new version.
+        cache.set(key, _get_privacy_map_version(tenant_id) + 1, None)
+
+
 def convert_br_to_newline(soup, newline='\n'):
     """
     Replace html line breaks with spaces to prevent lines appended after one another.
@@ -709,42 +1107,125 @@ def restore_email_account_settings(tenant):
         email_account.save()
 
 
-def determine_message_type(thread_id, sent_date, email_address):
+def get_message_type(subject, number_of_receivers):
     """
-    Determine if the message is a reply, reply-all, forward, forward-multi or just a normal email.
-    Return the message type and the message id it's a reply to, or forward of.
+    Return the message type of an outgoing message, based on its subject and number of receivers.
     """
-    # Get the whole thread this message belongs to.
-    thread = EmailMessage.objects.filter(thread_id=thread_id)
+    if subject.startswith('Re: '):
+        return EmailMessage.REPLY if number_of_receivers == 1 else EmailMessage.REPLY_ALL
+    elif subject.startswith('Fwd: '):
+        return EmailMessage.FORWARD if number_of_receivers == 1 else EmailMessage.FORWARD_MULTI
 
-    # Restrict the thread to only older messages.
-    thread = thread.filter(sent_date__gt=sent_date).order_by('sent_date')
+    return None
 
-    # Restrict the thread to just the outgoing messages.
-    email = thread.filter(sender__email_address=email_address)
 
-    # And retrieve only necessary fields.
-    email = email.only('id', 'subject', 'received_by', 'received_by_cc')
+def classify_threads(email_account, thread_ids):
+    """
+    Determine for every message in the threads if it was replied to, replied to all, forwarded or none of those.
 
-    # And we only want the first one.
-    email = email.first()
+    A message gets the type of the first later message in the thread sent by the email account, and the id of that
+    message. The threads are classified as a whole with a fixed number of queries, so the types of older messages are
+    updated too when a reply comes in.
 
-    if email:
-        receivers = set(email.received_by.all()) | set(email.received_by_cc.all())
-        numbers_of_receivers = len(receivers)
+    Args:
+        email_account (instance): EmailAccount instance the threads belong to
+        thread_ids (iterable): thread_ids of the threads to classify
 
-        if email.subject.startswith('Re: '):
-            if numbers_of_receivers == 1:
-                return EmailMessage.REPLY, email.id
-            else:
-                return EmailMessage.REPLY_ALL, email.id
-        elif email.subject.startswith('Fwd: '):
-                if numbers_of_receivers == 1:
-                    return EmailMessage.FORWARD, email.id
-                else:
-                    return EmailMessage.FORWARD_MULTI, email.id
-
-    return EmailMessage.NORMAL, None
+    Returns:
+        int: the number of messages of which the type changed
+    """
+    thread_ids = set(thread_ids)
+    if not thread_ids:
+        return 0
+
+    messages = EmailMessage.objects.filter(
+        account=email_account,
+        thread_id__in=thread_ids,
+    ).values_list(
+        'id', 'thread_id', 'sent_date', 'subject', 'sender__email_address', 'message_type', 'message_type_to_id',
+    ).order_by()
+
+    threads = {}
+    outgoing_ids = []
+    for message in messages:
+        threads.setdefault(message[1], []).append(message)
+        if message[4] == email_account.email_address:
+            outgoing_ids.append(message[0])
+
+    # Count the distinct receivers of the outgoing messages with one query per relation.
+    receivers = {}
+    for relation in (EmailMessage.received_by.through, EmailMessage.received_by_cc.through):
+        rows = relation.objects.filter(emailmessage_id__in=outgoing_ids).values_list('emailmessage_id', 'recipient_id')
+        for message_id, recipient_id in rows:
+            receivers.setdefault(message_id, set()).add(recipient_id)
+
+    changes = {}
+    for thread in threads.values():
+        # Walk from the newest to the oldest message, keeping track of the first later outgoing message.
+        thread.sort(key=lambda message: (message[2], message[0]), reverse=True)
+        next_outgoing = None
+        index = 0
+        while index < len(thread):
+            sent_date = thread[index][2]
+            same_date = []
+            while index < len(thread) and thread[index][2] == sent_date:
+                same_date.append(thread[index])
+                index += 1
+
+            for message in same_date:
+                message_id, message_type, message_type_to_id = message[0], message[5], message[6]
+                new_type, new_type_to_id = EmailMessage.NORMAL, None
+                if next_outgoing:
+                    outgoing_type = get_message_type(next_outgoing[3], len(receivers.get(next_outgoing[0], ())))
+                    if outgoing_type is not None:
+                        new_type, new_type_to_id = outgoing_type, next_outgoing[0]
+
+                if (message_type, message_type_to_id) != (new_type, new_type_to_id):
+                    changes[message_id] = (new_type, new_type_to_id)
+
+            # Only messages sent strictly later count, so update the outgoing message after the whole date is done.
+            outgoing = [outgoing_message for outgoing_message in same_date
+                        if outgoing_message[4] == email_account.email_address]
+            if outgoing:
+                next_outgoing = min(outgoing, key=lambda outgoing_message: outgoing_message[0])
+
+    for batch in chunks(changes.items(), 500):
+        EmailMessage.objects.filter(pk__in=[pk for pk, change in batch]).update(
+            message_type=Case(
+                *[When(pk=pk, then=Value(change[0])) for pk, change in batch],
+                output_field=PositiveSmallIntegerField()
+            ),
+            message_type_to_id=Case(
+                *[When(pk=pk, then=Value(change[1])) for pk, change in batch],
+                output_field=PositiveIntegerField()
+            ),
+        )
+
+    return len(changes)
+
+
+def classify_unclassified_threads(batch_size):
+    """
+    Classify the threads of the next batch of messages without a message type.
+
+    Args:
+        batch_size (int): maximum number of unclassified messages to look up the threads of
+
+    Returns:
+        int: the number of unclassified messages found, so zero when there is nothing left to classify
+    """
+    batch = list(EmailMessage.objects.filter(
+        message_type__isnull=True,
+    ).values_list('account_id', 'thread_id').order_by()[:batch_size])
+
+    thread_ids = {}
+    for account_id, thread_id in batch:
+        thread_ids.setdefault(account_id, set()).add(thread_id)
+
+    for email_account in EmailAccount._base_manager.filter(pk__in=thread_ids.keys()):
+        classify_threads(email_account, thread_ids[email_account.pk])
+
+    return len(batch)
 
 
 def get_formatted_reply_email_subject(subject, prefix='Re: '):
@@ -2,6 +2,7 @@ from itertools import chain
 
 import analytics
 import anyjson
+import hashlib
 import HTMLParser
 import logging
 import mimetypes
@@ -15,10 +16,10 @@ from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.files.storage import default_storage
-from wsgiref.util import FileWrapper
 from django.urls import reverse
-from django.http import HttpResponseRedirect, HttpResponseBadRequest, Http404, HttpResponse
+from django.http import HttpResponseRedirect, HttpResponseBadRequest, Http404, HttpResponse, StreamingHttpResponse
 from django.template import Context, Template
+from django.utils.cache import get_conditional_response
 from django.utils.translation import ugettext_lazy as _
 from django.views.generic import UpdateView, DeleteView, CreateView, FormView
 from django.views.generic.base import View
@@ -44,10 +45,10 @@ from .models.models import (EmailMessage, EmailAttachment, EmailAccount, EmailTe
                             EmailLabel)
 from .services import GmailService
 from .tasks import (send_message, create_draft_email_message, update_draft_email_message,
-                    add_and_remove_labels_for_message, trash_email_message)
+                    add_and_remove_labels_for_message, trash_email_message, rerender_email_message_body)
 from .utils import (
-    get_attachment_filename_from_url, get_email_parameter_choices,
-    create_recipients, render_email_body, replace_cid_in_html,
+    EMAIL_BODY_RENDER_VERSION, download_attachment, get_attachment_filename_from_url, get_email_parameter_choices,
+    create_recipients, render_email_message_body, replace_cid_in_html,
     reindex_email_message, extract_script_tags,
     get_filtered_message, get_formatted_reply_email_subject,
     get_formatted_email_body
@@ -164,10 +165,78 @@ class EmailMessageHTMLView(LoginRequiredMixin, DetailView):
 
     def get_context_data(self, **kwargs):
         context = super(EmailMessageHTMLView, self).get_context_data(**kwargs)
-        context['body_html'] = render_email_body(self.object.body_html, self.object.attachments.all(), self.request)
+
+        email_message = self.object
+        if email_message.rendered_body_version is None:
+            # Stored before bodies were rendered, so there is nothing to show yet but to render it now.
+            render_email_message_body(email_message, email_message.attachments.all())
+            EmailMessage.objects.filter(pk=email_message.pk).update(
+                rendered_body_html=email_message.rendered_body_html,
+                rendered_body_version=email_message.rendered_body_version,
+            )
+        elif email_message.rendered_body_version != EMAIL_BODY_RENDER_VERSION:
+            # Rendered by an older version, show that one while it's rendered again in the background.
+            rerender_email_message_body.delay(email_message.pk)
+
+        context['body_html'] = email_message.rendered_body_html
         return context
 
 
+def parse_range_header(header, size):
+    """
+    Parse a HTTP Range header with a single byte range.
+
+    Args:
+        header (str): the value of the Range header, e.g. "bytes=0-1023"
+        size (int): the size of the file in bytes
+
+    Returns:
+        tuple: the first and last byte of the range, None if the header can't be parsed (so the whole file should be
+            sent) or False if the range can't be satisfied
+    """
+    match = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+    if not match or not any(match.groups()):
+        return None
+
+    start, end = match.groups()
+    if not start:
+        # Suffix range, e.g. "bytes=-500" for the last 500 bytes.
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+
+    if start > end or start >= size:
+        return False
+
+    return start, end
+
+
+def iter_storage_file(storage_file, start, end, chunk_size):
+    """
+    Read the given byte range of a file from storage in chunks of at most chunk_size bytes.
+    """
+    if hasattr(storage_file, 'key'):
+        # Reading from an S3 file downloads the whole object first, so request the range from S3 directly instead.
+        key = storage_file.key.bucket.new_key(storage_file.key.name)
+        key.open_read(headers={'Range': 'bytes=%s-%s' % (start, end)})
+        source = key
+    else:
+        storage_file.seek(start)
+        source = storage_file
+
+    remaining = end - start + 1
+    try:
+        while remaining > 0:
+            chunk = source.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        source.close()
+
+
 class EmailAttachmentProxy(View):
     def get(self, request, *args, **kwargs):
         try:
@@ -178,22 +247,85 @@ class EmailAttachmentProxy(View):
         except:
             raise Http404()
 
-        s3_file = default_storage._open(attachment.attachment.name)
+        # Don't keep the request waiting on retries when Gmail is unavailable.
+        if not download_attachment(attachment, retry=False):
+            raise Http404()
+
+        # Stored files are named after their content, so the filename and content type come from the attachment.
+        name = attachment.attachment.name
+        content_type = attachment.content_type or mimetypes.guess_type(attachment.name)[0]
+        disposition = '%s; filename=%s' % (
+            'inline' if attachment.inline else 'attachment',
+            get_attachment_filename_from_url(attachment.name),
+        )
+        delivery = settings.EMAIL_ATTACHMENT_DELIVERY
+
+        if delivery == 'redirect' and getattr(default_storage, 'querystring_auth', False):
+            # The url is signed and expires after a few minutes, so it can't be shared.
+            response_headers = {'response-content-disposition': disposition}
+            if content_type:
+                response_headers['response-content-type'] = content_type
+            return HttpResponseRedirect(default_storage.url(name, response_headers=response_headers))
+
+        if delivery == 'accel':
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = settings.EMAIL_ATTACHMENT_ACCEL_PREFIX + name
+            response['Content-Disposition'] = disposition
+            return response
+
+        return self.stream(request, attachment, disposition)
 
-        wrapper = FileWrapper(s3_file)
-        if hasattr(s3_file, 'key'):
+    def stream(self, request, attachment, disposition):
+        """
+        Stream the attachment through Django, with support for conditional and range requests.
+        """
+        name = attachment.attachment.name
+        # Attachments never change after they are stored, so the name and size identify the content.
+        etag = '"%s"' % hashlib.md5(('%s:%s' % (name, attachment.size)).encode('utf-8')).hexdigest()
+
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
+
+        s3_file = default_storage._open(name)
+        if attachment.content_type:
+            content_type = attachment.content_type
+        elif hasattr(s3_file, 'key'):
             content_type = s3_file.key.content_type
         else:
             content_type = mimetypes.guess_type(s3_file.file.name)[0]
 
-        response = HttpResponse(wrapper, content_type=content_type)
+        size = attachment.size or default_storage.size(name)
+        start, end = 0, size - 1
+        status = 200
+
+        byte_range = None
+        if 'HTTP_RANGE' in request.META and request.META.get('HTTP_IF_RANGE', etag) == etag:
+            byte_range = parse_range_header(request.META['HTTP_RANGE'], size)
+
+        if byte_range is False:
+            s3_file.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%s' % size
+            return response
+        elif byte_range:
+            start, end = byte_range
+            status = 206
+
+        response = StreamingHttpResponse(
+            iter_storage_file(s3_file, start, end, settings.EMAIL_ATTACHMENT_CHUNK_SIZE),
+            content_type=content_type,
+            status=status
+        )
 
-        inline = 'attachment'
-        if attachment.inline:
-            inline = 'inline'
+        if status == 206:
+            response['Content-Range'] = 'bytes %s-%s/%s' % (start, end, size)
 
-        response['Content-Disposition'] = '%s; filename=%s' % (inline, get_attachment_filename_from_url(s3_file.name))
-        response['Content-Length'] = attachment.size
+        response['Content-Disposition'] = disposition
+        response['Content-Length'] = end - start + 1
+        response['Accept-Ranges'] = 'bytes'
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, max-age=%s' % settings.EMAIL_ATTACHMENT_MAX_AGE
         return response
 
 
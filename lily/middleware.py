@@ -1,6 +1,7 @@
 from django.contrib.auth.models import AnonymousUser
 from django.utils.functional import SimpleLazyObject
-from rest_framework.authtoken.models import Token
+
+from lily.users.authentication.tokens import get_token_user
 
 
 class SetRemoteAddrFromForwardedFor(object):
@@ -17,15 +18,9 @@ class SetRemoteAddrFromForwardedFor(object):
 
 
 def get_user(token):
-    model = Token
-
-    try:
-        token = model.objects.select_related('user').get(key=token)
-        user = token.user
+    user = get_token_user(token)
 
-        if not user.is_active:
-            user = AnonymousUser()
-    except model.DoesNotExist:
+    if user is None or not user.is_active:
         user = AnonymousUser()
 
     return user
@@ -4,14 +4,14 @@ from django.db import models
 from django.utils.translation import ugettext_lazy as _
 
 from lily.tenant.models import TenantMixin
-from lily.utils.models.mixins import DeletedMixin
+from lily.utils.models.mixins import DeletedMixin, ContentTypeMixin
 from lily.users.models import LilyUser
 
 
 NOTABLE_MODELS = ('account', 'contact', 'deal', 'case', 'call', 'callrecord')
 
 
-class Note(TenantMixin, DeletedMixin):
+class Note(TenantMixin, DeletedMixin, ContentTypeMixin):
     """
     Note model, simple text fields to store text about another model for everyone to see.
     """
@@ -31,13 +31,6 @@ class Note(TenantMixin, DeletedMixin):
     subject = GenericForeignKey('gfk_content_type', 'gfk_object_id')
     is_pinned = models.BooleanField(default=False)
 
-    @property
-    def content_type(self):
-        """
-        Return the content type (Django model) for this model
-        """
-        return ContentType.objects.get(app_label='notes', model='note')
-
     def __unicode__(self):
         return self.content
 
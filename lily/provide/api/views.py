@@ -1,15 +1,21 @@
-import requests
+import hashlib
+
 from django.conf import settings
+from django.core.cache import cache
 from django.http import Http404
 from rest_framework.decorators import list_route
 from rest_framework.viewsets import ViewSet
 from rest_framework.response import Response
 
+from lily.utils import http
 from lily.utils.functions import (
-    parse_address, parse_phone_number, strip_protocol_from_url, get_country_by_phone_number
+    normalize_phone_number, parse_address, parse_phone_number, strip_protocol_from_url, get_country_by_phone_number
 )
 
 
+DATAPROVIDER_CACHE_KEY = 'dataprovider:%s:%s'
+
+
 class DataproviderViewSet(ViewSet):
     """
     View that makes an API call to Dataprovider to look up information for an account.
@@ -35,12 +41,14 @@ class DataproviderViewSet(ViewSet):
         }
 
         try:
-            response = requests.post(url, params=params, json=data)
+            json = self._request(
+                'phonenumber', normalize_phone_number(phone_number), 'post', url, params=params, json=data
+            )
         except Exception as e:
             error = {'error': {'message': str(e)}}
             return Response(error)
 
-        account_information = self._get_account_information(response.json())
+        account_information = self._get_account_information(json)
         return Response(account_information)
 
     @list_route(methods=['POST'])
@@ -58,13 +66,41 @@ class DataproviderViewSet(ViewSet):
         }
 
         try:
-            response = requests.get(url=url, params=params)
-            account_information = self._get_account_information(response.json())
+            json = self._request('url', query_website.lower().rstrip('/'), 'get', url, params=params)
+            account_information = self._get_account_information(json)
             return Response(account_information)
         except Exception as e:
             error = {'error': {'message': str(e)}}
             return Response(error)
 
+    def _request(self, lookup, value, method, url, **kwargs):
+        """
+        Return the json response of Dataprovider, cached per normalized lookup value.
+
+        Every lookup is billed, so successful responses are cached and the same company is only looked up once in a
+        while.
+
+        Args:
+            lookup (str): the kind of lookup, url or phonenumber
+            value (str): the normalized value that is looked up
+            method (str): the HTTP method
+            url (str): the Dataprovider url to call
+
+        Returns:
+            dict: the json response
+        """
+        cache_key = DATAPROVIDER_CACHE_KEY % (lookup, hashlib.sha1(value.encode('utf-8')).hexdigest())
+        json = cache.get(cache_key)
+
+        if json is None:
+            response = http.request(method, url, **kwargs)
+            json = response.json()
+
+            if response.status_code == 200 and not json.get('error'):
+                cache.set(cache_key, json, settings.DATAPROVIDER_CACHE_TIMEOUT)
+
+        return json
+
     def _get_account_information(self, json):
         """
         Create a dict with account information based on the json response from Dataprovider.
@@ -82,6 +82,17 @@ class BaseMapping(MappingType, Indexable):
             except FieldDoesNotExist:
                 return False
 
+    @classmethod
+    def has_modified(cls):
+        """
+        Does the model keep track of when it was modified?
+        """
+        try:
+            cls.get_model()._meta.get_field('modified')
+            return True
+        except FieldDoesNotExist:
+            return False
+
     @classmethod
     def get_related_models(cls):
         """
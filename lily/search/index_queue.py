@@ -0,0 +1,209 @@
+import logging
+from contextlib import contextmanager
+from threading import local
+
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from lily.search.indexing import process_index_markers
+
+
+logger = logging.getLogger('search')
+_buffer = local()
+_queues = {}
+
+
+class SynchronousIndexQueue(object):
+    """
+    Process the markers right away in the current process.
+
+    Every push results in one batch query and one bulk request per mapping, followed by a refresh so changes are
+    searchable immediately. Meant for development and the test suite.
+    """
+    def push(self, mapping, pks):
+        process_index_markers(mapping, pks, refresh=True)
+
+    def start_rebuild(self, name):
+        pass
+
+    def pop_rebuild(self, name):
+        return set()
+
+    def finish_rebuild(self, name):
+        pass
+
+
+class CeleryIndexQueue(object):
+    """
+    Collect the markers in Redis and let a Celery task process them after a short window.
+
+    The markers of one mapping are stored in a set, so an object that changes multiple times within the window is
+    only indexed once. The first push within a window schedules the task, further pushes only add to the set.
+
+    While the index of a mapping is rebuilt, the popped markers are also kept in a replay set. The markers are indexed
+    in the current index, the rebuild indexes them again in the new index, so changes made while switching to the new
+    index aren't lost. This includes changes that don't update the modified field.
+    """
+    key = 'search:index_queue:%s'
+    scheduled_key = 'search:index_queue:%s:scheduled'
+    rebuild_key = 'search:index_queue:%s:rebuild'
+    replay_key = 'search:index_queue:%s:replay'
+
+    def __init__(self):
+        self.client = redis.StrictRedis.from_url(settings.REDIS_URL)
+        self.window = settings.ES_INDEX_QUEUE_WINDOW
+
+    def push(self, mapping, pks):
+        from lily.search.tasks import process_index_queue
+
+        name = mapping.get_mapping_type_name()
+
+        pipeline = self.client.pipeline()
+        pipeline.sadd(self.key % name, *pks)
+        pipeline.set(self.scheduled_key % name, 1, ex=self.window, nx=True)
+        added, scheduled = pipeline.execute()
+
+        if scheduled:
+            process_index_queue.apply_async(args=(name, ), countdown=self.window)
+
+    def pop(self, name):
+        """
+        Take all markers for the given mapping type name off the queue.
+
+        Args:
+            name (str): the mapping type name
+
+        Returns:
+            list: primary keys of the objects that need to be (re)indexed
+        """
+        pipeline = self.client.pipeline()
+        # Clear the scheduled flag in the same transaction, so new markers will schedule a new task.
+        pipeline.delete(self.scheduled_key % name)
+        pipeline.smembers(self.key % name)
+        pipeline.delete(self.key % name)
+        pipeline.exists(self.rebuild_key % name)
+        deleted, pks, cleared, rebuilding = pipeline.execute()
+
+        if pks and rebuilding:
+            self.client.sadd(self.replay_key % name, *pks)
+
+        return [int(pk) for pk in pks]
+
+    def start_rebuild(self, name):
+        """
+        Start keeping the markers of the mapping type name for the index that is being rebuilt.
+        """
+        self.client.set(self.rebuild_key % name, 1)
+
+    def pop_rebuild(self, name):
+        """
+        Take the markers that were indexed since the rebuild started, or since the last time they were taken.
+
+        Returns:
+            set: primary keys of the objects that need to be indexed in the new index
+        """
+        pipeline = self.client.pipeline()
+        pipeline.smembers(self.replay_key % name)
+        pipeline.delete(self.replay_key % name)
+        pks, deleted = pipeline.execute()
+
+        return set(int(pk) for pk in pks)
+
+    def finish_rebuild(self, name):
+        """
+        Stop keeping the markers of the mapping type name, once the new index is in use.
+        """
+        self.client.delete(self.rebuild_key % name, self.replay_key % name)
+
+
+def get_index_queue():
+    """
+    Return the index queue configured by ES_INDEX_QUEUE_BACKEND.
+    """
+    path = settings.ES_INDEX_QUEUE_BACKEND
+    if path not in _queues:
+        _queues[path] = import_string(path)()
+    return _queues[path]
+
+
+def _push(mapping, pks):
+    """
+    Hand the markers to the index queue once the current transaction has been committed.
+
+    Pushing on commit prevents indexing data that may still be rolled back and prevents a Celery task from reading the
+    database before the changes are visible.
+    """
+    def push():
+        try:
+            get_index_queue().push(mapping, pks)
+        except Exception:
+            logger.exception('Unable to queue %s for indexing: %s' % (mapping.get_mapping_type_name(), list(pks)))
+
+    transaction.on_commit(push)
+
+
+def enqueue_index(mapping, pk):
+    """
+    Mark the object with the given primary key as changed for the given mapping.
+
+    Within a deferred_indexing block the markers are collected and deduplicated until the block ends, otherwise they
+    are queued directly.
+
+    Args:
+        mapping (BaseMapping): the mapping of the changed object
+        pk (int): the primary key of the changed object
+    """
+    if settings.ES_DISABLED:
+        return
+
+    if getattr(_buffer, 'depth', 0):
+        _buffer.markers.setdefault(mapping, set()).add(pk)
+    else:
+        _push(mapping, [pk])
+
+
+def start_deferred_indexing():
+    """
+    Start collecting index markers for the current thread, blocks can be nested.
+    """
+    if not getattr(_buffer, 'depth', 0):
+        _buffer.depth = 0
+        _buffer.markers = {}
+    _buffer.depth += 1
+
+
+def finish_deferred_indexing():
+    """
+    Stop collecting index markers and queue the collected ones when the outermost block is finished.
+    """
+    if not getattr(_buffer, 'depth', 0):
+        return
+
+    _buffer.depth -= 1
+    if not _buffer.depth:
+        markers, _buffer.markers = _buffer.markers, {}
+        for mapping, pks in markers.items():
+            _push(mapping, pks)
+
+
+def flush_deferred_indexing():
+    """
+    Stop collecting index markers and queue the collected ones, however many blocks weren't finished.
+    """
+    if getattr(_buffer, 'depth', 0):
+        _buffer.depth = 1
+        finish_deferred_indexing()
+
+
+@contextmanager
+def deferred_indexing():
+    """
+    Collect the index markers within the block and queue them as one batch per mapping when the block ends.
+    """
+    start_deferred_indexing()
+    try:
+        yield
+    finally:
+        finish_deferred_indexing()
@@ -4,7 +4,7 @@ import traceback
 
 from django.conf import settings
 from elasticsearch.exceptions import NotFoundError
-from elasticutils.contrib.django import tasks
+from elasticsearch.helpers import bulk
 
 from lily.search.connections_utils import get_es_client, get_index_name
 from lily.utils import logutil
@@ -15,68 +15,115 @@ main_index = settings.ES_INDEXES['default']
 es = get_es_client(maxsize=1)
 
 
-def update_in_index(instance, mapping):
+def process_index_markers(mapping, pks, refresh=False, index=main_index):
     """
-    Utility function for signal listeners index to Elasticsearch.
-    Currently uses synchronous tasks. And because of that all exceptions are
-    caught, so failures will not interfere with the regular model updates.
+    Bring the index in line with the database for the given primary keys of one mapping.
+
+    Existing objects are extracted in a single batch query (using the prepare_batch of the mapping) and sent through
+    the bulk API, objects that are deleted or no longer exist are removed from the index. All exceptions are caught
+    and logged, so failures will not interfere with whatever called this function.
+
+    Args:
+        mapping (BaseMapping): the mapping the primary keys belong to
+        pks (iterable): primary keys of objects that changed
+        refresh (boolean, optional): if True, refresh the index afterwards so the changes are searchable immediately
+        index (str, optional): the base name of the index, defaults to the main index
     """
     if settings.ES_DISABLED:
         return
-    if hasattr(instance, 'is_deleted') and instance.is_deleted:
-        remove_from_index(instance, mapping)
-    else:
-        logger.info(u'Updating instance %s: %s' % (instance.__class__.__name__, instance.pk))
 
-        try:
-            main_index_with_type = get_index_name(main_index, mapping)
-            try:
-                document = mapping.extract_document(instance.id, instance)
-            except Exception as exc:
-                logger.exception('Unable to extract document {0}: {1}'.format(
-                    instance, repr(exc)))
-            else:
-                # Index object direct instead of bulk_index, to prevent multiple reads from db
-                mapping.index(document, id_=instance.id, es=es, index=main_index_with_type)
-                es.indices.refresh(main_index_with_type)
-        except Exception, e:
-            logger.error(traceback.format_exc(e))
-
-
-def remove_from_index(instance, mapping):
-    """
-    Utility function for signal listeners to remove from Elasticsearch.
-    Currently uses synchronous tasks. And because of that all exceptions are
-    caught, so failures will not interfere with the regular model updates.
-    """
-    if settings.ES_DISABLED:
+    pks = set(pks)
+    if not pks:
         return
-    logger.info(u'Removing instance %s: %s' % (instance.__class__.__name__, instance.pk))
+
+    main_index_with_type = get_index_name(index, mapping)
+    # Use the base manager to bypass the tenant filtering of the current user.
+    queryset = mapping.prepare_batch(mapping.get_model()._base_manager.filter(pk__in=pks))
+
+    documents = []
+    remove_pks = set(pks)
+    for instance in queryset:
+        if getattr(instance, 'is_deleted', False):
+            continue
+
+        # Whether extracting works or not, the object still exists so it shouldn't be removed from the index.
+        remove_pks.discard(instance.pk)
+        try:
+            documents.append(mapping.extract_document(instance.pk, instance))
+        except Exception as exc:
+            logger.exception('Unable to extract document {0}: {1}'.format(instance, repr(exc)))
+
+    logger.info(u'Updating %s %s, removing %s' % (len(documents), mapping.get_mapping_type_name(), len(remove_pks)))
 
     try:
-        main_index_with_type = get_index_name(main_index, mapping)
-        tasks.unindex_objects(mapping, [instance.id], es=es, index=main_index_with_type)
-        es.indices.refresh(main_index_with_type)
-    except NotFoundError, e:
-        logger.warn('Not found in index instance %s: %s' % (instance.__class__.__name__, instance.pk))
+        if documents:
+            mapping.bulk_index(documents, id_field='id', es=es, index=main_index_with_type)
+        if remove_pks:
+            bulk(es, [{
+                '_op_type': 'delete',
+                '_index': main_index_with_type,
+                '_type': mapping.get_mapping_type_name(),
+                '_id': pk,
+            } for pk in remove_pks], raise_on_error=False)
+        if refresh:
+            es.indices.refresh(main_index_with_type)
+    except NotFoundError:
+        logger.warn('Index %s not found' % main_index_with_type)
     except Exception, e:
         logger.error(traceback.format_exc(e))
 
 
-def index_objects(mapping, queryset, index, print_progress=False):
+def get_changed_pks(mapping, since):
+    """
+    Return the primary keys of the objects of the mapping that were modified or deleted since the given time.
+
+    Args:
+        mapping (BaseMapping): a mapping of a model with a modified field
+        since (datetime): the time from which changes are returned
+
+    Returns:
+        set: primary keys of the changed objects
+    """
+    from lily.search.models import IndexTombstone
+
+    modified_pks = mapping.get_model()._base_manager.filter(modified__gte=since).values_list('pk', flat=True)
+    deleted_pks = IndexTombstone.objects.filter(
+        mapping_type_name=mapping.get_mapping_type_name(),
+        deleted__gte=since,
+    ).values_list('object_id', flat=True)
+
+    return set(modified_pks) | set(deleted_pks)
+
+
+def index_objects(mapping, queryset, index, print_progress=False, es_client=None, callback=None):
     """
     Index synchronously model specified mapping type with an optimized query.
+
+    Args:
+        mapping (BaseMapping): the mapping of the objects
+        queryset (QuerySet): the objects to index
+        index (str): the base name of the index
+        print_progress (boolean, optional): if True, print the progress
+        es_client (Elasticsearch, optional): the client to use instead of the module wide one
+        callback (function, optional): called with the pk of the last indexed object after every bulk request
     """
+    es_client = es_client or es
     documents = []
+    pk = None
     for instance in queryset_iterator(mapping, queryset, print_progress=print_progress):
         documents.append(mapping.extract_document(instance.id, instance))
+        pk = instance.pk
 
         if len(documents) >= 100:
-            mapping.bulk_index(documents, id_field='id', index=get_index_name(index, mapping), es=es)
+            mapping.bulk_index(documents, id_field='id', index=get_index_name(index, mapping), es=es_client)
             documents = []
+            if callback:
+                callback(pk)
 
-    mapping.bulk_index(documents, id_field='id', index=get_index_name(index, mapping), es=es)
+    mapping.bulk_index(documents, id_field='id', index=get_index_name(index, mapping), es=es_client)
     documents = []
+    if callback and pk is not None:
+        callback(pk)
 
 
 def unindex_objects(mapping, queryset, index, print_progress=False):
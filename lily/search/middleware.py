@@ -0,0 +1,23 @@
+from .index_queue import finish_deferred_indexing, flush_deferred_indexing, start_deferred_indexing
+
+
+class DeferredIndexingMiddleware(object):
+    """
+    Collect the search index markers of a request and queue them once the response is ready.
+
+    This way an object that is saved multiple times during a request (directly or as a related object), is only
+    queued for indexing once.
+    """
+    def process_request(self, request):
+        # A request is always the outermost block, so markers left behind by a request that didn't finish properly
+        # are queued before collecting the markers of this one.
+        flush_deferred_indexing()
+        start_deferred_indexing()
+
+    def process_exception(self, request, exception):
+        # The changes that were committed before the exception still have to be indexed.
+        flush_deferred_indexing()
+
+    def process_response(self, request, response):
+        finish_deferred_indexing()
+        return response
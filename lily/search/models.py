@@ -0,0 +1,13 @@
+from django.db import models
+
+
+class IndexTombstone(models.Model):
+    """
+    A deleted object of a mapping, so it can be removed from an index that was being rebuilt at the time.
+    """
+    mapping_type_name = models.CharField(max_length=255)
+    object_id = models.PositiveIntegerField()
+    deleted = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __unicode__(self):
+        return '%s %s' % (self.mapping_type_name, self.object_id)
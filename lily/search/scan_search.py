@@ -33,3 +33,13 @@ class ModelMappings(object):
                         cls.app_to_mappings[app] = member
             except Exception:
                 pass
+
+    @classmethod
+    def get_mapping_by_type_name(cls, name):
+        """
+        Return the mapping with the given mapping type name, or None if there is no such mapping.
+        """
+        for mapping in cls.mappings:
+            if mapping.get_mapping_type_name() == name:
+                return mapping
+        return None
@@ -1,7 +1,8 @@
 from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch.dispatcher import receiver
 
-from .indexing import update_in_index, remove_from_index
+from .index_queue import enqueue_index
+from .models import IndexTombstone
 from .scan_search import ModelMappings
 from django.conf import settings
 
@@ -26,7 +27,7 @@ def post_save_generic(sender, instance, **kwargs):
         return
     mapping = ModelMappings.model_to_mappings.get(sender)
     if mapping:
-        update_in_index(instance, mapping)
+        enqueue_index(mapping, instance.pk)
     check_related(sender, instance)
 
 
@@ -38,7 +39,7 @@ def m2m_changed_generic(sender, instance, action, **kwargs):
     if action.startswith('post_'):
         mapping = ModelMappings.model_to_mappings.get(type(instance))
         if mapping:
-            update_in_index(instance, mapping)
+            enqueue_index(mapping, instance.pk)
         check_related(sender, instance)
 
 
@@ -48,7 +49,10 @@ def post_delete_generic(sender, instance, **kwargs):
         return
     mapping = ModelMappings.model_to_mappings.get(sender)
     if mapping:
-        remove_from_index(instance, mapping)
+        enqueue_index(mapping, instance.pk)
+        if mapping.has_modified():
+            # Changes are found by the modified field when catching up on a rebuilt index, deletions by tombstones.
+            IndexTombstone.objects.create(mapping_type_name=mapping.get_mapping_type_name(), object_id=instance.pk)
     # Remember: We UPDATE our related object, not DELETE it
     # (So we can use the check_related also used in the post_save method).
     check_related(sender, instance)
@@ -68,4 +72,4 @@ def check_related(sender, instance):
                 # Some related objects are not specific to one model, such as
                 # 'subject' of Tag, so we do a double check to match the model.
                 if type(obj) is mapping.get_model():
-                    update_in_index(obj, mapping)
+                    enqueue_index(mapping, obj.pk)
@@ -0,0 +1,42 @@
+import logging
+from datetime import timedelta
+
+from celery.task import task
+from django.conf import settings
+from django.utils import timezone
+
+from lily.search.index_queue import CeleryIndexQueue
+from lily.search.indexing import process_index_markers
+from lily.search.models import IndexTombstone
+from lily.search.scan_search import ModelMappings
+
+logger = logging.getLogger(__name__)
+
+
+@task(name='process_index_queue', logger=logger)
+def process_index_queue(name):
+    """
+    Index all objects that were queued for the mapping since the task was scheduled.
+
+    Args:
+        name (str): the mapping type name
+    """
+    mapping = ModelMappings.get_mapping_by_type_name(name)
+    if not mapping:
+        logger.warning('Unknown mapping type: %s', name)
+        return
+
+    pks = CeleryIndexQueue().pop(name)
+    if pks:
+        process_index_markers(mapping, pks)
+
+
+@task(name='cleanup_index_tombstones', logger=logger)
+def cleanup_index_tombstones():
+    """
+    Delete the tombstones that are older than ES_INDEX_TOMBSTONE_DAYS.
+    """
+    deleted, rows = IndexTombstone.objects.filter(
+        deleted__lt=timezone.now() - timedelta(days=settings.ES_INDEX_TOMBSTONE_DAYS)
+    ).delete()
+    logger.info('Deleted %s index tombstones' % deleted)
@@ -1,7 +1,10 @@
 import json
 from datetime import datetime, timedelta
 
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
+from mock import patch
 from pytz import utc
 from rest_framework import status
 from rest_framework.test import APITestCase
@@ -10,11 +13,16 @@ from lily.accounts.factories import AccountFactory
 from lily.cases.factories import CaseFactory, CaseStatusFactory
 from lily.cases.models import Case
 from lily.contacts.factories import ContactFactory
-from lily.contacts.models import Function
+from lily.contacts.models import Contact, Function
 from lily.deals.factories import DealFactory, DealStatusFactory
 from lily.deals.models import Deal
 from lily.notes.factories import NoteFactory
 from lily.notes.models import Note
+from lily.search.index_queue import deferred_indexing, enqueue_index
+from lily.search.indexing import get_changed_pks
+from lily.search.middleware import DeferredIndexingMiddleware
+from lily.search.models import IndexTombstone
+from lily.search.scan_search import ModelMappings
 from lily.tests.utils import UserBasedTest
 from lily.users.factories import LilyUserFactory
 from lily.utils.models.factories import PhoneNumberFactory
@@ -349,3 +357,79 @@ class InternalNumberSearchAPITestCase(UserBasedTest, APITestCase):
         content = json.loads(response.content)
         self.assertEqual(content.get('internal_number'), user.internal_number)
         self.assertEqual(content.get('user'), user.id)
+
+
+@override_settings(ES_DISABLED=False)
+@patch('lily.search.index_queue.transaction.on_commit', side_effect=lambda func: func())
+@patch('lily.search.index_queue.get_index_queue')
+class IndexQueueTestCase(TestCase):
+    def test_enqueue_outside_deferred_block(self, get_index_queue_mock, on_commit_mock):
+        """
+        Test that markers are pushed directly when no deferred block is active.
+        """
+        mapping = ModelMappings.mappings[0]
+
+        enqueue_index(mapping, 1)
+        enqueue_index(mapping, 1)
+
+        self.assertEqual(get_index_queue_mock.return_value.push.call_count, 2)
+
+    def test_enqueue_deduplicates_in_deferred_block(self, get_index_queue_mock, on_commit_mock):
+        """
+        Test that markers are collected per mapping and pushed once when the deferred block ends.
+        """
+        mapping = ModelMappings.mappings[0]
+        push_mock = get_index_queue_mock.return_value.push
+
+        with deferred_indexing():
+            with deferred_indexing():
+                enqueue_index(mapping, 1)
+                enqueue_index(mapping, 2)
+            enqueue_index(mapping, 1)
+
+            # Nothing is pushed until the outermost block ends.
+            self.assertFalse(push_mock.called)
+
+        push_mock.assert_called_once_with(mapping, {1, 2})
+
+    def test_middleware_exception(self, get_index_queue_mock, on_commit_mock):
+        """
+        Test that the markers of a request that raised an exception are pushed and collecting stops.
+        """
+        mapping = ModelMappings.mappings[0]
+        push_mock = get_index_queue_mock.return_value.push
+        middleware = DeferredIndexingMiddleware()
+
+        middleware.process_request(None)
+        enqueue_index(mapping, 1)
+        middleware.process_exception(None, Exception())
+
+        push_mock.assert_called_once_with(mapping, {1})
+
+        # Markers are pushed directly again outside a request.
+        enqueue_index(mapping, 2)
+        push_mock.assert_called_with(mapping, [2])
+
+
+@override_settings(ES_DISABLED=False)
+@patch('lily.search.index_queue.transaction.on_commit', side_effect=lambda func: func())
+@patch('lily.search.index_queue.get_index_queue')
+class IndexTombstoneTestCase(TestCase):
+    def test_get_changed_pks(self, get_index_queue_mock, on_commit_mock):
+        """
+        Test that objects modified or deleted since the given time are returned.
+        """
+        mapping = ModelMappings.model_to_mappings[Contact]
+        unchanged_contact = ContactFactory.create()
+
+        since = timezone.now()
+        changed_contact = ContactFactory.create(tenant=unchanged_contact.tenant)
+        deleted_contact = ContactFactory.create(tenant=unchanged_contact.tenant)
+        deleted_contact_id = deleted_contact.pk
+        deleted_contact.delete(hard=True)
+
+        self.assertTrue(IndexTombstone.objects.filter(
+            mapping_type_name=mapping.get_mapping_type_name(),
+            object_id=deleted_contact_id
+        ).exists())
+        self.assertEqual(get_changed_pks(mapping, since), {changed_contact.pk, deleted_contact_id})
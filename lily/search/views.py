@@ -14,7 +14,8 @@ from lily.accounts.models import Account, Website
 from lily.cases.models import Case
 from lily.contacts.models import Contact
 from lily.deals.models import Deal
-from lily.messaging.email.models.models import EmailAccount
+from lily.messaging.email.models.models import EmailAccount, EmailMessage
+from lily.messaging.email.utils import get_email_account_privacy_map
 from lily.utils.functions import parse_phone_number
 from lily.search.functions import search_number
 from lily.utils.models.models import PhoneNumber
@@ -109,17 +110,9 @@ class SearchView(LoginRequiredMixin, View):
         hits, facets, total, took = search.do_search(return_fields)
 
         if model_type == 'email_emailmessage':
-            content_type = ContentType.objects.get(app_label='email', model='emailmessage')
-            email_accounts = EmailAccount.objects.filter(
-                tenant=user.tenant,
-                is_deleted=False,
-                is_active=True,
-            ).distinct('id')
-
-            if user.tenant.billing.is_free_plan:
-                email_accounts = email_accounts.filter(
-                    owner=user,
-                )
+            content_type = ContentType.objects.get_for_model(EmailMessage)
+            # Determine the privacy of all email accounts at once, so filtering the hits doesn't need any queries.
+            privacy_map = get_email_account_privacy_map(user)
 
             filtered_hits = []
 
@@ -128,15 +121,14 @@ class SearchView(LoginRequiredMixin, View):
                     'content_type': content_type.id,
                 })
 
-                try:
-                    email_account = email_accounts.get(pk=hit.get('account').get('id'))
-                except EmailAccount.DoesNotExist:
-                    pass
-                else:
-                    shared_config = email_account.sharedemailconfig_set.filter(user=user).first()
+                privacy = privacy_map.get(hit.get('account').get('id'))
 
+                if privacy is None or privacy == EmailAccount.PRIVATE:
+                    # Inactive or private email (account), so don't add to list.
+                    continue
+                elif privacy == EmailAccount.METADATA:
                     # If the email account or sharing is set to metadata only, just return these fields.
-                    metadata_only_message = {
+                    filtered_hits.append({
                         'id': hit.get('id'),
                         'sender_name': hit.get('sender_name'),
                         'sender_email': hit.get('sender_email'),
@@ -145,28 +137,10 @@ class SearchView(LoginRequiredMixin, View):
                         'received_by_cc_email': hit.get('received_by_cc_email'),
                         'received_by_cc_name': hit.get('received_by_cc_name'),
                         'sent_date': hit.get('sent_date'),
-                        'privacy': hit.get('account').get('privacy'),
-                    }
-
-                    if email_account.owner == user:
-                        filtered_hits.append(hit)
-                    else:
-                        if shared_config:
-                            privacy = shared_config.privacy
-                        else:
-                            privacy = email_account.privacy
-
-                        metadata_only_message.update({
-                            'privacy': privacy,
-                        })
-
-                        if privacy == EmailAccount.METADATA:
-                            filtered_hits.append(metadata_only_message)
-                        elif privacy == EmailAccount.PRIVATE:
-                            # Private email (account), so don't add to list.
-                            continue
-                        else:
-                            filtered_hits.append(hit)
+                        'privacy': privacy,
+                    })
+                else:
+                    filtered_hits.append(hit)
 
             hits = filtered_hits
 
@@ -60,14 +60,54 @@ CELERY_ROUTES = (
         # When task is created in first sync, this task will be routed to email_first_sync.
         'queue': 'email_scheduled_tasks'
     }},
+    {'download_email_messages': {
+        # When task is created in first sync, this task will be routed to email_first_sync.
+        'queue': 'email_scheduled_tasks'
+    }},
     {'update_labels_for_message': {
         # When task is created in first sync, this task will be routed to email_first_sync.
         'queue': 'email_scheduled_tasks'
     }},
+    {'reconcile_email_labels': {
+        # When task is created in first sync, this task will be routed to email_first_sync.
+        'queue': 'email_scheduled_tasks'
+    }},
     {'migrate_email_messages': {
         # Temporary main task to migrate all the email messages in batches.
         'queue': 'other_tasks'
     }},
+    {'process_index_queue': {
+        # Bulk index the objects that changed in the last few seconds.
+        'queue': 'other_tasks'
+    }},
+    {'cleanup_index_tombstones': {
+        # Remove the tombstones that are too old to be needed for rebuilding an index.
+        'queue': 'other_tasks'
+    }},
+    {'update_stats_rollups': {
+        # Update the aggregates used by the stats dashboard.
+        'queue': 'other_tasks'
+    }},
+    {'reconcile_unread_counts': {
+        # Fix the unread counters of the email labels.
+        'queue': 'other_tasks'
+    }},
+    {'rerender_email_message_body': {
+        # Render email bodies that were rendered by an older version again.
+        'queue': 'other_tasks'
+    }},
+    {'collect_attachment_blobs': {
+        # Delete the attachment content that isn't used anymore.
+        'queue': 'other_tasks'
+    }},
+    {'deliver_webhook_events': {
+        # Post the stored webhook events to the webhook.
+        'queue': 'other_tasks'
+    }},
+    {'deliver_pending_webhook_events': {
+        # Retry failed webhook events and pick up events of which the delivery task was lost.
+        'queue': 'other_tasks'
+    }},
 )
 CELERYBEAT_SCHEDULE = {
     'synchronize_email_account_scheduler': {
@@ -90,4 +130,29 @@ CELERYBEAT_SCHEDULE = {
         'task': 'cleanup_deleted_email_accounts',
         'schedule': crontab(hour=1, minute=0),  # Every night at one o'clock.
     },
+    'cleanup_index_tombstones_scheduler': {
+        'task': 'cleanup_index_tombstones',
+        'schedule': crontab(hour=2, minute=0),  # Every night at two o'clock.
+    },
+    'update_stats_rollups_scheduler': {
+        'task': 'update_stats_rollups',
+        'schedule': timedelta(seconds=int(os.environ.get('STATS_ROLLUP_INTERVAL', 60 * 10))),
+    },
+    'rebuild_stats_rollups_scheduler': {
+        'task': 'update_stats_rollups',
+        'schedule': crontab(hour=3, minute=0),  # Every night at three o'clock.
+        'kwargs': {'full': True},
+    },
+    'deliver_pending_webhook_events_scheduler': {
+        'task': 'deliver_pending_webhook_events',
+        'schedule': timedelta(seconds=60),  # Once every minute.
+    },
+    'reconcile_unread_counts_scheduler': {
+        'task': 'reconcile_unread_counts',
+        'schedule': crontab(hour=4, minute=0),  # Every night at four o'clock.
+    },
+    'collect_attachment_blobs_scheduler': {
+        'task': 'collect_attachment_blobs',
+        'schedule': crontab(minute=30),  # Every hour at half past.
+    },
 }
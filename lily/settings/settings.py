@@ -186,6 +186,25 @@ LILYUSER_PICTURE_UPLOAD_TO = 'users/lilyuser/%(tenant_id)d/%(user_id)d/%(filenam
 LILYUSER_PICTURE_MAX_SIZE = os.environ.get('MAX_AVATAR_SIZE', 300 * 1024)
 
 EMAIL_ATTACHMENT_UPLOAD_TO = 'messaging/email/attachments/%(tenant_id)d/%(message_id)d/%(filename)s'
+# Attachments with the same content share one file per tenant, named after the SHA-256 digest of the content.
+EMAIL_ATTACHMENT_BLOB_UPLOAD_TO = 'messaging/email/blobs/%(tenant_id)d/%(digest)s'
+# Number of unused attachment files deleted in one transaction.
+EMAIL_ATTACHMENT_BLOB_COLLECT_BATCH_SIZE = int(os.environ.get('EMAIL_ATTACHMENT_BLOB_COLLECT_BATCH_SIZE', 500))
+# Outgoing messages are written to a temporary file, which is kept in memory up to this number of bytes.
+EMAIL_MESSAGE_SPOOL_SIZE = int(os.environ.get('EMAIL_MESSAGE_SPOOL_SIZE', 1024 * 1024))
+
+# How attachments are delivered: 'proxy' streams them through Django, 'redirect' redirects to a short-lived signed
+# storage url (when the storage supports it) and 'accel' lets the web server send the file using X-Accel-Redirect.
+EMAIL_ATTACHMENT_DELIVERY = os.environ.get('EMAIL_ATTACHMENT_DELIVERY', 'proxy')
+# Internal location of the attachments in the web server, used for X-Accel-Redirect.
+EMAIL_ATTACHMENT_ACCEL_PREFIX = os.environ.get('EMAIL_ATTACHMENT_ACCEL_PREFIX', '/protected/')
+# Number of bytes read from storage at once when streaming attachments through Django.
+EMAIL_ATTACHMENT_CHUNK_SIZE = int(os.environ.get('EMAIL_ATTACHMENT_CHUNK_SIZE', 64 * 1024))
+# Number of seconds browsers may reuse a downloaded attachment before checking it again.
+EMAIL_ATTACHMENT_MAX_AGE = int(os.environ.get('EMAIL_ATTACHMENT_MAX_AGE', 60 * 60))
+# Only store where to find attachments when syncing, their files are downloaded from Gmail when they're first used.
+# Off by default: files of accounts that lose access to Gmail can't be downloaded anymore.
+EMAIL_ATTACHMENTS_LAZY = boolean(os.environ.get('EMAIL_ATTACHMENTS_LAZY', 0))
 
 EMAIL_TEMPLATE_ATTACHMENT_UPLOAD_TO = ('messaging/email/templates/attachments'
                                        '/%(tenant_id)d/%(template_id)d/%(filename)s')
@@ -272,6 +291,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'lily.tenant.middleware.TenantMiddleware',
+    'lily.search.middleware.DeferredIndexingMiddleware',
     'two_factor.middleware.threadlocals.ThreadLocals',
 )
 
@@ -612,26 +632,53 @@ ES_MAXSIZE = os.environ.get('ES_MAXSIZE', 2)  # Default is 10
 
 ES_BLOCK = os.environ.get('ES_BLOCK', True)  # Default is False
 
+# The number of replicas of every index, replication is disabled while an index is being rebuilt.
+ES_NUMBER_OF_REPLICAS = int(os.environ.get('ES_NUMBER_OF_REPLICAS', 1))
+
+# Where changed objects are queued before they are (re)indexed, CeleryIndexQueue or SynchronousIndexQueue.
+ES_INDEX_QUEUE_BACKEND = os.environ.get('ES_INDEX_QUEUE_BACKEND', 'lily.search.index_queue.CeleryIndexQueue')
+
+# The number of seconds changes of the same mapping are collected before they are indexed in bulk.
+ES_INDEX_QUEUE_WINDOW = int(os.environ.get('ES_INDEX_QUEUE_WINDOW', 2))
+
+# The number of days tombstones of deleted objects are kept, rebuilding an index shouldn't take longer than this.
+ES_INDEX_TOMBSTONE_DAYS = int(os.environ.get('ES_INDEX_TOMBSTONE_DAYS', 7))
+
 #######################################################################################################################
 # Gmail settings                                                                                                  #
 #######################################################################################################################
 GOOGLE_OAUTH2_CLIENT_ID = os.environ.get('GOOGLE_OAUTH2_CLIENT_ID', '')
 GOOGLE_OAUTH2_CLIENT_SECRET = os.environ.get('GOOGLE_OAUTH2_CLIENT_SECRET', '')
-GMAIL_FULL_MESSAGE_BATCH_SIZE = os.environ.get('GMAIL_FULL_MESSAGE_BATCH_SIZE', 300)
-GMAIL_LABEL_UPDATE_BATCH_SIZE = os.environ.get('GMAIL_LABEL_UPDATE_BATCH_SIZE', 500)
+GMAIL_FULL_MESSAGE_BATCH_SIZE = int(os.environ.get('GMAIL_FULL_MESSAGE_BATCH_SIZE', 300))
+# The number of requests combined in one call to the batch endpoint, Google allows at most 100.
+GMAIL_BATCH_REQUEST_SIZE = int(os.environ.get('GMAIL_BATCH_REQUEST_SIZE', 50))
+# Reconcile the labels of the existing messages on a full sync by listing the messages per label, instead of fetching
+# the labels of every message separately.
+GMAIL_FULL_SYNC_RECONCILE_LABELS = boolean(os.environ.get('GMAIL_FULL_SYNC_RECONCILE_LABELS', 1))
+# The number of message ids per page when listing the messages of a label, Google allows at most 500.
+GMAIL_LABEL_LIST_PAGE_SIZE = int(os.environ.get('GMAIL_LABEL_LIST_PAGE_SIZE', 500))
+GMAIL_LABEL_UPDATE_BATCH_SIZE = int(os.environ.get('GMAIL_LABEL_UPDATE_BATCH_SIZE', 500))
 GMAIL_PARTIAL_SYNC_LIMIT = os.environ.get('GMAIL_PARTIAL_SYNC_LIMIT', 899)
+# Path of a static copy of the discovery document of the Gmail API, otherwise it's retrieved once per process.
+GMAIL_DISCOVERY_DOCUMENT = os.environ.get('GMAIL_DISCOVERY_DOCUMENT', '')
+# Number of Gmail services with an authorized connection that are kept per email account in every process, for the
+# number of most recently used email accounts.
+GMAIL_SERVICE_POOL_SIZE = int(os.environ.get('GMAIL_SERVICE_POOL_SIZE', 2))
+GMAIL_SERVICE_POOL_ACCOUNTS = int(os.environ.get('GMAIL_SERVICE_POOL_ACCOUNTS', 200))
+# Credentials are kept in every process until their access token expires within the margin (in seconds).
+GMAIL_CREDENTIALS_CACHE_SIZE = int(os.environ.get('GMAIL_CREDENTIALS_CACHE_SIZE', 1000))
+GMAIL_CREDENTIALS_CACHE_TIMEOUT = int(os.environ.get('GMAIL_CREDENTIALS_CACHE_TIMEOUT', 3600))
+GMAIL_CREDENTIALS_EXPIRY_MARGIN = int(os.environ.get('GMAIL_CREDENTIALS_EXPIRY_MARGIN', 300))
 GMAIL_CALLBACK_URL = os.environ.get('GMAIL_CALLBACK_URL', 'http://localhost:8080/messaging/email/callback/')
 GMAIL_SYNC_DELAY_INTERVAL = 1
 GMAIL_SYNC_LOCK_LIFETIME = 300
-# A chuck size of -1 indicates that the entire file should be uploaded in a single request. If the underlying platform
-# supports streams, such as Python 2.6 or later, then this can be very efficient as it avoids multiple connections, and
-# also avoids loading the entire file into memory before sending it.
-GMAIL_CHUNK_SIZE = -1
-# Disable resumable uploads.
+# Messages larger than this number of bytes are uploaded in chunks, with a resumable upload.
 # https://developers.google.com/api-client-library/python/guide/media_upload#resumable-media-chunked-upload
-# With resumable uploads enabled, tests on sending email behave different when mocking. In the old situation resumable
-# was enabled but code handling failing uploads was missing.
-GMAIL_UPLOAD_RESUMABLE = False
+GMAIL_RESUMABLE_UPLOAD_THRESHOLD = int(os.environ.get('GMAIL_RESUMABLE_UPLOAD_THRESHOLD', 5 * 1024 * 1024))
+# Number of bytes per chunk of a resumable upload, must be a multiple of 256 KB.
+GMAIL_CHUNK_SIZE = int(os.environ.get('GMAIL_CHUNK_SIZE', 5 * 1024 * 1024))
+# Number of times an upload is retried on a transient error, resumable uploads continue where they left off.
+GMAIL_UPLOAD_RETRIES = int(os.environ.get('GMAIL_UPLOAD_RETRIES', 3))
 GMAIL_LABEL_INBOX = os.environ.get('GMAIL_LABEL_INBOX', 'INBOX')
 GMAIL_LABEL_SPAM = os.environ.get('GMAIL_LABEL_SPAM', 'SPAM')
 GMAIL_LABEL_TRASH = os.environ.get('GMAIL_LABEL_TRASH', 'TRASH')
@@ -675,6 +722,8 @@ REST_FRAMEWORK = {
 DATAPROVIDER_API_KEY = os.environ.get('DATAPROVIDER_API_KEY')
 DATAPROVIDER_API_LOOKUP_URL = 'https://api.dataprovider.com/lookup/hostname.json'
 DATAPROVIDER_API_ENRICH_URL = 'https://api.dataprovider.com/enrich/enrich.json'
+# Number of seconds the results of Dataprovider are cached per domain or phone number.
+DATAPROVIDER_CACHE_TIMEOUT = int(os.environ.get('DATAPROVIDER_CACHE_TIMEOUT', 60 * 60 * 24 * 7))
 
 INTERCOM_APP_ID = os.environ.get('INTERCOM_APP_ID', '')
 INTERCOM_KEY = os.environ.get('INTERCOM_KEY', '')
@@ -747,9 +796,41 @@ BOOTSTRAP3 = {
 }
 
 VOIPGRID_IPS = os.environ.get('VOIPGRID_IPS', '127.0.0.1')
+# In-process cache of matched callers, so repeated notifications for the same call don't hit the database.
+# Every process has its own cache that can't be cleared when a phone number, contact or account changes, so matches
+# are only kept for a few seconds.
+CALLER_ID_CACHE_SIZE = int(os.environ.get('CALLER_ID_CACHE_SIZE', '10000'))
+CALLER_ID_CACHE_TIMEOUT = int(os.environ.get('CALLER_ID_CACHE_TIMEOUT', '10'))
 
 # Temporary setting to fine tune the email migration background task.
 MIGRATE_EMAIL_COUNTDOWN = int(os.environ.get('MIGRATE_EMAIL_COUNTDOWN', '30'))
+MIGRATE_EMAIL_BATCH_SIZE = int(os.environ.get('MIGRATE_EMAIL_BATCH_SIZE', '5000'))
+
+# Number of seconds the stats of the dashboard are cached, the cache is also cleared when the rollups are updated.
+STATS_CACHE_TIMEOUT = int(os.environ.get('STATS_CACHE_TIMEOUT', 60 * 60))
+
+# Cache of the users of API tokens, in-process for a short time because other processes can't invalidate it and
+# shared through the cache backend for longer.
+AUTH_TOKEN_CACHE_SIZE = int(os.environ.get('AUTH_TOKEN_CACHE_SIZE', '1000'))
+AUTH_TOKEN_CACHE_LOCAL_TIMEOUT = int(os.environ.get('AUTH_TOKEN_CACHE_LOCAL_TIMEOUT', '30'))
+AUTH_TOKEN_CACHE_TIMEOUT = int(os.environ.get('AUTH_TOKEN_CACHE_TIMEOUT', 60 * 60))
+
+# Connection pools of the shared HTTP sessions, the default timeout in seconds and the number of threads for
+# requests sent in the background.
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', '10'))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '10'))
+HTTP_TIMEOUT = int(os.environ.get('HTTP_TIMEOUT', '30'))
+HTTP_ASYNC_WORKERS = int(os.environ.get('HTTP_ASYNC_WORKERS', '4'))
+
+# Webhook delivery, events for the same object within the batch delay are sent as one.
+WEBHOOK_BATCH_DELAY = int(os.environ.get('WEBHOOK_BATCH_DELAY', '5'))
+WEBHOOK_BATCH_SIZE = int(os.environ.get('WEBHOOK_BATCH_SIZE', '50'))
+WEBHOOK_MAX_CONCURRENCY = int(os.environ.get('WEBHOOK_MAX_CONCURRENCY', '2'))
+WEBHOOK_TIMEOUT = int(os.environ.get('WEBHOOK_TIMEOUT', '10'))
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', '8'))
+WEBHOOK_RETRY_DELAY = int(os.environ.get('WEBHOOK_RETRY_DELAY', '30'))
+WEBHOOK_MAX_RETRY_DELAY = int(os.environ.get('WEBHOOK_MAX_RETRY_DELAY', 60 * 60))
+WEBHOOK_EVENT_RETENTION_DAYS = int(os.environ.get('WEBHOOK_EVENT_RETENTION_DAYS', '7'))
 
 # Import related settings.
 IMPORT_COUNTDOWN = int(os.environ.get('IMPORT_COUNTDOWN', '3'))
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0021_auto_20180822_1303'),
+        ('deals', '0038_auto_20180822_1303'),
+        ('tenant', '0008_auto_20180822_1308'),
+        ('users', '0026_set_registration_finished_to_true'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CaseRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('is_archived', models.BooleanField(default=False)),
+                ('cases', models.PositiveIntegerField(default=0)),
+                ('tagged_cases', models.PositiveIntegerField(default=0)),
+                ('case_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cases.CaseType')),
+                ('status', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cases.CaseStatus')),
+                ('team', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='users.Team')),
+                ('tenant', models.ForeignKey(blank=True, on_delete=django.db.models.deletion.CASCADE, to='tenant.Tenant')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CaseTagRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('tag', models.CharField(max_length=50)),
+                ('cases', models.PositiveIntegerField(default=0)),
+                ('case_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cases.CaseType')),
+                ('team', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='users.Team')),
+                ('tenant', models.ForeignKey(blank=True, on_delete=django.db.models.deletion.CASCADE, to='tenant.Tenant')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DealRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('new_business', models.BooleanField(default=False)),
+                ('closed_day', models.DateField(null=True)),
+                ('next_step_date', models.DateField(null=True)),
+                ('deals', models.PositiveIntegerField(default=0)),
+                ('amount_recurring', models.DecimalField(decimal_places=2, default=0, max_digits=19)),
+                ('assigned_to', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('status', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='deals.DealStatus')),
+                ('tenant', models.ForeignKey(blank=True, on_delete=django.db.models.deletion.CASCADE, to='tenant.Tenant')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='caserollup',
+            index_together=set([('tenant', 'team', 'day')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='casetagrollup',
+            index_together=set([('tenant', 'team', 'day')]),
+        ),
+    ]
@@ -0,0 +1,56 @@
+from django.db import models
+
+from lily.cases.models import CaseStatus, CaseType
+from lily.deals.models import DealStatus
+from lily.tenant.models import TenantMixin
+from lily.users.models import LilyUser, Team
+
+
+class CaseRollup(TenantMixin):
+    """
+    Number of cases per team, created day, type, status and archived state.
+
+    Maintained by the update_stats_rollups task, so the stats views don't need to join and scan the cases.
+    """
+    team = models.ForeignKey(Team, related_name='+')
+    day = models.DateField()
+    case_type = models.ForeignKey(CaseType, related_name='+')
+    status = models.ForeignKey(CaseStatus, related_name='+')
+    is_archived = models.BooleanField(default=False)
+    cases = models.PositiveIntegerField(default=0)
+    # Number of those cases that have at least one tag.
+    tagged_cases = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        index_together = [
+            ['tenant', 'team', 'day'],
+        ]
+
+
+class CaseTagRollup(TenantMixin):
+    """
+    Number of cases per team, created day, type and tag.
+    """
+    team = models.ForeignKey(Team, related_name='+')
+    day = models.DateField()
+    case_type = models.ForeignKey(CaseType, related_name='+')
+    tag = models.CharField(max_length=50)
+    cases = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        index_together = [
+            ['tenant', 'team', 'day'],
+        ]
+
+
+class DealRollup(TenantMixin):
+    """
+    Number and recurring amount of the deals per assigned user, status, new business, closed day and next step date.
+    """
+    assigned_to = models.ForeignKey(LilyUser, related_name='+')
+    status = models.ForeignKey(DealStatus, related_name='+')
+    new_business = models.BooleanField(default=False)
+    closed_day = models.DateField(null=True)
+    next_step_date = models.DateField(null=True)
+    deals = models.PositiveIntegerField(default=0)
+    amount_recurring = models.DecimalField(default=0, max_digits=19, decimal_places=2)
@@ -0,0 +1,191 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+from lily.cases.models import Case
+from lily.deals.models import Deal
+from lily.tags.models import Tag
+from lily.tenant.models import Tenant
+
+from .models import CaseRollup, CaseTagRollup, DealRollup
+
+
+STATS_VERSION_KEY = 'stats_version:%s'
+
+
+def get_stats_version(tenant_id):
+    """
+    Return the version of the rollups of the tenant, which changes every time the rollups are updated.
+    """
+    return cache.get(STATS_VERSION_KEY % tenant_id, 0)
+
+
+def invalidate_stats(tenant_id):
+    """
+    Invalidate the cached stats of the tenant.
+
+    Args:
+        tenant_id (int): the tenant of which the rollups were updated
+    """
+    key = STATS_VERSION_KEY % tenant_id
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Not set yet or expired, so start a new version.
+        cache.set(key, get_stats_version(tenant_id) + 1, None)
+
+
+def update_case_rollups(tenant_id, days=None):
+    """
+    Recalculate the case rollups of the tenant.
+
+    Cases never change their created day, so the rollups of a day only change when one of the cases created on that
+    day changes.
+
+    Args:
+        tenant_id (int): the tenant to update the rollups for
+        days (iterable, optional): the created days to update, all days if not given
+    """
+    # Clear the default ordering, so it doesn't end up in the GROUP BY clauses.
+    cases = Case._base_manager.filter(
+        tenant_id=tenant_id,
+        is_deleted=False
+    ).annotate(day=TruncDate('created')).order_by()
+    rollups = CaseRollup.objects.filter(tenant_id=tenant_id)
+    tag_rollups = CaseTagRollup.objects.filter(tenant_id=tenant_id)
+
+    if days is not None:
+        days = list(days)
+        cases = cases.filter(day__in=days)
+        rollups = rollups.filter(day__in=days)
+        tag_rollups = tag_rollups.filter(day__in=days)
+
+    tagged_case_ids = Tag._base_manager.filter(
+        tenant_id=tenant_id,
+        content_type=ContentType.objects.get_for_model(Case)
+    ).exclude(name='').values('object_id')
+
+    fields = ('assigned_to_teams', 'day', 'type', 'status', 'is_archived')
+    counts = {}
+    for row in cases.values(*fields).annotate(count=Count('id')):
+        if row['assigned_to_teams']:
+            counts[tuple(row[field] for field in fields)] = [row['count'], 0]
+
+    for row in cases.filter(pk__in=tagged_case_ids).values(*fields).annotate(count=Count('id')):
+        key = tuple(row[field] for field in fields)
+        if key in counts:
+            counts[key][1] = row['count']
+
+    tag_fields = ('assigned_to_teams', 'day', 'type', 'tags__name')
+    tag_counts = [
+        row for row in cases.values(*tag_fields).annotate(count=Count('id'))
+        if row['assigned_to_teams'] and row['tags__name']
+    ]
+
+    with transaction.atomic():
+        rollups.delete()
+        tag_rollups.delete()
+
+        CaseRollup.objects.bulk_create([
+            CaseRollup(
+                tenant_id=tenant_id,
+                team_id=team_id,
+                day=day,
+                case_type_id=case_type_id,
+                status_id=status_id,
+                is_archived=is_archived,
+                cases=count,
+                tagged_cases=tagged_count,
+            ) for (team_id, day, case_type_id, status_id, is_archived), (count, tagged_count) in counts.items()
+        ])
+        CaseTagRollup.objects.bulk_create([
+            CaseTagRollup(
+                tenant_id=tenant_id,
+                team_id=row['assigned_to_teams'],
+                day=row['day'],
+                case_type_id=row['type'],
+                tag=row['tags__name'],
+                cases=row['count'],
+            ) for row in tag_counts
+        ])
+
+
+def update_deal_rollups(tenant_id):
+    """
+    Recalculate the deal rollups of the tenant.
+
+    Both the closed and next step date of a deal can change, so the rollups are always recalculated completely.
+
+    Args:
+        tenant_id (int): the tenant to update the rollups for
+    """
+    deals = Deal._base_manager.filter(
+        tenant_id=tenant_id,
+        is_deleted=False,
+        assigned_to__isnull=False
+    ).annotate(closed_day=TruncDate('closed_date')).order_by()
+
+    fields = ('assigned_to', 'status', 'new_business', 'closed_day', 'next_step_date')
+    rows = deals.values(*fields).annotate(count=Count('id'), amount=Sum('amount_recurring'))
+
+    with transaction.atomic():
+        DealRollup.objects.filter(tenant_id=tenant_id).delete()
+
+        DealRollup.objects.bulk_create([
+            DealRollup(
+                tenant_id=tenant_id,
+                assigned_to_id=row['assigned_to'],
+                status_id=row['status'],
+                new_business=row['new_business'],
+                closed_day=row['closed_day'],
+                next_step_date=row['next_step_date'],
+                deals=row['count'],
+                amount_recurring=row['amount'] or 0,
+            ) for row in rows
+        ])
+
+
+def update_rollups(since=None):
+    """
+    Update the rollups for everything that changed since the given time.
+
+    Deleting a tag doesn't leave a trace, so the rollups should be rebuilt completely every now and then.
+
+    Args:
+        since (datetime, optional): only update the rollups affected by changes after this time, rebuild all rollups
+            if not given
+    """
+    if since is None:
+        for tenant_id in Tenant.objects.values_list('pk', flat=True):
+            update_case_rollups(tenant_id)
+            update_deal_rollups(tenant_id)
+            invalidate_stats(tenant_id)
+        return
+
+    # Tags keep track of when they were last changed, so also update the days of cases with changed tags.
+    changed_tags = Tag._base_manager.filter(
+        content_type=ContentType.objects.get_for_model(Case),
+        last_used__gte=since
+    ).values('object_id')
+    changed_cases = Case._base_manager.filter(modified__gte=since) | Case._base_manager.filter(pk__in=changed_tags)
+
+    changed_days = changed_cases.annotate(day=TruncDate('created')).values_list('tenant_id', 'day').order_by()
+
+    case_days = {}
+    for tenant_id, day in changed_days.distinct():
+        case_days.setdefault(tenant_id, set()).add(day)
+
+    deal_tenant_ids = set(
+        Deal._base_manager.filter(modified__gte=since).values_list('tenant_id', flat=True).order_by().distinct()
+    )
+
+    for tenant_id, days in case_days.items():
+        update_case_rollups(tenant_id, days)
+
+    for tenant_id in deal_tenant_ids:
+        update_deal_rollups(tenant_id)
+
+    for tenant_id in deal_tenant_ids.union(case_days):
+        invalidate_stats(tenant_id)
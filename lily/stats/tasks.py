@@ -0,0 +1,39 @@
+import calendar
+import logging
+from datetime import datetime, timedelta
+
+import redis
+from celery.task import task
+from django.conf import settings
+from django.utils import timezone
+
+from .rollups import update_rollups
+
+logger = logging.getLogger(__name__)
+
+STATS_ROLLUP_WATERMARK_KEY = 'stats:rollup_watermark'
+
+# Changes are picked up from slightly before the previous run, so differences between server clocks don't matter.
+STATS_ROLLUP_MARGIN = timedelta(minutes=1)
+
+
+@task(name='update_stats_rollups', logger=logger)
+def update_stats_rollups(full=False):
+    """
+    Update the stats rollups with the changes since the previous run.
+
+    Args:
+        full (bool, optional): rebuild all rollups instead, which is also done when there is no previous run
+    """
+    client = redis.StrictRedis.from_url(settings.REDIS_URL)
+    started = timezone.now()
+
+    watermark = None if full else client.get(STATS_ROLLUP_WATERMARK_KEY)
+    if watermark is None:
+        logger.info('Rebuilding all stats rollups.')
+        update_rollups()
+    else:
+        since = datetime.fromtimestamp(int(watermark), timezone.utc) - STATS_ROLLUP_MARGIN
+        update_rollups(since)
+
+    client.set(STATS_ROLLUP_WATERMARK_KEY, calendar.timegm(started.utctimetuple()))
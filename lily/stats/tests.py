@@ -1,7 +1,14 @@
+from datetime import timedelta
+
+import anyjson
 from django.urls import reverse
 from django.test import TestCase
+from django.utils import timezone
 
+from lily.cases.factories import CaseFactory
+from lily.cases.models import Case
 from lily.users.factories import TeamFactory, LilyUserFactory
+from .rollups import update_rollups
 from .urls import case_patterns, deal_patterns
 
 
@@ -26,3 +33,29 @@ class StatsTests(TestCase):
             # Loop over deal patterns, these need no kwargs.
             response = self.client.get(reverse(pattern.name))
             self.assertEqual(response.status_code, 200)
+
+    def test_rollups(self):
+        """
+        Test that the stats are calculated from the rollups and follow changes after an update.
+        """
+        user_obj = LilyUserFactory(is_active=True)
+        team = TeamFactory(tenant=user_obj.tenant)
+        cases = CaseFactory.create_batch(size=3, tenant=user_obj.tenant, teams=team)
+        # Move two of the cases to last week.
+        Case.objects.filter(pk__in=[cases[0].pk, cases[1].pk]).update(created=timezone.now() - timedelta(weeks=1))
+        update_rollups()
+
+        self.client.login(username=user_obj.email, password='admin')
+        url = reverse('stats_cases_total', kwargs={'team_id': team.id})
+
+        response = self.client.get(url)
+        self.assertEqual(anyjson.loads(response.content), [{'count': '2'}])
+
+        since = timezone.now()
+        cases[0].refresh_from_db()
+        cases[0].is_deleted = True
+        cases[0].save()
+        update_rollups(since)
+
+        response = self.client.get(url)
+        self.assertEqual(anyjson.loads(response.content), [{'count': '1'}])
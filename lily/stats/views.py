@@ -1,40 +1,74 @@
+import datetime
+from decimal import Decimal, ROUND_HALF_UP
+
 import anyjson
+from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.db import connection
+from django.core.cache import cache
+from django.db.models import Sum
 from django.http import HttpResponse
+from django.utils import timezone
 from django.views.generic import View
 
-from lily.deals.models import DealStatus
+from .models import CaseRollup, CaseTagRollup, DealRollup
+from .rollups import get_stats_version
+
+
+STATS_CACHE_KEY = 'stats:%(view)s:%(tenant)s:%(version)s:%(team)s:%(period)s'
 
 
-def dictfetchall(cursor):
+def last_week(today):
     """
-    Return all rows from a cursor as a dict
+    Return the first day of last week and the first day of this week.
     """
-    desc = cursor.description
-    return [
-        dict(zip([col[0] for col in desc], row))
-        for row in cursor.fetchall()
-    ]
+    start = today - datetime.timedelta(days=today.weekday() + 7)
+    return start, start + datetime.timedelta(weeks=1)
 
 
-class RawDatabaseView(LoginRequiredMixin, View):
+def last_month(today):
+    """
+    Return the first day of last month and the first day of this month.
+    """
+    end = today.replace(day=1)
+    return (end - datetime.timedelta(days=1)).replace(day=1), end
 
-    def get(self, request, *args, **kwargs):
 
-        query = self.get_query(request, *args, **kwargs)
+def start_of_day(day):
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+def average(total, count):
+    return (total / count).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+
+class RollupView(LoginRequiredMixin, View):
+    """
+    Base view for the stats, which are calculated from the rollups instead of the cases and deals themselves.
 
-        if query:
-            cursor = connection.cursor()
-            cursor.execute(query)
+    The results are cached per tenant, team and period, so all users of a team share them until the rollups change.
+    """
 
-            results = self.parse_results(dictfetchall(cursor))
-        else:
-            results = []
+    def get(self, request, *args, **kwargs):
+        tenant_id = request.user.tenant_id
+        team_id = int(kwargs['team_id']) if 'team_id' in kwargs else None
+        today = timezone.localdate()
+
+        cache_key = STATS_CACHE_KEY % {
+            'view': self.__class__.__name__,
+            'tenant': tenant_id,
+            'version': get_stats_version(tenant_id),
+            'team': team_id,
+            'period': today.isoformat(),
+        }
+        results = cache.get(cache_key)
+
+        if results is None:
+            results = self.parse_results(self.get_results(tenant_id, team_id, today))
+            cache.set(cache_key, results, settings.STATS_CACHE_TIMEOUT)
 
         return HttpResponse(anyjson.dumps(results))
 
-    def get_query(self, request, *args, **kwargs):
+    def get_results(self, tenant_id, team_id, today):
         raise NotImplementedError
 
     def parse_results(self, results):
@@ -45,298 +79,161 @@ class RawDatabaseView(LoginRequiredMixin, View):
                 try:
                     parsed_row[key] = str(value)
                 except UnicodeEncodeError:
-                    parsed_row[key] = unicode(value, 'utf-8', errors='ignore')
+                    parsed_row[key] = unicode(value)
             parsed_results.append(parsed_row)
         return parsed_results
 
 
-class CasesTotalCountLastWeek(RawDatabaseView):
-
-    def get_query(self, request, *args, **kwargs):
-        return '''
-            SELECT
-                count (cases_case.id)
-            FROM
-                cases_case,
-                cases_casestatus,
-                cases_casetype,
-                cases_case_assigned_to_teams
-            WHERE
-                cases_case.status_id = cases_casestatus.id AND
-                cases_case.type_id = cases_casetype.id AND
-                cases_case.id = cases_case_assigned_to_teams.case_id AND
-                cases_case.tenant_id = {tenant_id} AND
-                cases_case_assigned_to_teams.team_id = {team_id} AND
-                cases_case.is_deleted = false AND
-
-                /*last week*/
-                cases_case.created BETWEEN  date_trunc( 'week', now() - interval '1 week' ) AND
-                date_trunc( 'week', now() - interval '1 week' )+ interval '1 week' - interval '1 second';
-        '''.format(
-            tenant_id=request.user.tenant_id,
-            team_id=int(kwargs['team_id']),
-        )
-
-
-class CasesPerTypeCountLastWeek(RawDatabaseView):
-
-    def get_query(self, request, *args, **kwargs):
-        return '''
-            SELECT
-                count(cases_case.id),
-                cases_casetype.name,
-                date_trunc( 'week', now() - interval '1 week' ) as from,
-                (date_trunc('week', now() - interval '1 week' ) + interval '1 week' - interval '1 second') as to,
-                EXTRACT(WEEK FROM date_trunc( 'week', now() - interval '1 week' )) as weeknr
-            FROM
-                cases_case,
-                cases_casestatus,
-                cases_casetype,
-                cases_case_assigned_to_teams
-            WHERE
-                cases_case.status_id = cases_casestatus.id AND
-                cases_case.type_id = cases_casetype.id AND
-                cases_case.id = cases_case_assigned_to_teams.case_id AND
-                cases_case.tenant_id = {tenant_id} AND
-                cases_case_assigned_to_teams.team_id = {team_id} AND
-                cases_case.is_deleted = false AND
-
-                /*last week*/
-                cases_case.created BETWEEN  date_trunc( 'week', now() - interval '1 week' ) AND
-                date_trunc( 'week', now() - interval '1 week' )+ interval '1 week' - interval '1 second'
-            GROUP BY
-                cases_casetype.name;
-        '''.format(
-            tenant_id=request.user.tenant_id,
-            team_id=int(kwargs['team_id']),
-        )
-
-
-class CasesWithTagsLastWeek(RawDatabaseView):
-    def get_query(self, request, *args, **kwargs):
-        return '''
-            SELECT
-                count(DISTINCT(cases_case.id)),
-                date_trunc( 'week', now() - interval '1 week' ) as start,
-                (date_trunc( 'week', now() - interval '1 week' ) + interval '1 week' - interval '1 second') as end
-            FROM
-                cases_case,
-                cases_casestatus,
-                cases_casetype,
-                cases_case_assigned_to_teams,
-                tags_tag
-            WHERE
-                cases_case.status_id = cases_casestatus.id AND
-                cases_case.type_id = cases_casetype.id AND
-                cases_case.id = cases_case_assigned_to_teams.case_id AND
-                cases_case.id = tags_tag.object_id AND
-                tags_tag.name != '' AND
-                tags_tag.tenant_id = {tenant_id} AND
-                cases_case_assigned_to_teams.team_id = {team_id} AND
-                cases_case.is_deleted = false AND
-
-                /*last week*/
-                cases_case.created BETWEEN date_trunc( 'week', now() - interval '1 week' ) AND
-                date_trunc( 'week', now() - interval '1 week' )+ interval '1 week' - interval '1 second';
-        '''.format(
-            tenant_id=request.user.tenant_id,
-            team_id=int(kwargs['team_id']),
-        )
-
-
-class CasesCountPerStatus(RawDatabaseView):
-    def get_query(self, request, *args, **kwargs):
-        return '''
-            SELECT
-                count (cases_case.id), cases_casestatus.name
-            FROM
-                cases_case,
-                cases_casestatus,
-                cases_casetype,
-                cases_case_assigned_to_teams
-            WHERE
-                cases_case.status_id = cases_casestatus.id AND
-                cases_case.type_id = cases_casetype.id AND
-                cases_case.id = cases_case_assigned_to_teams.case_id AND
-                cases_case.tenant_id = {tenant_id} AND
-                cases_case_assigned_to_teams.team_id = {team_id} AND
-                cases_case.is_deleted = false AND
-                cases_case.is_archived = false AND
-                cases_casestatus.name != 'Closed'
-            GROUP BY
-                cases_casestatus.name;
-          '''.format(
-            tenant_id=request.user.tenant_id,
-            team_id=int(kwargs['team_id']),
-        )
-
-
-class CasesTopTags(RawDatabaseView):
-    def get_query(self, request, *args, **kwargs):
-        return '''
-            SELECT
-                count(tags_tag.name), tags_tag.name
-            FROM
-                cases_case,
-                cases_casestatus,
-                cases_casetype,
-                cases_case_assigned_to_teams,
-                tags_tag
-            WHERE
-                cases_case.status_id = cases_casestatus.id AND
-                cases_case.type_id = cases_casetype.id AND
-                cases_case.id = cases_case_assigned_to_teams.case_id AND
-                cases_case.id = tags_tag.object_id AND
-                tags_tag.name <> '' AND
-                tags_tag.tenant_id = {tenant_id} AND
-                cases_case.is_deleted = false AND
-                cases_case.created BETWEEN date_trunc('month', now()- interval '1 month') AND
-                date_trunc('month', now()) - interval '1 second' AND
-                cases_case_assigned_to_teams.team_id = {team_id} AND
-                cases_casetype.name != 'Config' AND
-                cases_casetype.name != 'Retour' AND
-                cases_casetype.name != 'Callback'
-            GROUP BY
-                tags_tag.name
-            HAVING
-                COUNT (tags_tag.name) > 2
-            ORDER BY
-                count(tags_tag.name) desc
-            LIMIT 15;
-          '''.format(
-            tenant_id=request.user.tenant_id,
-            team_id=int(kwargs['team_id']),
-        )
-
-
-class DealsUrgentFollowUp(RawDatabaseView):
-    def get_query(self, request, *args, **kwargs):
-        try:
-            deal_status_open = DealStatus.objects.get(name='Open')
-            deal_status_proposal_sent = DealStatus.objects.get(name='Proposal sent')
-        except DealStatus.DoesNotExist:
-            return ''
-
-        return '''
-            SELECT
-                users_lilyuser.last_name,
-                count(deals_deal.id) as NrOfDeals
-            FROM
-                public.users_lilyuser,
-                public.deals_deal
-            WHERE
-                deals_deal.assigned_to_id = users_lilyuser.id AND
-                deals_deal.next_step_date < now() - interval '7 days' AND
-                deals_deal.next_step_date > now() - interval '60 days' AND
-                deals_deal.tenant_id = {tenant_id} AND
-                deals_deal.is_deleted = false AND
-                (deals_deal.status_id = {status_id_open} or deals_deal.status_id = {status_id_proposal_sent})
-            GROUP BY
-               users_lilyuser.first_name, users_lilyuser.last_name
-            ORDER BY
-               users_lilyuser.last_name;
-        '''.format(
-            tenant_id=request.user.tenant_id,
-            status_id_open=deal_status_open.pk,
-            status_id_proposal_sent=deal_status_proposal_sent.pk
-        )
-
-
-class DealsWon(RawDatabaseView):
-    def get_query(self, request, *args, **kwargs):
-        try:
-            deal_status = DealStatus.objects.get(name='Won')
-        except DealStatus.DoesNotExist:
-            return ''
-
-        return '''
-            SELECT
-                users_lilyuser.last_name,
-                count(deals_deal.id) as NrOfDealsWon,
-                sum(deals_deal.amount_recurring) as TotalAmountDealsWon,
-                ROUND(sum(deals_deal.amount_recurring)/count(deals_deal.id),2) as AvgPerDealWon
-            FROM
-                public.users_lilyuser,
-                public.deals_deal
-            WHERE
-                deals_deal.assigned_to_id = users_lilyuser.id AND
-                deals_deal.closed_date > now() - interval '30 days month' AND
-                deals_deal.tenant_id = {tenant_id} AND
-                deals_deal.is_deleted = false AND
-                deals_deal.new_business = true AND
-                deals_deal.status_id = {status_id}
-            GROUP BY
-                users_lilyuser.last_name
-            ORDER BY
-                users_lilyuser.last_name;
-        '''.format(
-            tenant_id=request.user.tenant_id,
-            status_id=deal_status.pk
-        )
-
-
-class DealsLost(RawDatabaseView):
-    def get_query(self, request, *args, **kwargs):
-        try:
-            deal_status = DealStatus.objects.get(name='Lost')
-        except DealStatus.DoesNotExist:
-            return ''
-
-        return '''
-            SELECT
-                users_lilyuser.last_name,
-                count(deals_deal.id) as NrOfNotWonDeals,
-                sum(deals_deal.amount_recurring) as TotalAmountNotWonDeals,
-                ROUND(sum(deals_deal.amount_recurring)/count(deals_deal.id),2) as AvgPerNotWonDeal
-            FROM
-                public.users_lilyuser,
-                public.deals_deal
-            WHERE
-                deals_deal.assigned_to_id = users_lilyuser.id AND
-                deals_deal.closed_date > now() - interval '30 days month' AND
-                deals_deal.tenant_id = {tenant_id} AND
-                deals_deal.status_id = {status_id} AND
-                deals_deal.is_deleted = false AND
-                deals_deal.new_business = true
-            GROUP BY
-                users_lilyuser.last_name,deals_deal.new_business
-            ORDER BY
-                users_lilyuser.last_name;
-        '''.format(
-            tenant_id=request.user.tenant_id,
-            status_id=deal_status.pk
-        )
-
-
-class DealsAmountRecurring(RawDatabaseView):
-    def get_query(self, request, *args, **kwargs):
-        try:
-            deal_status = DealStatus.objects.get(name='Won')
-        except DealStatus.DoesNotExist:
-            return ''
-
-        return '''
-            SELECT
-                users_lilyuser.last_name,
-                count(deals_deal.id) as NrOfWonDeals,
-                sum(deals_deal.amount_recurring) as TotalAmountWonDeals,
-                ROUND(sum(deals_deal.amount_recurring)/count(deals_deal.id),2) as AvgPerWonDeal,
-                deals_deal.new_business
-            FROM
-                public.users_lilyuser,
-                public.deals_deal
-            WHERE
-                deals_deal.assigned_to_id = users_lilyuser.id AND
-                deals_deal.closed_date > now() - interval '30 days month' AND
-                deals_deal.is_deleted = false AND
-                deals_deal.tenant_id = {tenant_id} AND
-                deals_deal.new_business = false AND
-                deals_deal.status_id = {status_id}
-            GROUP BY
-                users_lilyuser.last_name,deals_deal.new_business
-            ORDER BY
-                users_lilyuser.last_name,deals_deal.new_business;
-        '''.format(
-            tenant_id=request.user.tenant_id,
-            status_id=deal_status.pk
-        )
+class CasesTotalCountLastWeek(RollupView):
+
+    def get_results(self, tenant_id, team_id, today):
+        start, end = last_week(today)
+
+        count = CaseRollup.objects.filter(
+            tenant_id=tenant_id,
+            team_id=team_id,
+            day__gte=start,
+            day__lt=end,
+        ).aggregate(count=Sum('cases'))['count']
+
+        return [{'count': count or 0}]
+
+
+class CasesPerTypeCountLastWeek(RollupView):
+
+    def get_results(self, tenant_id, team_id, today):
+        start, end = last_week(today)
+
+        rows = CaseRollup.objects.filter(
+            tenant_id=tenant_id,
+            team_id=team_id,
+            day__gte=start,
+            day__lt=end,
+        ).values('case_type__name').annotate(count=Sum('cases')).order_by()
+
+        return [{
+            'count': row['count'],
+            'name': row['case_type__name'],
+            'from': start_of_day(start),
+            'to': start_of_day(end) - datetime.timedelta(seconds=1),
+            'weeknr': start.isocalendar()[1],
+        } for row in rows]
+
+
+class CasesWithTagsLastWeek(RollupView):
+
+    def get_results(self, tenant_id, team_id, today):
+        start, end = last_week(today)
+
+        count = CaseRollup.objects.filter(
+            tenant_id=tenant_id,
+            team_id=team_id,
+            day__gte=start,
+            day__lt=end,
+        ).aggregate(count=Sum('tagged_cases'))['count']
+
+        return [{
+            'count': count or 0,
+            'start': start_of_day(start),
+            'end': start_of_day(end) - datetime.timedelta(seconds=1),
+        }]
+
+
+class CasesCountPerStatus(RollupView):
+
+    def get_results(self, tenant_id, team_id, today):
+        rows = CaseRollup.objects.filter(
+            tenant_id=tenant_id,
+            team_id=team_id,
+            is_archived=False,
+        ).exclude(
+            status__name='Closed',
+        ).values('status__name').annotate(count=Sum('cases')).order_by()
+
+        return [{'count': row['count'], 'name': row['status__name']} for row in rows]
+
+
+class CasesTopTags(RollupView):
+
+    def get_results(self, tenant_id, team_id, today):
+        start, end = last_month(today)
+
+        rows = CaseTagRollup.objects.filter(
+            tenant_id=tenant_id,
+            team_id=team_id,
+            day__gte=start,
+            day__lt=end,
+        ).exclude(
+            case_type__name__in=['Config', 'Retour', 'Callback'],
+        ).values('tag').annotate(count=Sum('cases')).filter(count__gt=2).order_by('-count')[:15]
+
+        return [{'count': row['count'], 'name': row['tag']} for row in rows]
+
+
+class DealsUrgentFollowUp(RollupView):
+
+    def get_results(self, tenant_id, team_id, today):
+        rows = DealRollup.objects.filter(
+            tenant_id=tenant_id,
+            status__name__in=['Open', 'Proposal sent'],
+            next_step_date__gt=today - datetime.timedelta(days=60),
+            next_step_date__lte=today - datetime.timedelta(days=7),
+        ).values(
+            'assigned_to__first_name',
+            'assigned_to__last_name',
+        ).annotate(count=Sum('deals')).order_by('assigned_to__last_name')
+
+        return [{'last_name': row['assigned_to__last_name'], 'nrofdeals': row['count']} for row in rows]
+
+
+class DealsClosedView(RollupView):
+    """
+    Base view for the number and recurring amount of the deals per user, closed in the last 30 days.
+    """
+    status = None
+    new_business = None
+    fields = ()
+
+    def get_results(self, tenant_id, team_id, today):
+        rows = DealRollup.objects.filter(
+            tenant_id=tenant_id,
+            status__name=self.status,
+            new_business=self.new_business,
+            closed_day__gt=today - datetime.timedelta(days=30),
+        ).values('assigned_to__last_name').annotate(
+            count=Sum('deals'),
+            amount=Sum('amount_recurring'),
+        ).order_by('assigned_to__last_name')
+
+        count_field, amount_field, average_field = self.fields
+
+        return [{
+            'last_name': row['assigned_to__last_name'],
+            count_field: row['count'],
+            amount_field: row['amount'],
+            average_field: average(row['amount'], row['count']),
+        } for row in rows]
+
+
+class DealsWon(DealsClosedView):
+    status = 'Won'
+    new_business = True
+    fields = ('nrofdealswon', 'totalamountdealswon', 'avgperdealwon')
+
+
+class DealsLost(DealsClosedView):
+    status = 'Lost'
+    new_business = True
+    fields = ('nrofnotwondeals', 'totalamountnotwondeals', 'avgpernotwondeal')
+
+
+class DealsAmountRecurring(DealsClosedView):
+    status = 'Won'
+    new_business = False
+    fields = ('nrofwondeals', 'totalamountwondeals', 'avgperwondeal')
+
+    def get_results(self, tenant_id, team_id, today):
+        results = super(DealsAmountRecurring, self).get_results(tenant_id, team_id, today)
+        for row in results:
+            row['new_business'] = self.new_business
+        return results
@@ -24,6 +24,7 @@ class LilyNoseTestSuiteRunner(DiscoverRunner):
     Customize settings to run the test suite without problems.
     Settings it changes:
         * TESTING=True, useful to check if we are running tests.
+        * ES_INDEX_QUEUE_BACKEND, changes are indexed synchronously.
     """
     def __init__(self, *args, **kwargs):
         super(LilyNoseTestSuiteRunner, self).__init__(*args, **kwargs)
@@ -38,5 +39,8 @@ class LilyNoseTestSuiteRunner(DiscoverRunner):
         # manage.py test lily/contacts/tests.
         settings.DEBUG = False
 
+        # Index changes right away, so tests don't depend on a Celery worker.
+        settings.ES_INDEX_QUEUE_BACKEND = 'lily.search.index_queue.SynchronousIndexQueue'
+
         # Disable migrations so the database is built faster.
         settings.MIGRATION_MODULES = DisableMigrations()
@@ -2,12 +2,14 @@ import json
 
 from mock import patch
 from rest_framework import status
+from rest_framework.authtoken.models import Token
 
 from django.forms.models import model_to_dict
 
 from lily.billing.models import Billing
 from lily.tenant.middleware import set_current_user
 from lily.tests.utils import GenericAPITestCase
+from lily.users.authentication.tokens import get_token_user, token_cache
 from lily.users.api.serializers import LilyUserSerializer
 from lily.users.factories import LilyUserFactory
 from lily.users.models import LilyUser
@@ -138,3 +140,56 @@ class LilyUserTests(GenericAPITestCase):
         request = self.user.delete(self.get_url(self.detail_url, kwargs={'pk': db_obj.pk}))
         self.assertStatus(request, status.HTTP_204_NO_CONTENT)
         self.assertFalse(self.model_cls.objects.get(pk=db_obj.pk).is_active)
+
+    def test_token_user_cache(self):
+        """
+        Test that the user of a token is cached and removed from the cache when the token or user changes.
+        """
+        token_cache.clear()
+        user = LilyUserFactory.create(tenant=self.user_obj.tenant, is_active=True)
+        token = Token.objects.create(user=user)
+
+        self.assertEqual(get_token_user(token.key).pk, user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_token_user(token.key).pk, user.pk)
+
+        user.is_active = False
+        user.save()
+        self.assertFalse(get_token_user(token.key).is_active)
+
+        token.delete()
+        self.assertIsNone(get_token_user(token.key))
+
+    def test_token_cache_stats(self):
+        """
+        Test that the token lookups per result are shown to staff users only.
+        """
+        token_cache.clear()
+        user = LilyUserFactory.create(tenant=self.user_obj.tenant, is_active=True)
+        token = Token.objects.create(user=user)
+
+        request = self.superuser.get('/api/users/token-cache-stats/')
+        self.assertStatus(request, status.HTTP_200_OK)
+        stats = request.data
+
+        get_token_user(token.key)
+        get_token_user(token.key)
+
+        request = self.superuser.get('/api/users/token-cache-stats/')
+        self.assertEqual(request.data['miss'], stats['miss'] + 1)
+        self.assertEqual(request.data['local_hit'], stats['local_hit'] + 1)
+
+        request = self.user.get('/api/users/token-cache-stats/')
+        self.assertStatus(request, status.HTTP_403_FORBIDDEN)
+
+    def test_token_user_copies(self):
+        """
+        Test that the cached user and its tenant are copied for every lookup.
+        """
+        token_cache.clear()
+        user = LilyUserFactory.create(tenant=self.user_obj.tenant, is_active=True)
+        token = Token.objects.create(user=user)
+
+        get_token_user(token.key).tenant.name = 'Changed'
+
+        self.assertNotEqual(get_token_user(token.key).tenant.name, 'Changed')
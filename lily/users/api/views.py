@@ -17,7 +17,8 @@ from rest_framework.exceptions import PermissionDenied
 from rest_framework.filters import OrderingFilter
 from rest_framework.response import Response
 from rest_framework.parsers import JSONParser, MultiPartParser
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.views import APIView
 from two_factor.models import PhoneDevice
 from two_factor.templatetags.two_factor import mask_phone_number, format_phone_number
 from two_factor.utils import default_device, backup_phones
@@ -25,6 +26,7 @@ from user_sessions.models import Session
 from templated_email import send_templated_mail
 
 from lily.users.api.filters import TeamFilter, LilyUserFilter
+from lily.users.authentication.tokens import get_token_cache_stats
 from lily.utils.api.permissions import IsAccountAdmin
 from lily.utils.functions import post_intercom_event
 
@@ -408,3 +410,14 @@ class SessionViewSet(mixins.RetrieveModelMixin,
         Set the queryset here so it filters on tenant and works with pagination.
         """
         return self.request.user.session_set.filter(expire_date__gt=timezone.now()).order_by('-last_activity')
+
+
+class TokenCacheStats(APIView):
+    """
+    Show the number of token lookups per result of the process that handles the request.
+    """
+    permission_classes = (IsAdminUser, )
+    swagger_schema = None
+
+    def get(self, request, format=None, *args, **kwargs):
+        return Response(get_token_cache_stats())
@@ -0,0 +1,115 @@
+import copy
+import hashlib
+import threading
+from collections import Counter
+
+from ddtrace import tracer
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.authtoken.models import Token
+
+from lily.utils.cache import LRUCache
+
+
+TOKEN_CACHE_KEY = 'auth_token:%s'
+
+token_cache = LRUCache(size=settings.AUTH_TOKEN_CACHE_SIZE, timeout=settings.AUTH_TOKEN_CACHE_LOCAL_TIMEOUT)
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def get_token_cache_key(key):
+    # Don't use the tokens themselves as cache keys, so they don't end up in the cache backend.
+    return TOKEN_CACHE_KEY % hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def count_lookup(result):
+    """
+    Count the result of a token lookup in this process and tag the request trace with it.
+
+    Args:
+        result (str): 'local_hit', 'shared_hit' or 'miss'
+    """
+    with _stats_lock:
+        _stats[result] += 1
+
+    span = tracer.current_span()
+    if span:
+        span.set_tag('auth.token_cache', result)
+
+
+def get_token_cache_stats():
+    """
+    Return the number of token lookups of this process per result.
+
+    Returns:
+        dict: number of 'local_hit', 'shared_hit' and 'miss' lookups
+    """
+    with _stats_lock:
+        return {result: _stats[result] for result in ('local_hit', 'shared_hit', 'miss')}
+
+
+def get_token_user(key):
+    """
+    Return the user of the token.
+
+    The user is looked up in the in-process cache first, then in the shared cache and only then in the database.
+    Inactive users are returned as well, so the callers can decide how to handle them.
+
+    Args:
+        key (str): the key of the token
+
+    Returns:
+        LilyUser instance or None if the token doesn't exist
+    """
+    cache_key = get_token_cache_key(key)
+
+    user = token_cache.get(cache_key)
+    if user is not None:
+        count_lookup('local_hit')
+        # Every request gets its own instance, including the tenant, so changes to it don't leak into other requests.
+        return copy.deepcopy(user)
+
+    user = cache.get(cache_key)
+    if user is not None:
+        count_lookup('shared_hit')
+        token_cache.set(cache_key, user)
+        return copy.deepcopy(user)
+
+    count_lookup('miss')
+    try:
+        token = Token.objects.select_related('user__tenant').get(key=key)
+    except Token.DoesNotExist:
+        return None
+
+    user = token.user
+    cache.set(cache_key, user, settings.AUTH_TOKEN_CACHE_TIMEOUT)
+    token_cache.set(cache_key, user)
+
+    return copy.deepcopy(user)
+
+
+def invalidate_token(key):
+    """
+    Remove the user of the token from the caches.
+
+    Other processes keep their in-process copy until it expires.
+
+    Args:
+        key (str): the key of the token
+    """
+    cache_key = get_token_cache_key(key)
+    cache.delete(cache_key)
+    token_cache.delete(cache_key)
+
+
+def invalidate_user_tokens(user):
+    """
+    Remove the user from the caches of all its tokens.
+
+    Args:
+        user (instance): LilyUser instance
+    """
+    for key in Token.objects.filter(user=user).values_list('key', flat=True):
+        invalidate_token(key)
@@ -1,10 +1,12 @@
 import analytics
 from django.conf import settings
 from django.contrib.auth import user_logged_in
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
 
 from lily.tenant.middleware import get_current_user
+from lily.users.authentication.tokens import invalidate_token, invalidate_user_tokens
 from lily.users.models import LilyUser, UserInvite
 
 
@@ -57,6 +59,23 @@ def post_save_user_callback(sender, instance, created, **kwargs):
     })
 
 
+@receiver(post_save, sender=LilyUser)
+def post_save_user_token_callback(sender, instance, created, **kwargs):
+    """
+    Remove the cached user of the tokens, so deactivated users can't use them anymore.
+    """
+    if not created:
+        invalidate_user_tokens(instance)
+
+
+@receiver(post_delete, sender=Token)
+def post_delete_token_callback(sender, instance, **kwargs):
+    """
+    Remove the cached user of deleted and regenerated tokens.
+    """
+    invalidate_token(instance.key)
+
+
 @receiver(post_save, sender=UserInvite)
 def post_save_invite_callback(sender, instance, created, **kwargs):
     if settings.TESTING:
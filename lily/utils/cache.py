@@ -0,0 +1,50 @@
+import threading
+from collections import OrderedDict
+from time import time
+
+
+class LRUCache(object):
+    """
+    Small thread-safe in-process cache which keeps the most recently used entries for a limited time.
+
+    Meant for hot lookups where even a round trip to Redis is too slow. Every process has its own copy, so entries
+    should only be cached for as long as stale data is acceptable.
+    """
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+
+            if expires < time():
+                return default
+
+            # Re-insert the entry so it becomes the most recently used one.
+            self._data[key] = (value, expires)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time() + self.timeout)
+
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -6,13 +6,12 @@ from time import time
 
 import anyjson
 import phonenumbers
-import requests
 from django import forms
 from django.conf import settings
 from phonenumbers import geocoder
 import pycountry
-from requests_futures.sessions import FuturesSession
 from lily.tenant.middleware import get_current_user
+from lily.utils import http
 
 
 def autostrip(cls):
@@ -114,6 +113,21 @@ def format_phone_number(number, country_code=None, international=False):
     return parsed_number
 
 
+def normalize_phone_number(number):
+    """
+    Return the phone number in E.164 format, so numbers can be matched regardless of how they were entered.
+
+    Args:
+        number (str): the phone number as entered or received, e.g. "06-12345678" or "+31 (0)6 12345678"
+
+    Returns:
+        str: the normalized phone number, e.g. "+31612345678", or an empty string if there are no digits
+    """
+    number = parse_phone_number(number or '')
+
+    return format_phone_number(number, international=True) or number
+
+
 def parse_address(address):
     """
     Parse an address string and return street, number and complement.
@@ -156,6 +170,22 @@ def flatten(input):
     return pattern.sub('', re.escape(input)).lower()
 
 
+def chunks(sequence, size):
+    """
+    Split the sequence into lists of at most the given size.
+
+    Arguments:
+        sequence (iterable): items to split
+        size (int): maximum number of items per chunk
+
+    Returns:
+        generator: lists with the items of the sequence
+    """
+    sequence = list(sequence)
+    for i in xrange(0, len(sequence), size):
+        yield sequence[i:i + size]
+
+
 def dummy_function(x, y=None):
     return x, y
 
@@ -213,7 +243,8 @@ def post_intercom_event(event_name, user_id):
             'created_at': int(time())
         }
 
-        response = requests.post(
+        response = http.request(
+            'post',
             url='https://api.intercom.io/events',
             data=anyjson.serialize(payload),
             headers={
@@ -241,7 +272,7 @@ def send_get_request(url, credentials):
         'Authorization': 'Bearer %s' % credentials.access_token
     }
 
-    response = requests.get(url, headers=headers)
+    response = http.request('get', url, headers=headers)
 
     return response
 
@@ -264,17 +295,8 @@ def send_post_request(url, credentials, params, patch=False, async_request=False
         'Authorization': 'Bearer %s' % credentials.access_token
     }
 
-    if async_request:
-        session = FuturesSession()
-        if patch:
-            response = session.patch(url, headers=headers, json=params)
-        else:
-            response = session.post(url, headers=headers, json=params)
-    else:
-        if patch:
-            response = requests.patch(url, headers=headers, json=params)
-        else:
-            response = requests.post(url, headers=headers, json=params)
+    method = 'patch' if patch else 'post'
+    response = http.request(method, url, async_request=async_request, headers=headers, json=params)
 
     return response
 
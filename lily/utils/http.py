@@ -0,0 +1,89 @@
+import cookielib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+
+_local = threading.local()
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def create_session():
+    """
+    Return a new HTTP session with connection pools of the configured size for every host it connects to.
+
+    The session is shared by the requests of all tenants in its thread, so it doesn't keep cookies set by a server.
+    """
+    session = requests.Session()
+    session.cookies.set_policy(cookielib.DefaultCookiePolicy(allowed_domains=[]))
+    adapter = HTTPAdapter(pool_connections=settings.HTTP_POOL_CONNECTIONS, pool_maxsize=settings.HTTP_POOL_MAXSIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """
+    Return the HTTP session of the current thread.
+
+    The session keeps connections alive, so repeated requests to the same host reuse them instead of setting up a new
+    connection (and TLS handshake) every time. Sessions aren't guaranteed to be thread-safe, so every thread gets its
+    own.
+
+    Returns:
+        requests.Session
+    """
+    session = getattr(_local, 'session', None)
+
+    if session is None:
+        session = create_session()
+        _local.session = session
+
+    return session
+
+
+def get_executor():
+    """
+    Return the shared thread pool for requests that are sent in the background.
+
+    All background requests of the process share a fixed number of threads, instead of every request starting a new
+    thread pool. Every thread sends its requests with its own session, so the connections are reused per thread.
+
+    Returns:
+        ThreadPoolExecutor
+    """
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.HTTP_ASYNC_WORKERS)
+
+    return _executor
+
+
+def _send(method, url, kwargs):
+    return get_session().request(method, url, **kwargs)
+
+
+def request(method, url, async_request=False, **kwargs):
+    """
+    Send a request through the shared sessions, with the default timeout unless another one is given.
+
+    Args:
+        method (str): the HTTP method
+        url (str): the url to call
+        async_request (bool, optional): send the request in the background and return a Future
+
+    Returns:
+        Response, or a Future of the Response when async_request is used
+    """
+    kwargs.setdefault('timeout', settings.HTTP_TIMEOUT)
+
+    if async_request:
+        return get_executor().submit(_send, method, url, kwargs)
+
+    return get_session().request(method, url, **kwargs)
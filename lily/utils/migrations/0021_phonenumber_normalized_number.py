@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('utils', '0020_auto_20180822_1308'),
+    ]
+
+    operations = [
+        # Nullable, so adding the column doesn't rewrite the table. Existing rows are filled in by migration 0023.
+        migrations.AddField(
+            model_name='phonenumber',
+            name='normalized_number',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='phonenumber',
+            index_together=set([('tenant', 'normalized_number')]),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('utils', '0021_phonenumber_normalized_number'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_type', models.CharField(max_length=255)),
+                ('object_id', models.PositiveIntegerField()),
+                ('event', models.CharField(max_length=255)),
+                ('payload', models.TextField()),
+                ('status', models.PositiveSmallIntegerField(choices=[(0, 'Pending'), (1, 'Delivered'), (2, 'Failed')], default=0)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(db_index=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('webhook', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='utils.Webhook')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='webhookevent',
+            index_together=set([('webhook', 'status', 'next_attempt')]),
+        ),
+    ]
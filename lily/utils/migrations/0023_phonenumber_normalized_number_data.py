@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, transaction
+
+from lily.utils.functions import normalize_phone_number
+
+
+def normalize_phone_numbers(apps, schema_editor):
+    PhoneNumber = apps.get_model('utils', 'PhoneNumber')
+
+    last_pk = 0
+    while True:
+        # Walk through the table by primary key, so every batch is a cheap index range scan.
+        batch = list(PhoneNumber.objects.filter(
+            pk__gt=last_pk,
+            normalized_number__isnull=True,
+        ).order_by('pk').values_list('pk', 'number')[:1000])
+        if not batch:
+            break
+
+        with transaction.atomic():
+            for pk, number in batch:
+                PhoneNumber.objects.filter(pk=pk).update(normalized_number=normalize_phone_number(number))
+
+        last_pk = batch[-1][0]
+
+
+def do_nothing(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+    # Every batch is committed on its own, so the table isn't locked for the whole migration.
+    atomic = False
+
+    dependencies = [
+        ('utils', '0022_webhookevent'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_phone_numbers, do_nothing),
+    ]
@@ -1,4 +1,5 @@
 from django.contrib.contenttypes.fields import GenericRelation
+from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
@@ -60,6 +61,24 @@ class ArchivedMixin(models.Model):
         abstract = True
 
 
+class ContentTypeMixin(models.Model):
+    """
+    Content type model, provides the content type of the instance.
+    """
+    @property
+    def content_type(self):
+        """
+        Return the content type (Django model) for this model.
+
+        The content type is looked up through the ContentType cache, so only the first lookup per process hits the
+        database.
+        """
+        return ContentType.objects.get_for_model(self)
+
+    class Meta:
+        abstract = True
+
+
 class Common(DeletedMixin, TenantMixin):
     """
     Common model to make it possible to easily define relations to other models.
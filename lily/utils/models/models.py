@@ -3,6 +3,7 @@ from django.utils.translation import ugettext_lazy as _
 
 from lily.tenant.models import TenantMixin
 from lily.utils.countries import COUNTRIES
+from lily.utils.functions import normalize_phone_number
 
 
 PHONE_TYPE_CHOICES = (
@@ -29,6 +30,8 @@ class PhoneNumber(TenantMixin):
     )
 
     number = models.CharField(max_length=40)
+    # E.164 version of the number, used to match incoming calls.
+    normalized_number = models.CharField(max_length=40, blank=True, null=True)
     type = models.CharField(
         max_length=15,
         choices=PHONE_TYPE_CHOICES,
@@ -45,10 +48,18 @@ class PhoneNumber(TenantMixin):
     def __unicode__(self):
         return self.number
 
+    def save(self, *args, **kwargs):
+        self.normalized_number = normalize_phone_number(self.number)
+
+        return super(PhoneNumber, self).save(*args, **kwargs)
+
     class Meta:
         app_label = 'utils'
         verbose_name = _('phone number')
         verbose_name_plural = _('phone numbers')
+        index_together = [
+            ['tenant', 'normalized_number'],
+        ]
 
 
 class Address(TenantMixin):
@@ -155,3 +166,35 @@ class Webhook(TenantMixin):
 
     class Meta:
         app_label = 'utils'
+
+
+class WebhookEvent(models.Model):
+    """
+    An event waiting to be delivered to a webhook, so deliveries survive restarts and can be retried.
+    """
+    PENDING, DELIVERED, FAILED = range(3)
+    STATUS_CHOICES = (
+        (PENDING, _('Pending')),
+        (DELIVERED, _('Delivered')),
+        (FAILED, _('Failed')),
+    )
+
+    webhook = models.ForeignKey(Webhook, related_name='events', on_delete=models.CASCADE)
+    object_type = models.CharField(max_length=255)
+    object_id = models.PositiveIntegerField()
+    event = models.CharField(max_length=255)
+    payload = models.TextField()
+    status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt = models.DateTimeField(db_index=True)
+    last_error = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __unicode__(self):
+        return '%s %s %s' % (self.object_type, self.object_id, self.event)
+
+    class Meta:
+        app_label = 'utils'
+        index_together = [
+            ['webhook', 'status', 'next_attempt'],
+        ]
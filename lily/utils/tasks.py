@@ -1,8 +1,11 @@
 import logging
 
 from celery.task import task
+from django.conf import settings
 from django.core.management import call_command
 
+from lily.utils import webhooks
+
 
 logger = logging.getLogger(__name__)
 
@@ -25,3 +28,24 @@ def clear_sessions_scheduler():
     Call the Django provided management command to clear expired sessions.
     """
     call_command('clearsessions', interactive=False)
+
+
+@task(name='deliver_webhook_events', logger=logger)
+def deliver_webhook_events(webhook_id):
+    """
+    Deliver the due events of the webhook.
+    """
+    if not webhooks.deliver_webhook_events(webhook_id):
+        # Enough workers are delivering to this webhook already, so try again later.
+        deliver_webhook_events.apply_async(args=(webhook_id,), countdown=settings.WEBHOOK_BATCH_DELAY)
+
+
+@task(name='deliver_pending_webhook_events', logger=logger)
+def deliver_pending_webhook_events():
+    """
+    Start delivering the webhook events that are due for a retry or of which the delivery task was lost.
+    """
+    for webhook_id in webhooks.get_due_webhook_ids():
+        deliver_webhook_events.apply_async(args=(webhook_id,))
+
+    webhooks.cleanup_webhook_events()
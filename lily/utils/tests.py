@@ -1,6 +1,29 @@
+import httplib
+from datetime import timedelta
+from StringIO import StringIO
+
+import requests
+from django.conf import settings
 from django.test import TestCase
 from django.http.request import HttpRequest
+from django.utils import timezone
+from mock import patch
+from requests.cookies import MockRequest, MockResponse
+from requests.exceptions import ConnectionError
+
+from lily.accounts.models import Account
+from lily.calls.models import Call, CallRecord
+from lily.cases.models import Case
+from lily.contacts.models import Contact
+from lily.deals.models import Deal
+from lily.messaging.email.models.models import EmailMessage
+from lily.notes.models import Note
+from lily.tenant.factories import TenantFactory
+from lily.utils import http
+from lily.utils.models.factories import WebhookFactory
+from lily.utils.models.models import WebhookEvent
 from lily.utils.request import is_external_referer
+from lily.utils.webhooks import claim_webhook_events, deliver_webhook_event, queue_webhook_event
 
 
 class UtilTests(TestCase):
@@ -15,3 +38,111 @@ class UtilTests(TestCase):
         request.META['HTTP_REFERER'] = 'app.notlily.com/some-url/'
 
         self.assertTrue(is_external_referer(request))
+
+
+class ContentTypeMixinTests(TestCase):
+    models = [Account, Call, CallRecord, Case, Contact, Deal, EmailMessage, Note]
+
+    def test_content_type(self):
+        """
+        Test if the content type matches the model and doesn't query the database after the first lookup.
+        """
+        for model in self.models:
+            self.assertEqual(model().content_type.model_class(), model)
+
+        with self.assertNumQueries(0):
+            for model in self.models:
+                model().content_type
+
+
+class HttpTests(TestCase):
+    @patch.object(http.requests.Session, 'request')
+    def test_request_reuses_session(self, request_mock):
+        """
+        Test that requests share the session of the thread and get the default timeout.
+        """
+        self.assertIs(http.get_session(), http.get_session())
+
+        http.request('get', 'https://example.com/')
+        http.request('get', 'https://example.com/', timeout=5)
+
+        self.assertEqual(request_mock.call_args_list[0][1]['timeout'], settings.HTTP_TIMEOUT)
+        self.assertEqual(request_mock.call_args_list[1][1]['timeout'], 5)
+
+    @patch.object(http.requests.Session, 'request')
+    def test_async_request_session_per_thread(self, request_mock):
+        """
+        Test that requests in the background are sent with the session of the worker thread, not a shared one.
+        """
+        request_mock.side_effect = lambda *args, **kwargs: http.get_session()
+
+        session = http.request('post', 'https://example.com/', async_request=True).result()
+
+        self.assertIsNot(session, http.get_session())
+        self.assertEqual(request_mock.call_args[1]['timeout'], settings.HTTP_TIMEOUT)
+
+    def test_session_ignores_cookies(self):
+        """
+        Test that the shared sessions don't keep cookies set by a server, so they aren't sent for other tenants.
+        """
+        session = http.create_session()
+        request = requests.Request('get', 'https://example.com/').prepare()
+        headers = httplib.HTTPMessage(StringIO('Set-Cookie: session=secret; Path=/\r\n\r\n'))
+
+        session.cookies.extract_cookies(MockResponse(headers), MockRequest(request))
+
+        self.assertEqual(len(session.cookies), 0)
+
+
+class WebhookEventTests(TestCase):
+    def test_queue_merges_events(self):
+        """
+        Test that successive events for the same object are merged into the pending event.
+        """
+        webhook = WebhookFactory.create(tenant=TenantFactory.create())
+
+        queue_webhook_event(webhook, 'contact', 1, 'create', {'id': 1, 'first_name': 'Foo'}, {'id': 1})
+        queue_webhook_event(webhook, 'contact', 1, 'update', {'last_name': 'Bar'}, {'id': 1, 'last_name': 'Bar'})
+        queue_webhook_event(webhook, 'contact', 2, 'create', {'id': 2}, {'id': 2})
+
+        self.assertEqual(WebhookEvent.objects.count(), 2)
+        event = WebhookEvent.objects.get(object_id=1)
+        self.assertEqual(event.event, 'create')
+        self.assertIn('"first_name": "Foo"', event.payload)
+        self.assertIn('"last_name": "Bar"', event.payload)
+
+    @patch('lily.utils.webhooks.get_session')
+    def test_deliver_retries(self, get_session_mock):
+        """
+        Test that failed deliveries are retried later and successful ones are marked as delivered.
+        """
+        webhook = WebhookFactory.create(tenant=TenantFactory.create())
+        queue_webhook_event(webhook, 'deal', 1, 'create', {'id': 1}, {'id': 1})
+        event = WebhookEvent.objects.get()
+
+        get_session_mock.return_value.post.side_effect = ConnectionError()
+        self.assertFalse(deliver_webhook_event(event, webhook.url))
+        self.assertEqual(event.status, WebhookEvent.PENDING)
+        self.assertEqual(event.attempts, 1)
+        self.assertGreater(event.next_attempt, event.created)
+
+        get_session_mock.return_value.post.side_effect = None
+        self.assertTrue(deliver_webhook_event(event, webhook.url))
+        self.assertEqual(WebhookEvent.objects.get().status, WebhookEvent.DELIVERED)
+
+    def test_claim_keeps_object_order(self):
+        """
+        Test that new events of an object are held back while an older event of the object is waiting for a retry.
+        """
+        webhook = WebhookFactory.create(tenant=TenantFactory.create())
+        queue_webhook_event(webhook, 'deal', 1, 'create', {'id': 1}, {'id': 1})
+        WebhookEvent.objects.update(attempts=1, next_attempt=timezone.now() + timedelta(minutes=1))
+
+        # The retried event can't be merged with, so these are new events.
+        queue_webhook_event(webhook, 'deal', 1, 'update', {'name': 'Foo'}, {'id': 1, 'name': 'Foo'})
+        queue_webhook_event(webhook, 'deal', 2, 'create', {'id': 2}, {'id': 2})
+
+        self.assertEqual([event.object_id for event in claim_webhook_events(webhook.pk)], [2])
+
+        WebhookEvent.objects.filter(attempts=1).update(status=WebhookEvent.DELIVERED)
+        self.assertEqual([event.event for event in claim_webhook_events(webhook.pk)], ['update'])
@@ -150,6 +150,10 @@ class DownloadRedirectView(LoginRequiredMixin, RedirectView):
     }
 
     def get_redirect_url(self, *args, **kwargs):
+        if isinstance(self.instance, EmailAttachment):
+            # The stored file is named after its content, the proxy sends it with the name of the attachment.
+            return reverse('email_attachment_proxy_view', kwargs={'pk': self.instance.pk})
+
         field = getattr(self.instance, self.field_name)
         return field.url  # Let the storage backend generate an url for us.
 
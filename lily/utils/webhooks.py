@@ -0,0 +1,237 @@
+import json
+import logging
+from datetime import timedelta
+
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from requests.exceptions import RequestException
+
+from lily.utils.http import get_session
+from lily.utils.models.models import Webhook, WebhookEvent
+
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_SLOTS_KEY = 'webhook:slots:%s'
+
+# Only release a slot while the counter still exists, an expired counter would otherwise be recreated at -1 and allow
+# an extra worker.
+RELEASE_SLOT_SCRIPT = """
+local slots = tonumber(redis.call('get', KEYS[1]))
+if slots and slots > 0 then
+    return redis.call('decr', KEYS[1])
+end
+return 0
+"""
+
+
+def queue_webhook_event(webhook, object_type, object_id, event, data, obj):
+    """
+    Store an event for the webhook and deliver it once the current transaction is committed.
+
+    Rapid successive events for the same object are merged into the event that is still waiting to be delivered, so
+    the webhook receives the latest state once instead of every intermediate change.
+
+    Args:
+        webhook (instance): Webhook instance to deliver the event to
+        object_type (str): the model name of the object
+        object_id (int): the primary key of the object
+        event (str): 'create' or 'update'
+        data (dict): the changed data
+        obj (dict): the serialized object
+    """
+    now = timezone.now()
+    pending = WebhookEvent.objects.filter(
+        webhook=webhook,
+        object_type=object_type,
+        object_id=object_id,
+        status=WebhookEvent.PENDING,
+        attempts=0,
+        next_attempt__lte=now,
+    ).order_by('-pk').first()
+
+    if pending:
+        payload = json.loads(pending.payload)
+        payload['data'].update(data)
+        payload['object'] = obj
+
+        # Only merge when the event wasn't claimed for delivery in the meantime.
+        merged = WebhookEvent.objects.filter(
+            pk=pending.pk,
+            attempts=0,
+            next_attempt=pending.next_attempt,
+        ).update(payload=json.dumps(payload, sort_keys=True, default=lambda x: str(x)))
+
+        if merged:
+            return
+
+    payload = {
+        'type': object_type,
+        'data': data,
+        'object': obj,
+        'event': event,
+    }
+    WebhookEvent.objects.create(
+        webhook=webhook,
+        object_type=object_type,
+        object_id=object_id,
+        event=event,
+        payload=json.dumps(payload, sort_keys=True, default=lambda x: str(x)),
+        next_attempt=now,
+    )
+
+    from lily.utils.tasks import deliver_webhook_events
+
+    transaction.on_commit(lambda: deliver_webhook_events.apply_async(
+        args=(webhook.pk,),
+        countdown=settings.WEBHOOK_BATCH_DELAY,
+    ))
+
+
+def get_retry_delay(attempts):
+    """
+    Return the number of seconds to wait before the next attempt, doubling with every failed attempt.
+    """
+    return min(settings.WEBHOOK_RETRY_DELAY * 2 ** (attempts - 1), settings.WEBHOOK_MAX_RETRY_DELAY)
+
+
+def claim_webhook_events(webhook_id):
+    """
+    Claim the events of the webhook that are due, so other workers skip them while they are being delivered.
+
+    Events of an object are delivered in order, so an event is held back while an older event of the same object is
+    still pending (being delivered or waiting for a retry).
+
+    Args:
+        webhook_id (int): the webhook to claim the events of
+
+    Returns:
+        list: the claimed WebhookEvent instances, oldest first
+    """
+    now = timezone.now()
+    older_pending = WebhookEvent.objects.filter(
+        webhook_id=OuterRef('webhook_id'),
+        object_type=OuterRef('object_type'),
+        object_id=OuterRef('object_id'),
+        status=WebhookEvent.PENDING,
+        pk__lt=OuterRef('pk'),
+    )
+
+    with transaction.atomic():
+        events = list(WebhookEvent.objects.select_for_update(skip_locked=True).annotate(
+            held_back=Exists(older_pending),
+        ).filter(
+            webhook_id=webhook_id,
+            status=WebhookEvent.PENDING,
+            next_attempt__lte=now,
+            held_back=False,
+        ).order_by('pk')[:settings.WEBHOOK_BATCH_SIZE])
+
+        # Lease the events until the request timed out for all of them, in case the worker dies while delivering.
+        lease = now + timedelta(seconds=settings.WEBHOOK_TIMEOUT * (len(events) + 1))
+        WebhookEvent.objects.filter(pk__in=[event.pk for event in events]).update(next_attempt=lease)
+
+    return events
+
+
+def deliver_webhook_event(event, url):
+    """
+    Post the event to its webhook and store the result.
+
+    Args:
+        event (instance): WebhookEvent instance
+        url (str): the url of the webhook
+
+    Returns:
+        bool: True if the event was delivered
+    """
+    event.attempts += 1
+
+    try:
+        response = get_session().post(
+            url,
+            data=event.payload,
+            headers={'Content-Type': 'application/json'},
+            timeout=settings.WEBHOOK_TIMEOUT,
+        )
+        response.raise_for_status()
+    except RequestException as e:
+        event.last_error = unicode(e)
+        if event.attempts >= settings.WEBHOOK_MAX_ATTEMPTS:
+            logger.warning('Giving up on webhook event %s after %s attempts: %s' % (event.pk, event.attempts, e))
+            event.status = WebhookEvent.FAILED
+        else:
+            event.next_attempt = timezone.now() + timedelta(seconds=get_retry_delay(event.attempts))
+    else:
+        event.status = WebhookEvent.DELIVERED
+        event.last_error = ''
+
+    event.save(update_fields=['attempts', 'status', 'next_attempt', 'last_error'])
+
+    return event.status == WebhookEvent.DELIVERED
+
+
+def deliver_webhook_events(webhook_id):
+    """
+    Deliver the due events of the webhook, with a limited number of workers per webhook at the same time.
+
+    Failed events are retried by deliver_pending_webhook_events once they are due again.
+
+    Args:
+        webhook_id (int): the webhook to deliver the events of
+
+    Returns:
+        bool: False if the webhook already has the maximum number of workers delivering to it
+    """
+    url = Webhook._base_manager.filter(pk=webhook_id).values_list('url', flat=True).first()
+    if not url:
+        # The webhook was removed, together with its events.
+        return True
+
+    connection = redis.StrictRedis.from_url(settings.REDIS_URL)
+    release_slot = connection.register_script(RELEASE_SLOT_SCRIPT)
+    slots_key = WEBHOOK_SLOTS_KEY % webhook_id
+
+    if connection.incr(slots_key) > settings.WEBHOOK_MAX_CONCURRENCY:
+        release_slot(keys=[slots_key])
+        return False
+
+    try:
+        while True:
+            # Keep the slots for as long as the next batch may take, so the slots of workers that died while
+            # delivering are released.
+            connection.expire(slots_key, settings.WEBHOOK_TIMEOUT * (settings.WEBHOOK_BATCH_SIZE + 1))
+
+            events = claim_webhook_events(webhook_id)
+            if not events:
+                break
+
+            for event in events:
+                deliver_webhook_event(event, url)
+    finally:
+        release_slot(keys=[slots_key])
+
+    return True
+
+
+def get_due_webhook_ids():
+    """
+    Return the ids of the webhooks with events that are due, including events of which the delivery was lost.
+    """
+    return WebhookEvent.objects.filter(
+        status=WebhookEvent.PENDING,
+        next_attempt__lte=timezone.now(),
+    ).order_by().values_list('webhook_id', flat=True).distinct()
+
+
+def cleanup_webhook_events():
+    """
+    Remove the delivered and failed events which are older than the retention period.
+    """
+    WebhookEvent.objects.filter(
+        status__in=[WebhookEvent.DELIVERED, WebhookEvent.FAILED],
+        created__lt=timezone.now() - timedelta(days=settings.WEBHOOK_EVENT_RETENTION_DAYS),
+    ).delete()
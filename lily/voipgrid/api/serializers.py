@@ -3,6 +3,7 @@ import logging
 import traceback
 
 from channels import Group
+from django.conf import settings
 from django.contrib.staticfiles.templatetags.staticfiles import static
 from django.utils.translation import ugettext_lazy as _
 from rest_framework import serializers
@@ -11,7 +12,10 @@ from lily.accounts.models import Account
 from lily.calls.models import CallRecord, CallParticipant, CallTransfer
 from lily.contacts.models import Contact
 from lily.users.models import LilyUser
-from lily.utils.functions import get_country_code_by_country, get_phone_number_without_country_code
+from lily.utils.cache import LRUCache
+from lily.utils.functions import (
+    get_country_code_by_country, get_phone_number_without_country_code, normalize_phone_number
+)
 
 import phonenumbers
 from phonenumbers import geocoder, NumberParseException
@@ -19,6 +23,57 @@ from phonenumbers import geocoder, NumberParseException
 
 logger = logging.getLogger(__name__)
 
+# Matched callers per tenant and normalized number, only matches are cached so new phone numbers are found right away.
+# Changed or removed numbers, names and deleted callers are only picked up after the (short) timeout.
+caller_cache = LRUCache(size=settings.CALLER_ID_CACHE_SIZE, timeout=settings.CALLER_ID_CACHE_TIMEOUT)
+
+
+def find_caller(tenant_id, number):
+    """
+    Find the contact or account the phone number belongs to.
+
+    Args:
+        tenant_id (int): the tenant to search in
+        number (str): the phone number of the caller, in any format
+
+    Returns:
+        tuple: name and contact or account of the caller, or an empty name and None if there's no match
+    """
+    normalized_number = normalize_phone_number(number)
+    if not normalized_number:
+        return '', None
+
+    key = (tenant_id, normalized_number)
+    caller = caller_cache.get(key)
+    if caller:
+        return caller
+
+    # Uses the (tenant, normalized_number) index on the phone numbers.
+    contact = Contact.objects.filter(
+        tenant_id=tenant_id,
+        phone_numbers__normalized_number=normalized_number,
+        is_deleted=False
+    ).only('id', 'first_name', 'last_name').order_by('-modified').first()
+
+    if contact:
+        caller = (contact.full_name, contact)
+    else:
+        account = Account.objects.filter(
+            tenant_id=tenant_id,
+            phone_numbers__normalized_number=normalized_number,
+            is_deleted=False
+        ).only('id', 'name').order_by('-modified').first()
+
+        if account:
+            caller = (account.name, account)
+
+    if not caller:
+        return '', None
+
+    caller_cache.set(key, caller)
+
+    return caller
+
 
 class CallNotificationSerializer(serializers.Serializer):
     call_id = serializers.CharField()
@@ -223,27 +278,8 @@ class CallNotificationSerializer(serializers.Serializer):
         }
 
     def match_external_participant(self, data):
-        name = ''
         number = data['number'] or ''
-        source = None
-
-        contact = Contact.objects.filter(
-            phone_numbers__number=number,
-            is_deleted=False
-        ).order_by('-modified').first()
-
-        if contact:
-            name = contact.full_name
-            source = contact
-        else:
-            account = Account.objects.filter(
-                phone_numbers__number=number,
-                is_deleted=False
-            ).order_by('-modified').first()
-
-            if account:
-                name = account.name
-                source = account
+        name, source = find_caller(self.context['request'].user.tenant_id, number)
 
         return {
             'name': name,
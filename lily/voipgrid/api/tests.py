@@ -341,6 +341,29 @@ class CallNotificationsAPITestCase(UserBasedTest, APITestCase):
 
         self.generic_test_simple_call('outbound', participant_a, participant_b)
 
+    def test_inbound_call_matches_normalized_number(self):
+        """
+        Test that an incoming call is matched to a contact whose phone number was entered in another format.
+        """
+        contact = factories.ContactFactory.create(tenant=self.user_obj.tenant)
+        number = self.generate_number()
+        # Saved in the national format with separators, e.g. "050-1234567".
+        phone_number = PhoneNumberFactory(tenant=self.user_obj.tenant, number='0{}-{}'.format(number[3:5], number[5:]))
+        contact.phone_numbers.add(phone_number)
+        self.assertEqual(phone_number.normalized_number, number)
+
+        participant_a = self.generate_participant(number=number)
+        participant_b = self.generate_participant(internal=True)
+        destination_b = self.generate_destination(number=participant_b['number'], targets=[participant_b, ])
+
+        ringing = self.generate_ringing_json('inbound', '100', caller=participant_a, destination=destination_b)
+        request = self.user.post(reverse(self.list_url), ringing)
+        self.assertEqual(request.status_code, status.HTTP_201_CREATED)
+
+        crs = CallRecord.objects.all()
+        self.assertEqual(len(crs), 1)  # There should only be one call record.
+        self.assertEqual(crs[0].caller.name, contact.full_name)  # The caller should be matched to the contact.
+
     def test_simple_outbound_call_to_unknow_number(self):
         """
         Test a simple outbound call to a number which does not belong to a known contact or an account.